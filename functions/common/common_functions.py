@@ -1,11 +1,21 @@
 import streamlit as st
 import os
+import html
+import time
 import tarfile
 import shutil
-import paramiko
 from tkinter import filedialog
 from functions.replicate_polymer.replicate_func import reset_replicate_options
 from functions.topology.topology_func import reset_topology_options
+from functions.common.ssh_pool import exec_remote_command
+from functions.common.job_engine import get_job_engine, JOB_QUEUED, JOB_RUNNING, JOB_FAILED, JOB_CANCELLED
+from functions.common.job_store import FINISHED_STATES, detached_runs, follow_run, forget_run
+from functions.common.job_history import calibration_samples
+from functions.common.slurm_resources import estimate_resources
+
+
+# Seconds between reruns of a page while it has jobs in progress
+JOB_REFRESH_INTERVAL = 2
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -22,12 +32,6 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def upload_file_to_server(ssh, local_path, remote_path):
-    sftp = ssh.open_sftp()
-    sftp.put(local_path, remote_path)
-    sftp.close()
-
-
 def create_tar_gz(output_folder, output_file_paths):
     temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
     with tarfile.open(temp_tar_path, "w:gz") as tar:
@@ -42,6 +46,91 @@ def create_tar_gz(output_folder, output_file_paths):
         return None
 
 
+def render_output_box(placeholder, text, height=300):
+    """Show program output in an auto-scrolling box inside a Streamlit placeholder."""
+    # column-reverse keeps the box scrolled to its last line as new lines are added
+    placeholder.markdown(f'<div style="display: flex; flex-direction: column-reverse; overflow-y: auto; '
+                         f'height: {height}px; background-color: #f0f2f6; padding: 0.5em;">'
+                         f'<pre style="margin: 0; white-space: pre-wrap;">{html.escape(text)}'
+                         f'</pre></div>', unsafe_allow_html=True)
+
+
+def show_jobs_panel(kind, show_results):
+    """List the background jobs of one program. show_results(job) draws the outputs of a finished job.
+
+    While any job is still queued or running, the page reruns itself every JOB_REFRESH_INTERVAL seconds.
+    Runs of earlier sessions that no job follows are listed below, with their outputs one click away.
+    """
+    job_engine = get_job_engine()
+    jobs = job_engine.list_jobs(kind)
+    show_saved_runs(kind)
+    if not jobs:
+        return
+
+    st.markdown("<h1 style='font-size:22px;'>Jobs</h1>", unsafe_allow_html=True)
+    for job in jobs:
+        label = f"{job.name} - {job.status.upper()} ({job.elapsed:.0f} s)"
+        with st.expander(label, expanded=job.is_active):
+            if job.status == JOB_QUEUED:
+                st.info("Waiting for a free worker...")
+            elif job.status == JOB_RUNNING:
+                if job.progress:
+                    done, total, file_name = job.progress
+                    st.progress(done / total, text=f"Downloaded {file_name} ({done}/{total})")
+                render_output_box(st.empty(), job.output_text())
+            elif job.status == JOB_FAILED:
+                st.error(f"ERROR!!! {job.error}")
+            elif job.status == JOB_CANCELLED:
+                if job.timed_out:
+                    st.warning(f"Stopped after the time limit of {job.max_runtime / 60:.0f} min")
+                else:
+                    st.warning("Cancelled")
+                render_output_box(st.empty(), job.output_text())
+            else:
+                show_results(job)
+
+            if job.is_active:
+                # Cancels the SLURM jobs or kills the remote/local processes of the run
+                if job.cancel_requested:
+                    st.info("Stopping...")
+                elif st.button("STOP", key=f"stop_job_{job.job_id}"):
+                    job_engine.cancel(job.job_id)
+                    st.rerun()
+            elif st.button("Remove from list", key=f"forget_job_{job.job_id}"):
+                job_engine.forget(job.job_id)
+                if job.run_id:
+                    forget_run(job.run_id)
+                st.rerun()
+
+    if any(job.is_active for job in jobs):
+        time.sleep(JOB_REFRESH_INTERVAL)
+        st.rerun()
+
+
+def show_saved_runs(kind):
+    """Runs of one program saved in the job store by an earlier session (see job_store)."""
+    saved_runs = detached_runs(kind)
+    if not saved_runs:
+        return
+
+    st.markdown("<h1 style='font-size:22px;'>Runs of earlier sessions</h1>", unsafe_allow_html=True)
+    for run in saved_runs:
+        submitted = time.strftime("%Y-%m-%d %H:%M", time.localtime(run["submitted"]))
+        with st.expander(f"{run['name']} - {run['state']} ({run['backend']}, {submitted})"):
+            st.text(f"Run directory: {run['run_directory']}")
+            if run["job_ids"]:
+                st.text(f"SLURM jobs: {run['job_ids']}")
+            if run["state"] in FINISHED_STATES:
+                if st.button("Fetch outputs", key=f"fetch_run_{run['run_id']}"):
+                    follow_run(run)
+                    st.rerun()
+            else:
+                st.info("Followed by another TOREPO process")
+            if st.button("Remove from list", key=f"forget_run_{run['run_id']}"):
+                forget_run(run["run_id"])
+                st.rerun()
+
+
 def clean_options(program):
     if st.button("Clean program options"):
         if program == "Topology":
@@ -52,17 +141,37 @@ def clean_options(program):
             st.rerun()
 
 
+def suggest_slurm_resources(program, atom_count, image_multiplier, name_server, name_user, ssh_key_options):
+    """Fill in the SLURM resource fields of the sidebar with the estimate for a run of program (called
+    before the page is drawn again). The message is shown by show_resource_suggestion."""
+    if not atom_count:
+        st.session_state[f"resource_estimate_{program}"] = "ERROR!!! Please select an input file with atoms first"
+        return
+    samples = calibration_samples(program, name_server, name_user, ssh_key_options)
+    estimate = estimate_resources(program, atom_count, image_multiplier, samples)
+
+    st.session_state.use_queuing_system = True
+    st.session_state.slurm_cpus_per_task = estimate["cpus_per_task"]
+    st.session_state.slurm_mem = estimate["mem"]
+    st.session_state.slurm_time_limit = estimate["time_limit"]
+    source = (f"calibrated from {estimate['calibrated_from']} previous runs" if estimate["calibrated_from"]
+              else "default model, not enough previous runs in the job history or sacct")
+    st.session_state[f"resource_estimate_{program}"] = (f"Suggested resources for "
+                                                        f"{atom_count * image_multiplier} atoms ({source}). "
+                                                        f"You can edit them in the sidebar.")
+
+
+def show_resource_suggestion(program, on_click, help_text):
+    """The "Suggest SLURM resources" button of the page of program and the message of its last suggestion."""
+    st.button("Suggest SLURM resources", on_click=on_click, help=help_text, key=f"suggest_resources_{program}")
+    if st.session_state.get(f"resource_estimate_{program}"):
+        st.info(st.session_state[f"resource_estimate_{program}"])
+
+
 def get_host_name(name_server, name_user, ssh_key_options):  # At the moment, we are not using it
     command = "hostname"
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(name_server, username=name_user, key_filename=ssh_key_options)
-
-    stdin, stdout, stderr = ssh.exec_command(command)
-    output = stdout.read().decode()
-    error = stderr.read().decode()
-    ssh.close()
+    output, error = exec_remote_command(name_server, name_user, ssh_key_options, command)
     return output, error
 
 
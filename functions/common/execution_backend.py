@@ -0,0 +1,781 @@
+import os
+import json
+import math
+import time
+import queue
+import shlex
+import shutil
+import signal
+import logging
+import tempfile
+import fnmatch
+import itertools
+import threading
+import subprocess
+from functions.common.ssh_pool import get_ssh_client, exec_remote_command
+from functions.common.sftp_transfer import open_sftp_session, upload_files, fetch_output_files
+from functions.common.upload_cache import upload_files_cached
+from functions.common.output_stream import read_channel_streaming, read_files_streaming
+from functions.common.slurm_poller import get_slurm_poller, cancel_slurm_jobs
+from functions.common.slurm_resources import sbatch_resource_lines
+from functions.common.job_history import record_slurm_accounting
+from functions.common.job_store import record_run, update_run
+from functions.common.job_engine import on_cancel
+from functions.common.remote_run import (REMOTE_RUNS_DIRNAME, RUN_DIRECTORY_MAX_AGE_DAYS, MANIFEST_FILENAME,
+                                         new_run_id, get_run_directory, prepare_run_directory,
+                                         start_marker_command, manifest_command, wrap_command_with_manifest,
+                                         read_remote_manifest, manifest_file_names, verify_downloaded_files)
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# States of a run, the same on every backend (SLURM states are mapped onto them)
+RUN_PENDING = "PENDING"
+RUN_RUNNING = "RUNNING"
+RUN_COMPLETED = "COMPLETED"
+RUN_FAILED = "FAILED"
+RUN_CANCELLED = "CANCELLED"
+RUN_FINISHED_STATES = (RUN_COMPLETED, RUN_FAILED, RUN_CANCELLED)
+
+BACKEND_LOCAL = "Local"
+BACKEND_SSH = "SSH"
+BACKEND_SLURM = "SLURM"
+
+# Local runs live next to the job history, in <LOCAL_WORKING_DIRECTORY>/torepo_runs/<run_id>
+LOCAL_WORKING_DIRECTORY = os.path.join(os.path.expanduser("~"), ".torepo")
+LOCAL_POOL_WORKERS = os.cpu_count() or 1
+# Order of the local runs waiting for a core: the lowest priority starts first, equal ones in submission order
+RUN_PRIORITY_HIGH = 0
+RUN_PRIORITY_NORMAL = 10
+RUN_PRIORITY_LOW = 20
+# Local and direct SSH runs are detached from the GUI: the PID of their process group (for cancel)
+# and their outputs are kept in the run directory, so that another session can follow them
+PID_FILENAME = ".pid"
+STDOUT_FILENAME = ".stdout"
+STDERR_FILENAME = ".stderr"
+# Seconds between checks of a detached run, and attempts to follow it again after a lost connection
+FOLLOW_INTERVAL = 0.5
+FOLLOW_ATTEMPTS = 3
+# Seconds a cancelled run gets to exit after SIGTERM before its process group is killed
+KILL_GRACE_PERIOD = 5
+# Function of this module that follows a saved run from another session (see job_store)
+REATTACH_FUNCTION = "functions.common.execution_backend.reattach_run"
+SLURM_SCRIPT_NAME = "slurm_job.sh"
+SLURM_LOG_FILES = ["slurm.out", "slurm.err"]
+# Task i of a job array runs in <run_directory>/task_<i> and logs to slurm_<i>.out/.err
+SLURM_ARRAY_LOG_FILES = ["slurm_%a.out", "slurm_%a.err"]
+TASK_DIRECTORY_PREFIX = "task_"
+
+
+class RunHandle:
+    """A command submitted to an ExecutionBackend: where it runs and how far it has got."""
+
+    def __init__(self, backend, run_id, run_directory, job_name):
+        self.backend = backend.name
+        self.run_id = run_id
+        self.run_directory = run_directory
+        self.job_name = job_name
+        self.job_id = None
+        # Number of tasks of a SLURM job array, None for a single run
+        self.task_count = None
+        self.state = RUN_PENDING
+        self.exit_code = None
+        self.output = ""
+        self.error = ""
+        self.cancel_requested = False
+        self._finished = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.state in RUN_FINISHED_STATES
+
+    def finish(self, state, exit_code=None):
+        self.state = state
+        self.exit_code = exit_code
+        update_run(self.run_id, state=state)
+        self._finished.set()
+        logger.info(f"Run {self.run_id} ({self.backend}: {self.job_name}) finished: {state}")
+
+    def finish_with_exit_code(self, exit_code):
+        """Finish a run that has ended with exit_code (None if it ended without writing its manifest)."""
+        if self.cancel_requested:
+            self.finish(RUN_CANCELLED, exit_code)
+        elif exit_code == 0:
+            self.finish(RUN_COMPLETED, exit_code)
+        else:
+            self.finish(RUN_FAILED, exit_code)
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+
+class ExecutionBackend:
+    """Where a command runs: on this workstation, on the server over SSH, or as a SLURM job.
+
+    The command runs in a new run directory next to its input files (referred to by base name) and
+    every backend records the files it produces in the run manifest. submit returns a RunHandle at
+    once; status, wait and cancel follow the run and fetch_outputs brings back the produced files.
+    """
+
+    name = None
+    # Files fetched on top of the manifest (the SLURM logs)
+    extra_output_files = []
+    # Arguments of the constructor, saved with every run to follow it from another session
+    options = {}
+
+    def submit(self, command, input_files=(), job_name="torepo_job", resources=None, accounting=None,
+               output_callback=None, priority=RUN_PRIORITY_NORMAL):
+        """Start command in a new run directory holding input_files and return its RunHandle.
+
+        resources ({"cpus_per_task", "mem", "time_limit"}) and accounting ({"program", "atom_count",
+        "task_parameters"}, see record_slurm_accounting) are only used by SLURM; priority orders the
+        runs waiting for a core of the local pool.
+        """
+        raise NotImplementedError
+
+    def attach(self, run_id, run_directory, job_name, job_id=None, accounting=None, output_callback=None,
+               task_count=None):
+        """RunHandle following a run submitted by another session (or another Streamlit process)."""
+        raise NotImplementedError
+
+    def _record(self, handle, command, input_files, accounting=None):
+        """Save the run in the job store, with what attach needs to follow it again, and let the
+        background job that submitted it cancel it."""
+        on_cancel(lambda: self.cancel(handle))
+        record_run(handle.run_id, self.name, handle.run_directory, handle.job_id, REATTACH_FUNCTION,
+                   {"backend": self.name, "options": self.options, "run_id": handle.run_id,
+                    "run_directory": handle.run_directory, "job_name": handle.job_name, "job_id": handle.job_id,
+                    "accounting": accounting, "task_count": handle.task_count},
+                   {"command": command, "input_files": [path for path in input_files if path]})
+
+    def status(self, handle):
+        return handle.state
+
+    def wait(self, handle, timeout=None):
+        """Block until the run has finished (or timeout seconds) and return its state."""
+        handle.wait(timeout)
+        return handle.state
+
+    def cancel(self, handle):
+        raise NotImplementedError
+
+    def fetch_outputs(self, handle, output_folder, progress_callback=None, file_patterns=None):
+        """Copy the files listed in the run manifest into output_folder (with file_patterns, only the ones
+        matching one of these fnmatch patterns: the others stay in the run directory). Returns their names."""
+        raise NotImplementedError
+
+    def remove_run_directory(self, handle):
+        raise NotImplementedError
+
+    def run(self, command, input_files=(), output_folder=None, progress_callback=None, output_callback=None,
+            **submit_options):
+        """submit, wait and fetch_outputs: the (output, error, output_folder) tuple of the runners.
+
+        The outputs of a cancelled run are not fetched: its run directory is removed and the output
+        folder is None.
+        """
+        handle = self.submit(command, input_files, output_callback=output_callback, **submit_options)
+        self.wait(handle)
+        return self.collect(handle, output_folder, progress_callback)
+
+    def collect(self, handle, output_folder=None, progress_callback=None, file_patterns=None):
+        """fetch_outputs of a finished run, or remove its run directory if it was cancelled."""
+        if handle.state == RUN_CANCELLED:
+            self.remove_run_directory(handle)
+            return handle.output, handle.error + "\nRun cancelled", None
+        output_folder = output_folder or tempfile.mkdtemp()
+        self.fetch_outputs(handle, output_folder, progress_callback=progress_callback, file_patterns=file_patterns)
+        update_run(handle.run_id, output_folder=output_folder)
+        return handle.output, handle.error, output_folder
+
+
+def _select_files(file_names, file_patterns=None):
+    if file_patterns is None:
+        return file_names
+    return [name for name in file_names if any(fnmatch.fnmatch(name, pattern) for pattern in file_patterns)]
+
+
+def _activate_command(path_virtualenv):
+    return f"source {path_virtualenv} && " if path_virtualenv else ""
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _kill_process_group(pid, grace_period=KILL_GRACE_PERIOD):
+    """SIGTERM to a process group, then SIGKILL to whatever is left of it after grace_period seconds."""
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+
+    def kill():
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(grace_period, kill)
+    timer.daemon = True
+    timer.start()
+
+
+#   ============================    Local process pool   ============================    #
+
+
+class LocalPoolBackend(ExecutionBackend):
+    """Runs commands on this workstation, at most max_workers at a time (one per core by default).
+
+    The runs waiting for a free worker are started by priority, then in submission order.
+    """
+
+    name = BACKEND_LOCAL
+
+    def __init__(self, working_directory=LOCAL_WORKING_DIRECTORY, path_virtualenv=None,
+                 max_workers=LOCAL_POOL_WORKERS):
+        self.options = {"working_directory": working_directory, "path_virtualenv": path_virtualenv}
+        self._working_directory = working_directory
+        self._path_virtualenv = path_virtualenv
+        self._queue = queue.PriorityQueue()
+        # (priority, sequence) of the runs still waiting for a worker, by run ID
+        self._queued = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._worker, daemon=True, name=f"torepo-local-{number}")
+                         for number in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _remove_old_run_directories(self):
+        runs_directory = os.path.join(self._working_directory, REMOTE_RUNS_DIRNAME)
+        oldest = time.time() - RUN_DIRECTORY_MAX_AGE_DAYS * 86400
+        for name in os.listdir(runs_directory):
+            path = os.path.join(runs_directory, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < oldest:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def submit(self, command, input_files=(), job_name="torepo_job", resources=None, accounting=None,
+               output_callback=None, priority=RUN_PRIORITY_NORMAL):
+        run_id = new_run_id()
+        run_directory = get_run_directory(self._working_directory, run_id)
+        os.makedirs(run_directory)
+        self._remove_old_run_directories()
+
+        # Inputs are linked, not copied: trajectories can be large
+        for path in input_files:
+            if not path:
+                continue
+            link_path = os.path.join(run_directory, os.path.basename(path))
+            try:
+                os.symlink(os.path.abspath(path), link_path)
+            except OSError:
+                shutil.copy2(path, link_path)
+
+        handle = RunHandle(self, run_id, run_directory, job_name)
+        self._record(handle, command, input_files)
+        with self._lock:
+            order = (priority, next(self._sequence))
+            self._queued[run_id] = order
+            self._queue.put(order + (handle, command, output_callback))
+        return handle
+
+    def queue_position(self, handle):
+        """How many runs will start before this one (None once it has started)."""
+        with self._lock:
+            order = self._queued.get(handle.run_id)
+            if order is None:
+                return None
+            return sum(1 for other in self._queued.values() if other < order)
+
+    def _worker(self):
+        while True:
+            priority, sequence, handle, command, output_callback = self._queue.get()
+            if handle is None:
+                # Sentinel of shutdown
+                return
+            try:
+                self._run(handle, command, output_callback)
+            except Exception as e:
+                logger.error(f"ERROR!!! Local run {handle.run_id} failed to start: {e}")
+                if not handle.is_finished:
+                    handle.error += f"\nERROR!!! {e}"
+                    handle.finish(RUN_FAILED)
+
+    def _run(self, handle, command, output_callback):
+        wrapped_command = wrap_command_with_manifest(f"{_activate_command(self._path_virtualenv)}"
+                                                     f"cd {shlex.quote(handle.run_directory)} && {command}",
+                                                     handle.run_directory, handle.run_directory)
+        with self._lock:
+            if self._queued.pop(handle.run_id, None) is None:
+                # Cancelled while waiting
+                return
+            # A new session writing to files: the run outlives a restart of Streamlit and cancel can
+            # kill its whole process group
+            with open(os.path.join(handle.run_directory, STDOUT_FILENAME), "w") as output_file, \
+                    open(os.path.join(handle.run_directory, STDERR_FILENAME), "w") as error_file:
+                process = subprocess.Popen(["bash", "-c", wrapped_command], cwd=handle.run_directory,
+                                           stdin=subprocess.DEVNULL, stdout=output_file, stderr=error_file,
+                                           start_new_session=True)
+            with open(os.path.join(handle.run_directory, PID_FILENAME), "w") as pid_file:
+                pid_file.write(str(process.pid))
+            handle.state = RUN_RUNNING
+        self._follow(handle, lambda: process.poll() is None, output_callback)
+        handle.finish_with_exit_code(process.wait())
+
+    def _follow(self, handle, is_running, output_callback):
+        try:
+            handle.output, handle.error = read_files_streaming(
+                os.path.join(handle.run_directory, STDOUT_FILENAME),
+                os.path.join(handle.run_directory, STDERR_FILENAME), is_running, output_callback)
+        except Exception as e:
+            handle.error += f"\nERROR!!! {e}"
+
+    def _read_pid(self, handle):
+        try:
+            with open(os.path.join(handle.run_directory, PID_FILENAME), "r") as pid_file:
+                return int(pid_file.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _read_manifest(self, handle):
+        try:
+            with open(os.path.join(handle.run_directory, MANIFEST_FILENAME), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logger.error(f"ERROR!!! Could not read the output manifest of {handle.run_directory}: {e}")
+            return None
+
+    def attach(self, run_id, run_directory, job_name, job_id=None, accounting=None, output_callback=None,
+               task_count=None):
+        handle = RunHandle(self, run_id, run_directory, job_name)
+        handle.state = RUN_RUNNING
+        pid = self._read_pid(handle)
+
+        def follow():
+            self._follow(handle, lambda: pid is not None and _process_alive(pid), output_callback)
+            manifest = self._read_manifest(handle)
+            handle.finish_with_exit_code(manifest["exit_status"] if manifest else None)
+
+        threading.Thread(target=follow, daemon=True, name=f"torepo-local-{run_id}").start()
+        return handle
+
+    def cancel(self, handle):
+        with self._lock:
+            handle.cancel_requested = True
+            queued = self._queued.pop(handle.run_id, None) is not None
+        if queued:
+            handle.finish(RUN_CANCELLED)
+            return
+        pid = self._read_pid(handle)
+        if pid is not None:
+            _kill_process_group(pid)
+
+    def remove_run_directory(self, handle):
+        shutil.rmtree(handle.run_directory, ignore_errors=True)
+
+    def fetch_outputs(self, handle, output_folder, progress_callback=None, file_patterns=None):
+        file_names = _select_files(manifest_file_names(self._read_manifest(handle)), file_patterns)
+        os.makedirs(output_folder, exist_ok=True)
+        for number, name in enumerate(file_names, start=1):
+            shutil.copy2(os.path.join(handle.run_directory, name), os.path.join(output_folder, name))
+            if progress_callback:
+                progress_callback(number, len(file_names), name)
+        return file_names
+
+    def shutdown(self, wait=True):
+        """Stop the workers: the runs still waiting are cancelled, the running ones are left to finish
+        (and waited for, with wait)."""
+        cancelled = []
+        with self._lock:
+            while True:
+                try:
+                    priority, sequence, handle, command, output_callback = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if self._queued.pop(handle.run_id, None) is not None:
+                    cancelled.append(handle)
+            # One sentinel per worker, ahead of anything submitted from now on
+            for worker in self._workers:
+                self._queue.put((-math.inf, next(self._sequence), None, None, None))
+        for handle in cancelled:
+            handle.finish(RUN_CANCELLED)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+#   ============================    Direct SSH   ============================    #
+
+
+class SSHDirectBackend(ExecutionBackend):
+    """Runs commands on the server straight over the pooled SSH connection."""
+
+    name = BACKEND_SSH
+
+    def __init__(self, name_server, name_user, ssh_key_options, path_virtualenv, working_directory):
+        self.options = {"name_server": name_server, "name_user": name_user, "ssh_key_options": ssh_key_options,
+                        "path_virtualenv": path_virtualenv, "working_directory": working_directory}
+        self._server = (name_server, name_user, ssh_key_options)
+        self._path_virtualenv = path_virtualenv
+        self._working_directory = working_directory
+
+    def _stage(self, handle, input_files, extra_pairs=()):
+        """Create the run directory and upload the inputs (through the cache) and extra_pairs (always)."""
+        ssh = get_ssh_client(*self._server)
+        prepare_run_directory(ssh, self._working_directory, handle.run_directory)
+        sftp = open_sftp_session(ssh)
+        try:
+            if extra_pairs:
+                upload_files(sftp, list(extra_pairs))
+            upload_files_cached(ssh, sftp, [(path, f"{handle.run_directory}/{os.path.basename(path)}")
+                                            for path in input_files if path],
+                                self._working_directory)
+        finally:
+            sftp.close()
+        return ssh
+
+    def submit(self, command, input_files=(), job_name="torepo_job", resources=None, accounting=None,
+               output_callback=None, priority=RUN_PRIORITY_NORMAL):
+        run_id = new_run_id()
+        handle = RunHandle(self, run_id, get_run_directory(self._working_directory, run_id), job_name)
+        ssh = self._stage(handle, input_files)
+
+        run_directory = shlex.quote(handle.run_directory)
+        wrapped_command = wrap_command_with_manifest(f"{_activate_command(self._path_virtualenv)}"
+                                                     f"cd {run_directory} && {command}",
+                                                     handle.run_directory, handle.run_directory)
+        # Started in its own session, detached from the SSH one: the run survives a lost connection or
+        # a restart of Streamlit, and its PID is also the process group to kill on cancel
+        stdin, stdout, stderr = ssh.exec_command(
+            f"cd {run_directory} && {{ setsid nohup bash -c {shlex.quote(wrapped_command)} > {STDOUT_FILENAME} "
+            f"2> {STDERR_FILENAME} < /dev/null & echo $! > {PID_FILENAME}; }}")
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"ERROR!!! Error starting the run: {stderr.read().decode()}")
+        handle.state = RUN_RUNNING
+        self._record(handle, command, input_files)
+        self._start_following(handle, output_callback)
+        return handle
+
+    def attach(self, run_id, run_directory, job_name, job_id=None, accounting=None, output_callback=None,
+               task_count=None):
+        handle = RunHandle(self, run_id, run_directory, job_name)
+        handle.state = RUN_RUNNING
+        self._start_following(handle, output_callback)
+        return handle
+
+    def _start_following(self, handle, output_callback):
+        threading.Thread(target=self._follow, args=(handle, output_callback),
+                         daemon=True, name=f"torepo-ssh-{handle.run_id}").start()
+
+    def _follow(self, handle, output_callback):
+        """Stream the output files of the run until it ends, then finish it with the status of its manifest."""
+        run_directory = shlex.quote(handle.run_directory)
+        # tail stops by itself once the run has ended, after printing what is left
+        tail_options = f"-s {FOLLOW_INTERVAL} -n +1 --pid=$pid -f"
+        follow_command = (f"cd {run_directory} || exit 1; pid=$(cat {PID_FILENAME}); "
+                          f"tail {tail_options} {STDOUT_FILENAME} & tail {tail_options} {STDERR_FILENAME} >&2 & wait")
+        for attempt in range(FOLLOW_ATTEMPTS):
+            try:
+                ssh = get_ssh_client(*self._server)
+                stdin, stdout, stderr = ssh.exec_command(follow_command)
+                # Every attempt prints the files from the start
+                handle.output, handle.error = read_channel_streaming(
+                    stdout.channel, output_callback if not attempt else None)
+                manifest_output, _ = exec_remote_command(*self._server,
+                                                         f"cat {run_directory}/{MANIFEST_FILENAME} 2>/dev/null")
+                break
+            except Exception as e:
+                logger.error(f"ERROR!!! Lost the connection to run {handle.run_id}: {e}")
+                if attempt == FOLLOW_ATTEMPTS - 1:
+                    handle.error += f"\nERROR!!! Lost the connection to the run: {e}"
+                    handle.finish(RUN_FAILED)
+                    return
+                time.sleep(FOLLOW_INTERVAL * 2 ** attempt)
+        try:
+            manifest = json.loads(manifest_output)
+        except ValueError:
+            manifest = None
+        handle.finish_with_exit_code(manifest["exit_status"] if manifest else None)
+
+    def cancel(self, handle):
+        handle.cancel_requested = True
+        pid_file = shlex.quote(f"{handle.run_directory}/{PID_FILENAME}")
+        # The SIGKILL of whatever ignored SIGTERM is left running on the server, not in this call
+        exec_remote_command(*self._server, f"pid=$(cat {pid_file}) && {{ kill -TERM -- -$pid; "
+                                           f"(sleep {KILL_GRACE_PERIOD}; kill -KILL -- -$pid) "
+                                           f"> /dev/null 2>&1 & }}")
+
+    def remove_run_directory(self, handle):
+        exec_remote_command(*self._server, f"rm -rf {shlex.quote(handle.run_directory)}")
+
+    def fetch_outputs(self, handle, output_folder, progress_callback=None, file_patterns=None):
+        ssh = get_ssh_client(*self._server)
+        sftp = open_sftp_session(ssh)
+        try:
+            manifest = read_remote_manifest(sftp, handle.run_directory)
+        finally:
+            sftp.close()
+        file_names = _select_files(manifest_file_names(manifest) + self.extra_output_files, file_patterns)
+        os.makedirs(output_folder, exist_ok=True)
+        fetch_output_files(ssh, handle.run_directory, file_names, output_folder,
+                           progress_callback=progress_callback)
+        verify_downloaded_files(manifest, output_folder)
+        return file_names
+
+
+#   ============================    SLURM   ============================    #
+
+
+def build_sbatch_script(job_name, run_directory, commands, path_virtualenv, partition=None,
+                        script_before_run="", script_after_run="", resources=None, atom_count=None,
+                        array_size=None, dependency=None):
+    """sbatch script running commands in run_directory, writing its manifest and keeping their exit status.
+
+    With array_size it is a job array: task i runs the commands in task_<i>/ (the inputs are in ..,
+    the task number in $SLURM_ARRAY_TASK_ID) and writes its own manifest there. With dependency (a job
+    ID) the job only starts once that job has completed successfully, and is cancelled if it fails.
+    """
+    resources = resources or {}
+    log_files = SLURM_ARRAY_LOG_FILES if array_size else SLURM_LOG_FILES
+
+    script_content = "#!/bin/bash\n"
+    script_content += f"#SBATCH --job-name={job_name}\n"
+    script_content += f"#SBATCH --chdir={run_directory}\n"
+    script_content += f"#SBATCH --output={log_files[0]}\n"
+    script_content += f"#SBATCH --error={log_files[1]}\n"
+    if array_size:
+        script_content += f"#SBATCH --array=0-{array_size - 1}\n"
+    if dependency:
+        script_content += f"#SBATCH --dependency=afterok:{dependency}\n"
+        script_content += "#SBATCH --kill-on-invalid-dep=yes\n"
+    if partition:
+        script_content += f"#SBATCH --partition={partition}\n"
+    # Requested resources, plus the atom count that lets sacct calibrate future requests
+    script_content += sbatch_resource_lines(resources.get("cpus_per_task"), resources.get("mem"),
+                                            resources.get("time_limit"), atom_count)
+    if script_before_run:
+        script_content += script_before_run + "\n"
+    script_content += f"source {path_virtualenv}\n"
+    script_content += f"cd {shlex.quote(run_directory)}\n"
+    if array_size:
+        task_directory = f"{TASK_DIRECTORY_PREFIX}${{SLURM_ARRAY_TASK_ID}}"
+        script_content += f"mkdir -p {task_directory} && cd {task_directory}\n"
+    script_content += start_marker_command(".") + "\n"
+    script_content += "{\n" + "\n".join(commands) + "\n}\n"
+    script_content += "run_status=$?\n"
+    script_content += manifest_command(".", ".", "$run_status") + "\n"
+    if script_after_run:
+        script_content += script_after_run + "\n"
+    script_content += "exit $run_status\n"
+    return script_content
+
+
+class SlurmBackend(SSHDirectBackend):
+    """Runs commands as SLURM jobs on the server, followed by the shared SlurmPoller."""
+
+    name = BACKEND_SLURM
+    extra_output_files = SLURM_LOG_FILES
+
+    def __init__(self, name_server, name_user, ssh_key_options, path_virtualenv, working_directory,
+                 partition=None, script_before_run="", script_after_run="",
+                 cpus_per_task=None, mem=None, time_limit=None):
+        super().__init__(name_server, name_user, ssh_key_options, path_virtualenv, working_directory)
+        self.options = dict(self.options, partition=partition, script_before_run=script_before_run,
+                            script_after_run=script_after_run, cpus_per_task=cpus_per_task, mem=mem,
+                            time_limit=time_limit)
+        self._partition = partition
+        self._script_before_run = script_before_run
+        self._script_after_run = script_after_run
+        self._resources = {"cpus_per_task": cpus_per_task, "mem": mem, "time_limit": time_limit}
+
+    def submit(self, command, input_files=(), job_name="torepo_job", resources=None, accounting=None,
+               output_callback=None, priority=RUN_PRIORITY_NORMAL, task_count=None, dependency=None):
+        """See ExecutionBackend.submit. With task_count, command runs as a job array of that many tasks
+        (see build_sbatch_script) and task_parameters of accounting is keyed by task number. With
+        dependency (the job_id of another handle) the job waits for that one to complete successfully."""
+        run_id = new_run_id()
+        handle = RunHandle(self, run_id, get_run_directory(self._working_directory, run_id), job_name)
+        handle.task_count = task_count
+        accounting = accounting or {}
+
+        # Resources given for this run override the ones of the backend
+        job_resources = dict(self._resources)
+        job_resources.update({key: value for key, value in (resources or {}).items() if value})
+        # The atoms the job works on (in its largest task: every task gets the same request)
+        image_multiplier = max([multiplier for multiplier, parameters
+                                in (accounting.get("task_parameters") or {}).values()] or [1])
+        atom_count = accounting["atom_count"] * image_multiplier if accounting.get("atom_count") else None
+        temp_dir = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(temp_dir, SLURM_SCRIPT_NAME)
+            with open(script_path, "w") as script_file:
+                script_file.write(build_sbatch_script(job_name, handle.run_directory, [command],
+                                                      self._path_virtualenv, self._partition,
+                                                      self._script_before_run, self._script_after_run,
+                                                      job_resources, atom_count, task_count, dependency))
+            ssh = self._stage(handle, input_files,
+                              [(script_path, f"{handle.run_directory}/{SLURM_SCRIPT_NAME}")])
+        finally:
+            shutil.rmtree(temp_dir)
+
+        stdin, stdout, stderr = ssh.exec_command(f"cd {shlex.quote(handle.run_directory)} && "
+                                                 f"sbatch --parsable {SLURM_SCRIPT_NAME}")
+        job_submission_output = stdout.read().decode()
+        job_submission_error = stderr.read().decode()
+        if stdout.channel.recv_exit_status() != 0 or not job_submission_output.strip():
+            raise RuntimeError(f"ERROR!!! Error submitting job: {job_submission_error}")
+        handle.job_id = job_submission_output.strip().split(";")[0]
+        if output_callback:
+            tasks = f" ({task_count} array tasks)" if task_count else ""
+            output_callback([("stdout", f"Submitted SLURM job {handle.job_id}{tasks}")])
+        self._record(handle, command, input_files, accounting)
+        self._watch(handle, accounting)
+        return handle
+
+    def _watch(self, handle, accounting):
+        """Follow the job with the shared poller: PENDING until squeue shows it running, then RUNNING."""
+        def started():
+            if not handle.is_finished:
+                handle.state = RUN_RUNNING
+
+        get_slurm_poller(*self._server).watch(
+            handle.job_id, callback=lambda status: self._job_finished(handle, status, accounting),
+            started_callback=started)
+
+    def attach(self, run_id, run_directory, job_name, job_id=None, accounting=None, output_callback=None,
+               task_count=None):
+        handle = RunHandle(self, run_id, run_directory, job_name)
+        handle.job_id = job_id
+        handle.task_count = task_count
+        accounting = dict(accounting or {})
+        # JSON turned the task numbers into strings
+        if accounting.get("task_parameters"):
+            accounting["task_parameters"] = {int(task_number): tuple(parameters) for task_number, parameters
+                                             in accounting["task_parameters"].items()}
+        # The poller also answers for jobs that left the queue while nobody was watching
+        self._watch(handle, accounting)
+        return handle
+
+    def _task_directories(self, handle):
+        """Directories of the run holding a manifest: the run directory, or one per task of a job array."""
+        if handle.task_count is None:
+            return [handle.run_directory]
+        return [f"{handle.run_directory}/{TASK_DIRECTORY_PREFIX}{number}" for number in range(handle.task_count)]
+
+    def _read_exit_status(self, handle):
+        """Exit status in the manifests of the run (the first failure of a job array), None if one is missing."""
+        exit_status = 0
+        for directory in self._task_directories(handle):
+            try:
+                output, _ = exec_remote_command(*self._server,
+                                                f"cat {shlex.quote(directory)}/{MANIFEST_FILENAME} 2>/dev/null")
+                manifest = json.loads(output)
+            except Exception as e:
+                logger.error(f"ERROR!!! Could not read the output manifest of {directory}: {e}")
+                return None
+            exit_status = exit_status or manifest["exit_status"]
+        return exit_status
+
+    def _job_finished(self, handle, status, accounting):
+        logger.info(f"SLURM job {handle.job_id} finished with state {status['state']}")
+        if accounting.get("program") and status["state"] not in ("CANCELLED", "UNKNOWN"):
+            record_slurm_accounting(*self._server, handle.job_id, accounting["program"],
+                                    accounting.get("atom_count"), accounting.get("task_parameters"))
+        if status["state"] == "UNKNOWN":
+            # sacct lags behind or is not available (no slurmdbd): the script recorded its own exit status
+            handle.finish_with_exit_code(self._read_exit_status(handle))
+        elif status["state"] == "COMPLETED":
+            handle.finish(RUN_COMPLETED, status["exit_code"])
+        elif status["state"] == "CANCELLED" or handle.cancel_requested:
+            handle.finish(RUN_CANCELLED, status["exit_code"])
+        else:
+            handle.finish(RUN_FAILED, status["exit_code"])
+
+    def cancel(self, handle):
+        handle.cancel_requested = True
+        if handle.job_id:
+            cancel_slurm_jobs(*self._server, [handle.job_id])
+
+    def fetch_outputs(self, handle, output_folder, progress_callback=None, file_patterns=None):
+        if handle.task_count is not None:
+            return self._fetch_array_outputs(handle, output_folder, progress_callback, file_patterns)
+        file_names = super().fetch_outputs(handle, output_folder, progress_callback, file_patterns)
+        # What the job printed is in the SLURM logs
+        for attribute, log_file in zip(("output", "error"), SLURM_LOG_FILES):
+            log_path = os.path.join(output_folder, log_file)
+            if os.path.exists(log_path):
+                with open(log_path, "r", errors="replace") as f:
+                    setattr(handle, attribute, f.read())
+        return file_names
+
+    def _fetch_array_outputs(self, handle, output_folder, progress_callback=None, file_patterns=None):
+        """Outputs of every task of a job array in bulk, keeping the task_<i>/ layout, and the task logs."""
+        ssh = get_ssh_client(*self._server)
+        sftp = open_sftp_session(ssh)
+        try:
+            manifests = [read_remote_manifest(sftp, directory) for directory in self._task_directories(handle)]
+        finally:
+            sftp.close()
+        file_names = []
+        for number, manifest in enumerate(manifests):
+            task_directory = f"{TASK_DIRECTORY_PREFIX}{number}"
+            os.makedirs(os.path.join(output_folder, task_directory), exist_ok=True)
+            file_names += [f"{task_directory}/{name}" for name in _select_files(manifest_file_names(manifest),
+                                                                               file_patterns)]
+            file_names += [log_file.replace("%a", str(number)) for log_file in SLURM_ARRAY_LOG_FILES]
+        fetch_output_files(ssh, handle.run_directory, file_names, output_folder,
+                           progress_callback=progress_callback)
+
+        failed_tasks = []
+        for number, manifest in enumerate(manifests):
+            task_directory = f"{TASK_DIRECTORY_PREFIX}{number}"
+            verify_downloaded_files(manifest, os.path.join(output_folder, task_directory))
+            if manifest is None or manifest["exit_status"] != 0:
+                failed_tasks.append(task_directory)
+        handle.output = (f"Array job {handle.job_id}: {handle.task_count - len(failed_tasks)} of "
+                         f"{handle.task_count} tasks finished successfully ({handle.state})")
+        handle.error = f"Failed tasks: {', '.join(failed_tasks)}" if failed_tasks else ""
+        return file_names
+
+
+# Process pools of this workstation, one per (working_directory, path_virtualenv)
+_local_backends = {}
+_local_backend_lock = threading.Lock()
+
+
+def get_local_backend(working_directory=LOCAL_WORKING_DIRECTORY, path_virtualenv=None):
+    """The process pool of this workstation with these options, shared by every page."""
+    key = (working_directory, path_virtualenv)
+    with _local_backend_lock:
+        if key not in _local_backends:
+            _local_backends[key] = LocalPoolBackend(working_directory, path_virtualenv)
+        return _local_backends[key]
+
+
+def create_backend(name, options):
+    """The backend a saved run was submitted to, from its name and options."""
+    if name == BACKEND_LOCAL:
+        return get_local_backend(**options)
+    if name == BACKEND_SLURM:
+        return SlurmBackend(**options)
+    return SSHDirectBackend(**options)
+
+
+def reattach_run(backend, options, run_id, run_directory, job_name, job_id=None, accounting=None,
+                 task_count=None, progress_callback=None, output_callback=None):
+    """Follow a saved run to its end and fetch its outputs, as ExecutionBackend.run would have."""
+    execution_backend = create_backend(backend, options)
+    handle = execution_backend.attach(run_id, run_directory, job_name, job_id, accounting, output_callback,
+                                      task_count)
+    on_cancel(lambda: execution_backend.cancel(handle))
+    execution_backend.wait(handle)
+    return execution_backend.collect(handle, progress_callback=progress_callback)
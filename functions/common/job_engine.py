@@ -0,0 +1,223 @@
+import time
+import uuid
+import atexit
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functions.common.output_stream import OutputRingBuffer
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Remote runs executed at the same time, the rest wait in the queue
+JOB_WORKERS = 4
+# Seconds between two checks of the wall-clock limits of the running jobs
+WATCHDOG_INTERVAL = 1.0
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Job run by each worker thread, so that what it submits can be saved with it (see job_store)
+_current = threading.local()
+
+
+class Job:
+    """Handle of a run submitted to the JobEngine. Its state is updated by the worker thread."""
+
+    def __init__(self, kind, name):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.name = name
+        self.status = JOB_QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.output = OutputRingBuffer()
+        # Key of the run in the job store, once it has been submitted
+        self.run_id = None
+        # Wall-clock limit in seconds (None for no limit), enforced by the watchdog of the engine
+        self.max_runtime = None
+        self.timed_out = False
+        self.cancel_requested = False
+        self._cancel_callbacks = []
+        self._future = None
+        self._cleanup = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_active(self):
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    def on_cancel(self, callback):
+        """Call callback() when the job is cancelled (at once if it already is): it stops what the job started."""
+        with self._lock:
+            if not self.cancel_requested:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """Stop the job: drop it if still queued, otherwise call its cancel callbacks."""
+        with self._lock:
+            if self.cancel_requested or not self.is_active:
+                return
+            self.cancel_requested = True
+            callbacks = list(self._cancel_callbacks)
+        if self._future is not None and self._future.cancel():
+            # It never started: nothing to stop, only its temporary files to remove
+            self.status = JOB_CANCELLED
+            self.finished = time.time()
+            if self._cleanup:
+                self._cleanup()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"ERROR!!! Could not cancel a run of job {self.job_id}: {e}")
+        logger.info(f"Job {self.job_id} ({self.kind}: {self.name}) cancelled")
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    # The two callbacks handed to the runner: they only record state, the GUI renders it when it polls
+    def add_output(self, lines):
+        with self._lock:
+            self.output.extend(line for stream, line in lines)
+
+    def set_progress(self, done, total, file_name):
+        self.progress = (done, total, file_name)
+
+    def output_text(self):
+        with self._lock:
+            return self.output.text()
+
+
+class JobEngine:
+    """Runs remote jobs on a bounded pool of worker threads so the Streamlit script never waits for them."""
+
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="torepo-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        threading.Thread(target=self._watchdog, daemon=True, name="torepo-job-watchdog").start()
+
+    def submit(self, kind, name, func, *args, cleanup=None, max_runtime=None, **kwargs):
+        """Queue func(*args, **kwargs, progress_callback=..., output_callback=...) and return its Job.
+
+        func must return the (output, error, output_folder) tuple of the remote runners. cleanup, if
+        given, is called once the job has finished, whatever its outcome. A job still running
+        max_runtime seconds after it started is cancelled.
+        """
+        job = Job(kind, name)
+        job.max_runtime = max_runtime
+        job._cleanup = cleanup
+        with self._lock:
+            self._jobs[job.job_id] = job
+        job._future = self._executor.submit(self._run, job, func, args, kwargs)
+        logger.info(f"Job {job.job_id} ({kind}: {name}) queued")
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        job.status = JOB_RUNNING
+        job.started = time.time()
+        _current.job = job
+        try:
+            job.result = func(*args, progress_callback=job.set_progress, output_callback=job.add_output, **kwargs)
+            job.status = JOB_CANCELLED if job.cancel_requested else JOB_DONE
+        except Exception as e:
+            job.error = f"{e}\n{traceback.format_exc()}"
+            job.status = JOB_CANCELLED if job.cancel_requested else JOB_FAILED
+            logger.error(f"ERROR!!! Job {job.job_id} ({job.kind}: {job.name}) failed: {e}")
+        finally:
+            _current.job = None
+            job.finished = time.time()
+            if job._cleanup:
+                job._cleanup()
+        logger.info(f"Job {job.job_id} finished with status {job.status} in {job.elapsed:.1f} s")
+
+    def _watchdog(self):
+        """Cancel the jobs that have been running for longer than their max_runtime."""
+        while not self._stopped.wait(WATCHDOG_INTERVAL):
+            for job in self.list_jobs():
+                if (job.status == JOB_RUNNING and not job.cancel_requested and job.max_runtime
+                        and job.elapsed > job.max_runtime):
+                    logger.info(f"Job {job.job_id} has run for more than {job.max_runtime} s, cancelling it")
+                    job.timed_out = True
+                    job.cancel()
+
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        if job is not None:
+            job.cancel()
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def poll(self, job_id):
+        """Status of a job, or None if the engine does not know it."""
+        job = self.get_job(job_id)
+        return job.status if job else None
+
+    def find_run(self, run_id):
+        """The job following a run of the job store, or None."""
+        with self._lock:
+            return next((job for job in self._jobs.values() if job.run_id == run_id), None)
+
+    def list_jobs(self, kind=None):
+        """Jobs of one kind (all of them if kind is None), newest first."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted((job for job in jobs if kind is None or job.kind == kind),
+                      key=lambda job: job.submitted, reverse=True)
+
+    def forget(self, job_id):
+        """Drop a finished job from the list."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and not job.is_active:
+                del self._jobs[job_id]
+
+    def shutdown(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# One engine per Streamlit server process: it outlives script reruns and browser refreshes
+_job_engine = JobEngine()
+atexit.register(_job_engine.shutdown)
+
+
+def get_job_engine():
+    return _job_engine
+
+
+def current_job():
+    """The Job run by the calling worker thread, None outside the engine."""
+    return getattr(_current, "job", None)
+
+
+def on_cancel(callback):
+    """Call callback() if the job run by the calling worker thread is cancelled (no-op outside the engine)."""
+    job = current_job()
+    if job is not None:
+        job.on_cancel(callback)
+
+
+def cancel_requested():
+    """Whether the job run by the calling worker thread has been cancelled."""
+    job = current_job()
+    return job is not None and job.cancel_requested
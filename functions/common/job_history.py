@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from functions.common.ssh_pool import exec_remote_command
+from functions.common.slurm_resources import (parse_slurm_duration, parse_slurm_memory, fetch_sacct_samples,
+                                              MIN_CALIBRATION_SAMPLES)
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Local SQLite file with the accounting of every SLURM job run from the GUI
+HISTORY_DB_PATH = os.path.join(os.path.expanduser("~"), ".torepo", "job_history.sqlite")
+SACCT_FIELDS = "JobID,State,ExitCode,Elapsed,MaxRSS,TotalCPU,AllocCPUS,ReqMem"
+
+_db_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slurm_jobs (
+    server TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    program TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    state TEXT,
+    exit_code TEXT,
+    elapsed_s REAL,
+    max_rss_mb REAL,
+    total_cpu_s REAL,
+    alloc_cpus INTEGER,
+    cpu_efficiency REAL,
+    req_mem TEXT,
+    atom_count INTEGER,
+    image_multiplier INTEGER,
+    parameters TEXT,
+    PRIMARY KEY (server, job_id)
+)
+"""
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def parse_sacct_accounting(sacct_output):
+    """{job_id: accounting} from `sacct -n -P -o <SACCT_FIELDS>`, one entry per job or array task.
+
+    The steps of a job (<id>.batch, <id>.0, ...) are folded into it: they hold the MaxRSS.
+    """
+    jobs = {}
+    for line in sacct_output.splitlines():
+        fields = line.split("|")
+        if len(fields) < 8:
+            continue
+        job_id, state, exit_code, elapsed, max_rss, total_cpu, alloc_cpus, req_mem = fields[:8]
+        job = jobs.setdefault(job_id.split(".")[0], {"max_rss_mb": 0.0})
+        job["max_rss_mb"] = max(job["max_rss_mb"], parse_slurm_memory(max_rss) or 0.0)
+        if "." in job_id:
+            continue
+        job.update({"state": state.split()[0] if state else None, "exit_code": exit_code,
+                    "elapsed_s": parse_slurm_duration(elapsed), "total_cpu_s": parse_slurm_duration(total_cpu),
+                    "alloc_cpus": int(alloc_cpus) if alloc_cpus.isdigit() else None, "req_mem": req_mem})
+
+    for job in jobs.values():
+        if job.get("elapsed_s") and job.get("alloc_cpus") and job.get("total_cpu_s") is not None:
+            job["cpu_efficiency"] = job["total_cpu_s"] / (job["elapsed_s"] * job["alloc_cpus"])
+        else:
+            job["cpu_efficiency"] = None
+    return {job_id: job for job_id, job in jobs.items() if "state" in job}
+
+
+def collect_sacct_accounting(name_server, name_user, ssh_key_options, job_id):
+    """Accounting of a finished job (and of every task, for an array job) in one sacct call."""
+    output, error = exec_remote_command(name_server, name_user, ssh_key_options,
+                                        f"sacct -n -P -j {job_id} -o {SACCT_FIELDS}")
+    if error and not output:
+        logger.error(f"ERROR!!! sacct failed for job {job_id}: {error.strip()}")
+    return parse_sacct_accounting(output)
+
+
+def record_job(server, job_id, program, accounting, atom_count=None, image_multiplier=1, parameters=None,
+               db_path=HISTORY_DB_PATH):
+    """Store (or update) the accounting of one job with the parameters it was run with."""
+    with _db_lock:
+        connection = _connect(db_path)
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO slurm_jobs VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (server, job_id, program, time.time(), accounting.get("state"), accounting.get("exit_code"),
+                     accounting.get("elapsed_s"), accounting.get("max_rss_mb"), accounting.get("total_cpu_s"),
+                     accounting.get("alloc_cpus"), accounting.get("cpu_efficiency"), accounting.get("req_mem"),
+                     atom_count, image_multiplier, json.dumps(parameters or {})))
+        finally:
+            connection.close()
+
+
+def record_slurm_accounting(name_server, name_user, ssh_key_options, job_id, program, atom_count=None,
+                            task_parameters=None, db_path=HISTORY_DB_PATH):
+    """Fetch the sacct accounting of a finished job and add it to the local history.
+
+    task_parameters maps the array task number (0 for a plain job) to (image_multiplier, parameters).
+    Failures are only logged: the history must never break a run.
+    """
+    task_parameters = task_parameters or {0: (1, {})}
+    try:
+        accounting = collect_sacct_accounting(name_server, name_user, ssh_key_options, job_id)
+        for sacct_job_id, job_accounting in accounting.items():
+            task_number = int(sacct_job_id.split("_")[1]) if "_" in sacct_job_id else 0
+            image_multiplier, parameters = task_parameters.get(task_number, (1, {}))
+            record_job(name_server, sacct_job_id, program, job_accounting, atom_count, image_multiplier,
+                       parameters, db_path)
+        logger.info(f"Accounting of SLURM job {job_id} saved ({len(accounting)} entries)")
+    except Exception as e:
+        logger.error(f"ERROR!!! Could not save the accounting of SLURM job {job_id}: {e}")
+
+
+def load_history(program=None, db_path=HISTORY_DB_PATH):
+    """Rows of the local history (as dicts), oldest first."""
+    if not os.path.exists(db_path):
+        return []
+    with _db_lock:
+        connection = _connect(db_path)
+        try:
+            query = "SELECT * FROM slurm_jobs"
+            arguments = ()
+            if program:
+                query += " WHERE program = ?"
+                arguments = (program,)
+            rows = connection.execute(query + " ORDER BY recorded_at", arguments).fetchall()
+        finally:
+            connection.close()
+    return [dict(row) for row in rows]
+
+
+def history_samples(program, db_path=HISTORY_DB_PATH):
+    """(atoms, elapsed seconds, MaxRSS MB) of the completed runs of a program, for calibrate_model."""
+    return [(row["atom_count"] * row["image_multiplier"], row["elapsed_s"], row["max_rss_mb"])
+            for row in load_history(program, db_path)
+            if row["state"] == "COMPLETED" and row["atom_count"] and row["elapsed_s"] and row["max_rss_mb"]]
+
+
+def calibration_samples(program, name_server=None, name_user=None, ssh_key_options=None, db_path=HISTORY_DB_PATH):
+    """Samples to calibrate the resource model of a program: the local history, completed with the
+    sacct runs of the server it does not hold when there are not enough of them."""
+    samples = history_samples(program, db_path)
+    if len(samples) >= MIN_CALIBRATION_SAMPLES or not name_server:
+        return samples
+    # The jobs of the local history already counted, by the sacct ID of the job or array task
+    known_job_ids = {row["job_id"] for row in load_history(program, db_path) if row["server"] == name_server}
+    try:
+        samples += fetch_sacct_samples(name_server, name_user, ssh_key_options, program,
+                                       exclude_job_ids=known_job_ids)
+    except Exception as e:
+        logger.error(f"ERROR!!! Could not read the sacct history of {program}: {e}")
+    return samples
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import importlib
+import threading
+from functions.common.job_engine import get_job_engine, current_job
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Local SQLite file with every run submitted from a background job, so that another session (or
+# another Streamlit process) can follow it and fetch its outputs
+STORE_DB_PATH = os.path.join(os.path.expanduser("~"), ".torepo", "job_store.sqlite")
+FINISHED_STATES = ("COMPLETED", "FAILED", "CANCELLED")
+UPDATABLE_FIELDS = ("state", "finished", "output_folder", "owner_pid", "job_ids")
+
+_db_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    run_directory TEXT,
+    job_ids TEXT,
+    resume TEXT NOT NULL,
+    resume_arguments TEXT NOT NULL,
+    parameters TEXT,
+    state TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    finished REAL,
+    output_folder TEXT,
+    owner_pid INTEGER
+)
+"""
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def _execute(query, arguments=(), db_path=STORE_DB_PATH):
+    with _db_lock:
+        connection = _connect(db_path)
+        try:
+            with connection:
+                return [dict(row) for row in connection.execute(query, arguments).fetchall()]
+        finally:
+            connection.close()
+
+
+def record_run(run_id, backend, run_directory, job_ids, resume, resume_arguments, parameters=None,
+               db_path=STORE_DB_PATH):
+    """Save a run submitted by the current background job.
+
+    resume is the dotted path of the function that follows the run to its end from another session:
+    it is called with the JSON-serializable resume_arguments and returns (output, error, output_folder),
+    like the function of the original job. parameters describe the run for the user. Runs submitted
+    outside the JobEngine are not saved.
+    """
+    job = current_job()
+    if job is None:
+        return
+    job.run_id = run_id
+    try:
+        _execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (run_id, job.kind, job.name, backend, run_directory, job_ids, resume, json.dumps(resume_arguments),
+                  json.dumps(parameters or {}), "RUNNING", time.time(), None, None, os.getpid()), db_path)
+    except Exception as e:
+        logger.error(f"ERROR!!! Could not save run {run_id} in the job store: {e}")
+
+
+def update_run(run_id, db_path=STORE_DB_PATH, **fields):
+    """Change some fields of a saved run; runs that were not saved are ignored."""
+    fields = {field: value for field, value in fields.items() if field in UPDATABLE_FIELDS}
+    if "state" in fields and fields["state"] in FINISHED_STATES:
+        fields.setdefault("finished", time.time())
+    try:
+        _execute(f"UPDATE runs SET {', '.join(f'{field} = ?' for field in fields)} WHERE run_id = ?",
+                 tuple(fields.values()) + (run_id,), db_path)
+    except Exception as e:
+        logger.error(f"ERROR!!! Could not update run {run_id} in the job store: {e}")
+
+
+def load_runs(kind=None, db_path=STORE_DB_PATH):
+    """Saved runs (as dicts), newest first."""
+    if not os.path.exists(db_path):
+        return []
+    query = "SELECT * FROM runs"
+    arguments = ()
+    if kind:
+        query += " WHERE kind = ?"
+        arguments = (kind,)
+    return _execute(query + " ORDER BY submitted DESC", arguments, db_path)
+
+
+def forget_run(run_id, db_path=STORE_DB_PATH):
+    _execute("DELETE FROM runs WHERE run_id = ?", (run_id,), db_path)
+
+
+def _process_alive(pid):
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _resume_function(dotted_path):
+    module_name, _, function_name = dotted_path.rpartition(".")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def follow_run(run, db_path=STORE_DB_PATH):
+    """Queue a background job that follows a saved run (waits for it if needed) and fetches its outputs."""
+    update_run(run["run_id"], db_path, owner_pid=os.getpid())
+    job = get_job_engine().submit(run["kind"], run["name"], _resume_function(run["resume"]),
+                                  **json.loads(run["resume_arguments"]))
+    job.run_id = run["run_id"]
+    return job
+
+
+def reattach_runs(db_path=STORE_DB_PATH):
+    """Follow again the unfinished runs whose Streamlit process is gone. Returns how many there were.
+
+    Runs followed by a live process (this one included) are left alone, so calling this at the start
+    of every session is safe.
+    """
+    reattached = 0
+    for run in load_runs(db_path=db_path):
+        if run["state"] in FINISHED_STATES or _process_alive(run["owner_pid"]):
+            continue
+        try:
+            follow_run(run, db_path)
+            reattached += 1
+            logger.info(f"Reattached to run {run['run_id']} ({run['kind']}: {run['name']})")
+        except Exception as e:
+            logger.error(f"ERROR!!! Could not reattach to run {run['run_id']}: {e}")
+    return reattached
+
+
+def detached_runs(kind, db_path=STORE_DB_PATH):
+    """Saved runs of one kind that no job of this process follows (finished in an earlier session)."""
+    job_engine = get_job_engine()
+    return [run for run in load_runs(kind, db_path) if job_engine.find_run(run["run_id"]) is None]
@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import time
+import shlex
+import fcntl
+import signal
+import threading
+import argparse
+import subprocess
+from functions.common.slurm_resources import parse_slurm_duration, format_slurm_time
+
+
+# Stand-in for SLURM on one machine: sbatch, squeue, sacct and scancel with the options TOREPO uses.
+# Jobs run in a bounded pool of slots (one per core by default) and their state is kept on disk, so
+# every command can be a separate process, as when they are run over SSH.
+#
+#   python -m functions.common.local_scheduler install ~/bin    (then put ~/bin on the PATH of the SSH user)
+#
+# or, without an sshd on the machine, also start an SSH server in this process that runs them (keys of
+# ~/.ssh/authorized_keys only, see local_ssh_server):
+#
+#   python -m functions.common.local_scheduler serve ~/bin 2222    (then use 127.0.0.1:2222 as Name Server)
+#
+# TOREPO_SCHEDULER_DIR and TOREPO_SCHEDULER_SLOTS override the state directory and the number of slots.
+SCHEDULER_DIR = os.environ.get("TOREPO_SCHEDULER_DIR",
+                               os.path.join(os.path.expanduser("~"), ".torepo", "local_scheduler"))
+SCHEDULER_SLOTS = int(os.environ.get("TOREPO_SCHEDULER_SLOTS", os.cpu_count() or 1))
+SLOT_WAIT_INTERVAL = 0.2
+# Seconds between SIGTERM and SIGKILL when a job is cancelled or runs out of time
+KILL_GRACE_PERIOD = 5
+SCHEDULER_COMMANDS = ("sbatch", "squeue", "sacct", "scancel")
+
+ACTIVE_STATES = ("PENDING", "RUNNING")
+# sacct -s abbreviations
+STATE_CODES = {"PD": "PENDING", "R": "RUNNING", "CD": "COMPLETED", "F": "FAILED", "CA": "CANCELLED",
+               "TO": "TIMEOUT", "OOM": "OUT_OF_MEMORY"}
+SQUEUE_FIELDS = {"i": "job_id", "j": "name", "T": "state", "u": "user", "P": "partition", "M": "elapsed",
+                 "C": "cpus", "k": "comment", "r": "reason"}
+
+_REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _jobs_directory():
+    path = os.path.join(SCHEDULER_DIR, "jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _job_path(job_id):
+    return os.path.join(_jobs_directory(), f"{job_id}.json")
+
+
+def load_job(job_id):
+    with open(_job_path(job_id), "r") as f:
+        return json.load(f)
+
+
+def save_job(job):
+    path = _job_path(job["job_id"])
+    with open(path + ".part", "w") as f:
+        json.dump(job, f, indent=4)
+    os.replace(path + ".part", path)
+
+
+def list_jobs():
+    jobs = []
+    for name in os.listdir(_jobs_directory()):
+        if name.endswith(".json"):
+            try:
+                jobs.append(load_job(name[:-len(".json")]))
+            except (IOError, ValueError):
+                continue
+    return sorted(jobs, key=lambda job: (int(job["array_job_id"]), job["array_task_id"] or 0))
+
+
+def _next_job_id():
+    os.makedirs(SCHEDULER_DIR, exist_ok=True)
+    with open(os.path.join(SCHEDULER_DIR, "next_job_id"), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read().strip() or 1000)
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id + 1))
+    return str(job_id)
+
+
+def _cancel_marker(job_id):
+    return os.path.join(_jobs_directory(), f"{job_id}.cancel")
+
+
+def parse_time_limit(time_limit):
+    """Seconds of a --time value; a plain number is minutes, as in SLURM."""
+    if not time_limit:
+        return None
+    if ":" not in time_limit and "-" not in time_limit:
+        return int(time_limit) * 60
+    return parse_slurm_duration(time_limit)
+
+
+def parse_array_spec(array_spec):
+    """Task IDs of --array=0-9, 1,3,5 or 0-10:2 (the %N throttle is ignored)."""
+    task_ids = []
+    for part in array_spec.split("%")[0].split(","):
+        step = 1
+        if ":" in part:
+            part, step = part.split(":")
+        if "-" in part:
+            first, last = part.split("-")
+            task_ids.extend(range(int(first), int(last) + 1, int(step)))
+        else:
+            task_ids.append(int(part))
+    return task_ids
+
+
+def _sbatch_parser():
+    parser = argparse.ArgumentParser(prog="sbatch", add_help=False)
+    parser.add_argument("-J", "--job-name")
+    parser.add_argument("-D", "--chdir")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-e", "--error")
+    parser.add_argument("-a", "--array")
+    parser.add_argument("-d", "--dependency")
+    parser.add_argument("--kill-on-invalid-dep", nargs="?", const="yes")
+    parser.add_argument("-p", "--partition")
+    parser.add_argument("-c", "--cpus-per-task", type=int)
+    parser.add_argument("--mem")
+    parser.add_argument("-t", "--time")
+    parser.add_argument("--comment")
+    parser.add_argument("--parsable", action="store_true")
+    parser.add_argument("--wrap")
+    return parser
+
+
+def parse_sbatch_directives(script_content):
+    """Arguments of the #SBATCH lines at the top of a script (they end at the first command)."""
+    arguments = []
+    for line in script_content.splitlines()[1:]:
+        line = line.strip()
+        if line.startswith("#SBATCH"):
+            arguments.extend(shlex.split(line[len("#SBATCH"):], comments=True))
+        elif line and not line.startswith("#"):
+            break
+    return arguments
+
+
+def _log_path(pattern, job, workdir):
+    """--output/--error path with %j, %A and %a replaced, relative to the working directory."""
+    path = (pattern.replace("%A", job["array_job_id"]).replace("%a", str(job["array_task_id"] or 0))
+            .replace("%j", job["job_id"]).replace("%x", job["name"]))
+    return os.path.join(workdir, path)
+
+
+def sbatch(argv):
+    """Queue a script, as sbatch does. Options on the command line override the #SBATCH ones."""
+    parser = _sbatch_parser()
+    options, rest = parser.parse_known_args(argv)
+    if options.wrap:
+        script_content = f"#!/bin/bash\n{options.wrap}\n"
+        script_name = "wrap"
+    else:
+        if not rest:
+            sys.stderr.write("sbatch: error: no batch script given\n")
+            return 1
+        with open(rest[0], "r") as f:
+            script_content = f.read()
+        script_name = os.path.basename(rest[0])
+    directives, _ = parser.parse_known_args(parse_sbatch_directives(script_content))
+    for name, value in vars(options).items():
+        if value not in (None, False):
+            setattr(directives, name, value)
+
+    array_job_id = _next_job_id()
+    # SLURM runs a copy of the script, taken at submission
+    script_path = os.path.join(_jobs_directory(), f"{array_job_id}.sh")
+    with open(script_path, "w") as f:
+        f.write(script_content)
+
+    dependency = []
+    if directives.dependency:
+        kind, _, job_ids = directives.dependency.partition(":")
+        if kind != "afterok":
+            sys.stderr.write(f"sbatch: error: only afterok dependencies are supported, not {kind}\n")
+            return 1
+        dependency = [job_id for job_id in job_ids.split(":") if job_id]
+
+    task_ids = parse_array_spec(directives.array) if directives.array else [None]
+    workdir = directives.chdir or os.getcwd()
+    for task_id in task_ids:
+        job = {"job_id": array_job_id if task_id is None else f"{array_job_id}_{task_id}",
+               "array_job_id": array_job_id, "array_task_id": task_id,
+               "name": directives.job_name or script_name, "user": os.environ.get("USER", ""),
+               "partition": directives.partition or "local", "state": "PENDING", "reason": "Priority",
+               "exit_code": "0:0", "submit_time": time.time(), "start_time": None, "end_time": None,
+               "cpus": min(directives.cpus_per_task or 1, SCHEDULER_SLOTS), "mem": directives.mem or "",
+               "time_limit_s": parse_time_limit(directives.time), "comment": directives.comment or "",
+               "workdir": workdir, "script": script_path,
+               "output": directives.output or ("slurm-%A_%a.out" if task_id is not None else "slurm-%j.out"),
+               "error": directives.error, "dependency": dependency,
+               "kill_on_invalid_dep": directives.kill_on_invalid_dep == "yes",
+               "max_rss_kb": None, "total_cpu_s": None}
+        save_job(job)
+        # The runner outlives this command (and the SSH channel it came from)
+        subprocess.Popen([sys.executable, "-m", "functions.common.local_scheduler", "run", job["job_id"]],
+                         cwd=_REPOSITORY_ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True,
+                         env=dict(os.environ, PYTHONPATH=_REPOSITORY_ROOT))
+
+    print(array_job_id if options.parsable else f"Submitted batch job {array_job_id}")
+    return 0
+
+
+def _dependency_states(dependency):
+    """Final states of the jobs a job depends on (every task of an array), None while one is active."""
+    jobs = list_jobs()
+    states = []
+    for job_id in dependency:
+        tasks = [job for job in jobs if job["array_job_id"] == job_id or job["job_id"] == job_id]
+        if not tasks:
+            states.append("UNKNOWN")
+        for task in tasks:
+            if task["state"] in ACTIVE_STATES:
+                return None
+            states.append(task["state"])
+    return states
+
+
+def _acquire_slots(count):
+    """Lock count slot files (all or none); the locks go with the runner process when it exits."""
+    slots_directory = os.path.join(SCHEDULER_DIR, "slots")
+    os.makedirs(slots_directory, exist_ok=True)
+    held = []
+    for slot in range(SCHEDULER_SLOTS):
+        slot_file = open(os.path.join(slots_directory, f"{slot}.lock"), "a")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            continue
+        held.append(slot_file)
+        if len(held) == count:
+            return held
+    for slot_file in held:
+        slot_file.close()
+    return None
+
+
+def _finish(job, state, exit_code="0:0"):
+    job["state"] = state
+    job["exit_code"] = exit_code
+    job["end_time"] = time.time()
+    job["reason"] = "None"
+    save_job(job)
+
+
+def run_job(job_id):
+    """Runner of one job (or array task): waits for its dependencies and a slot, then runs the script."""
+    job = load_job(job_id)
+
+    while True:
+        if os.path.exists(_cancel_marker(job_id)):
+            _finish(job, "CANCELLED", "0:0")
+            return
+        if job["dependency"]:
+            states = _dependency_states(job["dependency"])
+            if states is None:
+                job["reason"] = "Dependency"
+                save_job(job)
+                time.sleep(SLOT_WAIT_INTERVAL)
+                continue
+            if any(state != "COMPLETED" for state in states):
+                if job["kill_on_invalid_dep"]:
+                    _finish(job, "CANCELLED", "0:0")
+                else:
+                    job["reason"] = "DependencyNeverSatisfied"
+                    save_job(job)
+                return
+        slots = _acquire_slots(job["cpus"])
+        if slots:
+            break
+        job["reason"] = "Resources"
+        save_job(job)
+        time.sleep(SLOT_WAIT_INTERVAL)
+
+    workdir = job["workdir"]
+    environment = dict(os.environ, SLURM_JOB_ID=job["job_id"].split("_")[0], SLURM_JOB_NAME=job["name"],
+                       SLURM_CPUS_PER_TASK=str(job["cpus"]), SLURM_SUBMIT_DIR=workdir,
+                       SLURM_JOB_PARTITION=job["partition"])
+    if job["array_task_id"] is not None:
+        environment.update(SLURM_ARRAY_JOB_ID=job["array_job_id"], SLURM_ARRAY_TASK_ID=str(job["array_task_id"]))
+    output_file = open(_log_path(job["output"], job, workdir), "w")
+    error_file = open(_log_path(job["error"], job, workdir), "w") if job["error"] else output_file
+
+    job.update(state="RUNNING", reason="None", start_time=time.time())
+    save_job(job)
+    process = subprocess.Popen(["bash", job["script"]], cwd=workdir, stdout=output_file, stderr=error_file,
+                               stdin=subprocess.DEVNULL, env=environment, start_new_session=True)
+    stop_state = None
+    kill_deadline = None
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if stop_state is None:
+            if os.path.exists(_cancel_marker(job_id)):
+                stop_state = "CANCELLED"
+            elif job["time_limit_s"] and time.time() - job["start_time"] > job["time_limit_s"]:
+                stop_state = "TIMEOUT"
+            if stop_state:
+                os.killpg(process.pid, signal.SIGTERM)
+                kill_deadline = time.time() + KILL_GRACE_PERIOD
+        elif time.time() > kill_deadline:
+            os.killpg(process.pid, signal.SIGKILL)
+        time.sleep(SLOT_WAIT_INTERVAL)
+    output_file.close()
+    if error_file is not output_file:
+        error_file.close()
+
+    # ru_maxrss is in KB on Linux
+    job["max_rss_kb"] = usage.ru_maxrss
+    job["total_cpu_s"] = usage.ru_utime + usage.ru_stime
+    if os.WIFSIGNALED(status):
+        exit_code = f"0:{os.WTERMSIG(status)}"
+    else:
+        exit_code = f"{os.WEXITSTATUS(status)}:0"
+    if stop_state:
+        _finish(job, stop_state, exit_code)
+    else:
+        _finish(job, "COMPLETED" if exit_code == "0:0" else "FAILED", exit_code)
+    for slot_file in slots:
+        slot_file.close()
+
+
+def _elapsed(job):
+    if not job["start_time"]:
+        return 0
+    return (job["end_time"] or time.time()) - job["start_time"]
+
+
+def _matches(job, job_ids):
+    return not job_ids or job["job_id"] in job_ids or job["array_job_id"] in job_ids
+
+
+def squeue(argv):
+    """Pending and running jobs, as squeue -h -o '%i %T' -u user [-j ids] prints them."""
+    parser = argparse.ArgumentParser(prog="squeue", add_help=False)
+    parser.add_argument("-h", "--noheader", action="store_true")
+    parser.add_argument("-o", "--format", default="%i %P %j %u %T %M")
+    parser.add_argument("-u", "--user")
+    parser.add_argument("-j", "--jobs", default="")
+    options, _ = parser.parse_known_args(argv)
+
+    job_ids = [job_id for job_id in options.jobs.split(",") if job_id]
+    jobs = [job for job in list_jobs() if job["state"] in ACTIVE_STATES and _matches(job, job_ids)]
+    fields = [field.lstrip("%").lstrip("0123456789.") for field in options.format.split()]
+    if not options.noheader:
+        print(" ".join(SQUEUE_FIELDS.get(field, field).upper() for field in fields))
+    for job in jobs:
+        values = dict(job, elapsed=format_slurm_time(_elapsed(job)))
+        print(" ".join(str(values.get(SQUEUE_FIELDS.get(field), "")) for field in fields))
+    return 0
+
+
+def _sacct_lines(job, fields, allocations_only):
+    job_values = {"JobID": job["job_id"], "JobName": job["name"], "State": job["state"],
+                  "ExitCode": job["exit_code"], "Elapsed": format_slurm_time(_elapsed(job)),
+                  "AllocCPUS": str(job["cpus"]), "ReqMem": job["mem"], "Comment": job["comment"],
+                  "Partition": job["partition"], "User": job["user"], "MaxRSS": "", "TotalCPU": ""}
+    if job["state"] in ("PENDING", "CANCELLED") and not job["start_time"]:
+        job_values["Elapsed"] = "00:00:00"
+    lines = [job_values]
+    if job["start_time"] and not allocations_only:
+        # As in SLURM, the memory and CPU time are reported by the batch step
+        lines.append(dict(job_values, JobID=f"{job['job_id']}.batch", JobName="batch", Comment="",
+                          MaxRSS=f"{job['max_rss_kb']}K" if job["max_rss_kb"] is not None else "",
+                          TotalCPU=format_slurm_time(job["total_cpu_s"] or 0)))
+    return ["|".join(values.get(field, "") for field in fields) for values in lines]
+
+
+def sacct(argv):
+    """Accounting of the jobs, as sacct -n -P [-X] -o <fields> [-j ids] [--name=...] [-s CD] prints it."""
+    parser = argparse.ArgumentParser(prog="sacct", add_help=False)
+    parser.add_argument("-n", "--noheader", action="store_true")
+    parser.add_argument("-P", "--parsable2", action="store_true")
+    parser.add_argument("-X", "--allocations", action="store_true")
+    parser.add_argument("-o", "--format", default="JobID,JobName,State,ExitCode,Elapsed")
+    parser.add_argument("-j", "--jobs", default="")
+    parser.add_argument("--name", default="")
+    parser.add_argument("-s", "--state", default="")
+    parser.add_argument("-u", "--user")
+    parser.add_argument("-S", "--starttime")
+    options, _ = parser.parse_known_args(argv)
+
+    fields = options.format.split(",")
+    job_ids = [job_id for job_id in options.jobs.split(",") if job_id]
+    names = [name for name in options.name.split(",") if name]
+    states = [STATE_CODES.get(state, state) for state in options.state.split(",") if state]
+    if not options.noheader:
+        print("|".join(fields))
+    for job in list_jobs():
+        if _matches(job, job_ids) and (not names or job["name"] in names) and \
+                (not states or job["state"] in states):
+            for line in _sacct_lines(job, fields, options.allocations):
+                print(line)
+    return 0
+
+
+def scancel(argv):
+    """Cancel jobs (every task of an array job): the runner kills them, or drops them if still pending."""
+    for job_id in argv:
+        if job_id.startswith("-"):
+            continue
+        for job in list_jobs():
+            if _matches(job, [job_id]) and job["state"] in ACTIVE_STATES:
+                open(_cancel_marker(job["job_id"]), "w").close()
+                if job["reason"] == "DependencyNeverSatisfied":
+                    # Nothing is left waiting for this job
+                    _finish(job, "CANCELLED", "0:0")
+    return 0
+
+
+def install(bin_directory):
+    """Write sbatch, squeue, sacct and scancel shims running this module into bin_directory."""
+    os.makedirs(bin_directory, exist_ok=True)
+    for command in SCHEDULER_COMMANDS:
+        path = os.path.join(bin_directory, command)
+        with open(path, "w") as f:
+            # The settings of the install are kept: SSH sessions do not carry the environment over
+            f.write("#!/bin/sh\n"
+                    f'export TOREPO_SCHEDULER_DIR="${{TOREPO_SCHEDULER_DIR:-{SCHEDULER_DIR}}}"\n'
+                    f'export TOREPO_SCHEDULER_SLOTS="${{TOREPO_SCHEDULER_SLOTS:-{SCHEDULER_SLOTS}}}"\n'
+                    f'PYTHONPATH={shlex.quote(_REPOSITORY_ROOT)}${{PYTHONPATH:+:$PYTHONPATH}} '
+                    f'exec {shlex.quote(sys.executable)} -m functions.common.local_scheduler {command} "$@"\n')
+        os.chmod(path, 0o755)
+    print(f"Local scheduler commands installed in {bin_directory} ({SCHEDULER_SLOTS} slots, "
+          f"state in {SCHEDULER_DIR})")
+    return 0
+
+
+def serve(bin_directory, port=0):
+    """install the commands into bin_directory, then serve them over SSH on 127.0.0.1:port until Ctrl+C."""
+    # paramiko is only needed here, not by every sbatch or squeue
+    from functions.common.local_ssh_server import LocalSSHServer, AUTHORIZED_KEYS_PATH
+
+    if not os.path.isfile(AUTHORIZED_KEYS_PATH):
+        sys.stderr.write(f"ERROR!!! No {AUTHORIZED_KEYS_PATH}: add the public key TOREPO connects with to it\n")
+        return 1
+    install(bin_directory)
+    server = LocalSSHServer(bin_directory=bin_directory, port=int(port)).start()
+    print(f"Local scheduler SSH server on {server.name_server}: use it as Name Server")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+def main(argv):
+    if not argv:
+        sys.stderr.write(f"usage: local_scheduler {{{','.join(SCHEDULER_COMMANDS)},install,serve,run}} ...\n")
+        return 2
+    command, arguments = argv[0], argv[1:]
+    if command == "run":
+        run_job(arguments[0])
+        return 0
+    if command == "install":
+        return install(arguments[0])
+    if command == "serve":
+        return serve(*arguments[:2])
+    commands = {"sbatch": sbatch, "squeue": squeue, "sacct": sacct, "scancel": scancel}
+    if command not in commands:
+        sys.stderr.write(f"local_scheduler: unknown command {command}\n")
+        return 2
+    return commands[command](arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
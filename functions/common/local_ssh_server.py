@@ -0,0 +1,232 @@
+import os
+import socket
+import logging
+import threading
+import subprocess
+import paramiko
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# In-process SSH server standing in for a cluster front end: commands run with bash on this machine
+# (with the local scheduler commands first on the PATH) and SFTP serves the local filesystem. Only the
+# keys of the authorized keys file get in, and it listens on 127.0.0.1 unless told otherwise.
+AUTHORIZED_KEYS_PATH = os.path.join(os.path.expanduser("~"), ".ssh", "authorized_keys")
+CHANNEL_BUFFER_SIZE = 32768
+
+
+def read_authorized_keys(path):
+    """Base64 blobs of the public keys in an OpenSSH authorized_keys file."""
+    keys = set()
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            # [options] type base64 [comment]
+            for key_type, blob in zip(fields, fields[1:]):
+                if key_type.startswith(("ssh-", "ecdsa-")):
+                    keys.add(blob)
+                    break
+    return keys
+
+
+class _LocalSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _LocalSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP on the local filesystem, with absolute paths as they are."""
+
+    @staticmethod
+    def _error(e):
+        return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            attributes = []
+            for name in os.listdir(path):
+                attribute = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attribute.filename = name
+                attributes.append(attribute)
+            return attributes
+        except OSError as e:
+            return self._error(e)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return self._error(e)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return self._error(e)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return self._error(e)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError as e:
+            return self._error(e)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, old_path, new_path):
+        return self._call(os.rename, old_path, new_path)
+
+    def posix_rename(self, old_path, new_path):
+        return self._call(os.replace, old_path, new_path)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            return self._call(os.chmod, path, attr.st_mode)
+        return paramiko.SFTP_OK
+
+
+class _LocalServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, server):
+        self._server = server
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() in self._server.authorized_keys:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._server.run_command, args=(channel, command.decode()),
+                         daemon=True, name="torepo-ssh-exec").start()
+        return True
+
+
+class LocalSSHServer:
+    """SSH server in this process, so that the SSH and SLURM backends can run against this machine.
+
+    With bin_directory (see local_scheduler install) sbatch, squeue, sacct and scancel are the ones of
+    the local scheduler. Use 127.0.0.1:<port> as the name server.
+    """
+
+    def __init__(self, authorized_keys_path=AUTHORIZED_KEYS_PATH, bin_directory=None, host="127.0.0.1",
+                 port=0, host_key=None):
+        self.authorized_keys = read_authorized_keys(authorized_keys_path)
+        self._bin_directory = bin_directory
+        self._host_key = host_key or paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self.host = host
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        self._stopped = threading.Event()
+
+    @property
+    def name_server(self):
+        return f"{self.host}:{self.port}"
+
+    def start(self):
+        """Accept connections in a background thread."""
+        self._socket.listen(50)
+        threading.Thread(target=self._accept, daemon=True, name="torepo-ssh-server").start()
+        logger.info(f"Local SSH server listening on {self.name_server}")
+        return self
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                connection, address = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _LocalSFTPServer)
+            try:
+                transport.start_server(server=_LocalServerInterface(self))
+            except paramiko.SSHException as e:
+                logger.error(f"ERROR!!! SSH negotiation with {address} failed: {e}")
+                continue
+            self._transports.append(transport)
+
+    def run_command(self, channel, command):
+        """Run command with bash, streaming its input and outputs over the channel, and send its status."""
+        environment = dict(os.environ)
+        if self._bin_directory:
+            environment["PATH"] = f"{self._bin_directory}{os.pathsep}{environment.get('PATH', '')}"
+        process = subprocess.Popen(["bash", "-c", command], cwd=os.path.expanduser("~"), env=environment,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+
+        def forward_input():
+            try:
+                for data in iter(lambda: channel.recv(CHANNEL_BUFFER_SIZE), b""):
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (OSError, EOFError, paramiko.SSHException):
+                pass
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+        def forward_error():
+            for data in iter(lambda: process.stderr.read1(CHANNEL_BUFFER_SIZE), b""):
+                channel.sendall_stderr(data)
+
+        threading.Thread(target=forward_input, daemon=True).start()
+        error_thread = threading.Thread(target=forward_error, daemon=True)
+        error_thread.start()
+        try:
+            for data in iter(lambda: process.stdout.read1(CHANNEL_BUFFER_SIZE), b""):
+                channel.sendall(data)
+            error_thread.join()
+            return_code = process.wait()
+            # A command killed by a signal exits with 128 + the signal, as in sshd
+            channel.send_exit_status(return_code if return_code >= 0 else 128 - return_code)
+            channel.shutdown_write()
+            channel.close()
+        except (OSError, EOFError, paramiko.SSHException) as e:
+            logger.error(f"ERROR!!! Lost the channel of '{command}': {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
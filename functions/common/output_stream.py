@@ -0,0 +1,115 @@
+import time
+import select
+import logging
+from collections import deque
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Lines of remote output kept for the live view (the full output is always returned)
+OUTPUT_BUFFER_LINES = 500
+# Seconds waited for new data before the channel is polled again, also the refresh rate of the live view
+OUTPUT_POLL_INTERVAL = 0.25
+CHANNEL_CHUNK_SIZE = 32768
+
+
+class OutputRingBuffer:
+    """Last max_lines lines of a remote run's output."""
+
+    def __init__(self, max_lines=OUTPUT_BUFFER_LINES):
+        self._lines = deque(maxlen=max_lines)
+        self._dropped = 0
+
+    def extend(self, lines):
+        for line in lines:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(line)
+
+    def text(self):
+        header = f"... {self._dropped} earlier lines not shown ...\n" if self._dropped else ""
+        return header + "\n".join(self._lines)
+
+
+def _split_lines(pending, chunk):
+    """Add chunk to the pending bytes and return (complete decoded lines, bytes left after the last newline)."""
+    pending += chunk
+    *complete, pending = pending.split(b"\n")
+    return [line.decode(errors="replace").rstrip("\r") for line in complete], pending
+
+
+def read_channel_streaming(channel, output_callback=None, poll_interval=OUTPUT_POLL_INTERVAL):
+    """Read stdout and stderr of an exec channel as they arrive, until the command exits.
+
+    output_callback(lines) is called from the calling thread with the (stream, line) pairs received
+    since the previous call, stream being "stdout" or "stderr", at most once every poll_interval.
+    Returns the complete (output, error) strings, like stdout.read().decode() would.
+    """
+    buffers = {"stdout": bytearray(), "stderr": bytearray()}
+    pending = {"stdout": b"", "stderr": b""}
+    readers = {"stdout": (channel.recv_ready, channel.recv),
+               "stderr": (channel.recv_stderr_ready, channel.recv_stderr)}
+
+    def drain():
+        new_lines = []
+        for stream, (ready, recv) in readers.items():
+            while ready():
+                chunk = recv(CHANNEL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffers[stream] += chunk
+                lines, pending[stream] = _split_lines(pending[stream], chunk)
+                new_lines.extend((stream, line) for line in lines)
+        return new_lines
+
+    while True:
+        # The channel is selectable: wait for data without spinning
+        select.select([channel], [], [], poll_interval)
+        new_lines = drain()
+        finished = channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready()
+        if finished:
+            new_lines.extend(drain())
+            new_lines.extend((stream, rest.decode(errors="replace")) for stream, rest in pending.items() if rest)
+        if new_lines and output_callback:
+            output_callback(new_lines)
+        if finished:
+            break
+
+    return buffers["stdout"].decode(), buffers["stderr"].decode()
+
+
+def read_files_streaming(output_path, error_path, is_running, output_callback=None,
+                         poll_interval=OUTPUT_POLL_INTERVAL):
+    """read_channel_streaming for a detached process writing its stdout and stderr to files.
+
+    The files are followed until is_running() returns False, then read to the end.
+    """
+    buffers = {"stdout": bytearray(), "stderr": bytearray()}
+    pending = {"stdout": b"", "stderr": b""}
+    files = {"stdout": open(output_path, "rb"), "stderr": open(error_path, "rb")}
+
+    try:
+        while True:
+            # Checked before reading, so that nothing written before the process ended is missed
+            running = is_running()
+            new_lines = []
+            for stream, f in files.items():
+                chunk = f.read()
+                if chunk:
+                    buffers[stream] += chunk
+                    lines, pending[stream] = _split_lines(pending[stream], chunk)
+                    new_lines.extend((stream, line) for line in lines)
+            if not running:
+                new_lines.extend((stream, rest.decode(errors="replace")) for stream, rest in pending.items() if rest)
+            if new_lines and output_callback:
+                output_callback(new_lines)
+            if not running:
+                break
+            time.sleep(poll_interval)
+    finally:
+        for f in files.values():
+            f.close()
+
+    return buffers["stdout"].decode(errors="replace"), buffers["stderr"].decode(errors="replace")
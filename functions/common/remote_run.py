@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import uuid
+import shlex
+import hashlib
+import logging
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory (inside the remote working directory) with one subdirectory per submitted job
+REMOTE_RUNS_DIRNAME = "torepo_runs"
+# Run directories untouched for this many days are deleted when a new run is prepared
+RUN_DIRECTORY_MAX_AGE_DAYS = 14
+START_MARKER = ".start"
+MANIFEST_FILENAME = "manifest.json"
+
+# Python snippet run on the server when the program finishes: lists every file it produced
+MANIFEST_SCRIPT = """
+import hashlib, json, os, sys
+output_directory, run_directory, exit_status = sys.argv[1], sys.argv[2], int(sys.argv[3])
+started = os.stat(os.path.join(run_directory, ".start")).st_mtime
+files = []
+for name in sorted(os.listdir(output_directory)):
+    path = os.path.join(output_directory, name)
+    if name.startswith(".") or name.endswith(".part") or not os.path.isfile(path):
+        continue
+    file_stat = os.stat(path)
+    if file_stat.st_mtime < started:
+        continue
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    files.append({"name": name, "size": file_stat.st_size, "mtime": file_stat.st_mtime,
+                  "sha256": sha256.hexdigest()})
+manifest = {"exit_status": exit_status, "output_directory": output_directory, "files": files}
+with open(os.path.join(run_directory, "manifest.json.part"), "w") as f:
+    json.dump(manifest, f, indent=4)
+os.rename(os.path.join(run_directory, "manifest.json.part"), os.path.join(run_directory, "manifest.json"))
+"""
+
+
+def new_run_id():
+    """Unique, sortable identifier for a remote submission (names its run directory)."""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def get_run_directory(working_directory, run_id):
+    return f"{working_directory}/{REMOTE_RUNS_DIRNAME}/{run_id}"
+
+
+def prepare_run_directory(ssh, working_directory, run_directory, max_age_days=RUN_DIRECTORY_MAX_AGE_DAYS):
+    """Create the run directory of a new submission and garbage collect old ones in the same round trip."""
+    runs_directory = shlex.quote(f"{working_directory}/{REMOTE_RUNS_DIRNAME}")
+    stdin, stdout, stderr = ssh.exec_command(
+        f"mkdir -p {shlex.quote(run_directory)} && "
+        f"find {runs_directory} -mindepth 1 -maxdepth 1 -type d -mtime +{max_age_days} -exec rm -rf {{}} +")
+    if stdout.channel.recv_exit_status() != 0:
+        logger.error(f"ERROR!!! Could not prepare run directory {run_directory}: {stderr.read().decode()}")
+
+
+def start_marker_command(run_directory):
+    """Shell command creating the run directory and the marker the manifest compares mtimes against."""
+    return f"mkdir -p {shlex.quote(run_directory)} && touch {shlex.quote(f'{run_directory}/{START_MARKER}')}"
+
+
+def manifest_command(output_directory, run_directory, exit_status="$?"):
+    """Shell command writing <run_directory>/manifest.json with the files created in output_directory."""
+    python_args = (f"-c {shlex.quote(MANIFEST_SCRIPT)} {shlex.quote(output_directory)} "
+                   f"{shlex.quote(run_directory)} {exit_status}")
+    return (f"for py in python python3; do "
+            f"if command -v $py >/dev/null 2>&1; then $py {python_args}; break; fi; done")
+
+
+def wrap_command_with_manifest(command, output_directory, run_directory):
+    """Run command and then record its output files in a manifest, keeping the command's exit status."""
+    return (f"{start_marker_command(run_directory)} && {{ {command} ; }}; torepo_status=$?; "
+            f"{manifest_command(output_directory, run_directory, '$torepo_status')}; exit $torepo_status")
+
+
+def read_remote_manifest(sftp, run_directory):
+    """Return the manifest written by a finished job, or None if there is none."""
+    try:
+        with sftp.open(f"{run_directory}/{MANIFEST_FILENAME}", "r") as f:
+            return json.loads(f.read().decode())
+    except (IOError, ValueError) as e:
+        logger.error(f"ERROR!!! Could not read the output manifest of {run_directory}: {e}")
+        return None
+
+
+def manifest_file_names(manifest, exclude=()):
+    if manifest is None:
+        return []
+    return [entry["name"] for entry in manifest["files"] if entry["name"] not in exclude]
+
+
+def verify_downloaded_files(manifest, local_directory):
+    """Check the size and sha256 of downloaded files against the manifest. Returns the names that differ."""
+    corrupted = []
+    for entry in manifest["files"] if manifest else []:
+        local_path = os.path.join(local_directory, entry["name"])
+        if not os.path.exists(local_path):
+            continue
+        sha256 = hashlib.sha256()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        if os.path.getsize(local_path) != entry["size"] or sha256.hexdigest() != entry["sha256"]:
+            logger.error(f"ERROR!!! {entry['name']} does not match the remote manifest")
+            corrupted.append(entry["name"])
+    return corrupted
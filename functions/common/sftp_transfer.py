@@ -0,0 +1,238 @@
+import os
+import time
+import shlex
+import logging
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import paramiko
+
+try:
+    import zstandard
+except ImportError:  # Optional: without it the streamed transfers fall back to gzip
+    zstandard = None
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Flow-control window and packet size of the SFTP channel used for bulk transfers.
+# A large window lets paramiko keep many read/write requests in flight instead of
+# stalling every 2 MB (its default) waiting for the server to acknowledge them.
+SFTP_WINDOW_SIZE = 32 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 32 * 1024
+# Worker threads used by download_files_parallel, each one with its own SFTP channel
+DOWNLOAD_WORKERS = 4
+# From this many files on, outputs are fetched as one compressed tar stream instead of file by file
+STREAM_TRANSFER_MIN_FILES = 20
+
+# Remote compressor and matching local tarfile read mode for each streamed transfer compression
+STREAM_COMPRESSORS = {"zstd": "zstd -q -c", "gzip": "gzip -c"}
+# A truncated or corrupt stream: what is missing is then fetched file by file
+STREAM_ERRORS = (tarfile.ReadError, EOFError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class TransferReport:
+    """Aggregate result of a batch of SFTP transfers."""
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.transferred = []
+        self.missing = []
+        self.total_bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """Bytes per second over the whole batch."""
+        return self.total_bytes / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        verb = "Uploaded" if self.direction == "put" else "Downloaded"
+        return (f"{verb} {len(self.transferred)} files ({self.total_bytes / 1024 ** 2:.2f} MB) "
+                f"in {self.elapsed:.2f} s ({self.throughput / 1024 ** 2:.2f} MB/s)")
+
+
+def open_sftp_session(ssh, window_size=SFTP_WINDOW_SIZE, max_packet_size=SFTP_MAX_PACKET_SIZE):
+    """Open an SFTP session with a large window on the transport of an (already connected) SSHClient."""
+    return paramiko.SFTPClient.from_transport(ssh.get_transport(), window_size=window_size,
+                                              max_packet_size=max_packet_size)
+
+
+def transfer_files(sftp, file_pairs, direction="put"):
+    """Transfer a batch of (local_path, remote_path) pairs over one SFTP session.
+
+    direction is "put" (local -> remote) or "get" (remote -> local). Missing
+    source files are logged and listed in the returned TransferReport instead
+    of aborting the batch.
+    """
+    report = TransferReport(direction)
+    start = time.time()
+
+    for local_path, remote_path in file_pairs:
+        try:
+            if direction == "put":
+                attributes = sftp.put(local_path, remote_path)
+                report.total_bytes += attributes.st_size
+            else:
+                # sftp.get stats the remote file itself, no need for a separate round trip
+                sftp.get(remote_path, local_path)
+                report.total_bytes += os.path.getsize(local_path)
+            report.transferred.append((local_path, remote_path))
+        except FileNotFoundError:
+            source = local_path if direction == "put" else remote_path
+            logger.error(f"ERROR!!! File not found: {source}")
+            report.missing.append((local_path, remote_path))
+            # sftp.get creates the local file before it finds out the remote one is missing
+            if direction == "get" and os.path.exists(local_path):
+                os.remove(local_path)
+
+    report.elapsed = time.time() - start
+    logger.info(report.summary())
+    return report
+
+
+def upload_files(sftp, file_pairs):
+    return transfer_files(sftp, file_pairs, "put")
+
+
+def download_files_parallel(ssh, file_pairs, max_workers=DOWNLOAD_WORKERS, progress_callback=None):
+    """Download (local_path, remote_path) pairs with a bounded pool of threads sharing the pooled transport.
+
+    Every worker opens its own SFTP channel, so several files stream at once. Files are written under a
+    temporary name and renamed when complete, so a local path only ever holds a whole file.
+    progress_callback(done, total, file_name) is called from the calling thread after each file, which
+    makes it safe to update Streamlit elements from it.
+    """
+    report = TransferReport("get")
+    thread_data = threading.local()
+    sessions = []
+    sessions_lock = threading.Lock()
+
+    def get_session():
+        if not hasattr(thread_data, "sftp"):
+            thread_data.sftp = open_sftp_session(ssh)
+            with sessions_lock:
+                sessions.append(thread_data.sftp)
+        return thread_data.sftp
+
+    def fetch(local_path, remote_path):
+        partial_path = f"{local_path}.part"
+        try:
+            get_session().get(remote_path, partial_path)
+        except FileNotFoundError:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.replace(partial_path, local_path)
+        return os.path.getsize(local_path)
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch, local_path, remote_path): (local_path, remote_path)
+                       for local_path, remote_path in file_pairs}
+            for done, future in enumerate(as_completed(futures), start=1):
+                local_path, remote_path = futures[future]
+                try:
+                    report.total_bytes += future.result()
+                    report.transferred.append((local_path, remote_path))
+                except FileNotFoundError:
+                    logger.error(f"ERROR!!! File not found: {remote_path}")
+                    report.missing.append((local_path, remote_path))
+                if progress_callback:
+                    progress_callback(done, len(futures), os.path.basename(local_path))
+    finally:
+        for sftp in sessions:
+            sftp.close()
+
+    report.elapsed = time.time() - start
+    logger.info(report.summary())
+    return report
+
+
+def download_files_stream(ssh, remote_directory, file_names, local_directory, compression=None):
+    """Download many files from one remote directory as a single compressed tar stream.
+
+    The remote side runs `tar | zstd` (or gzip) in one exec channel and the stream is unpacked
+    locally as it arrives, with no intermediate archive on either side. zstd is used when the
+    optional zstandard module is installed and the server has the zstd command, otherwise gzip.
+    """
+    if compression is None:
+        compression = "zstd" if zstandard is not None else "gzip"
+
+    report = TransferReport("get")
+    requested = set(file_names)
+    start = time.time()
+
+    stdin, stdout, stderr = ssh.exec_command(f"cd {shlex.quote(remote_directory)} && "
+                                             f"tar -cf - -T - 2>/dev/null | {STREAM_COMPRESSORS[compression]}")
+
+    # Feed the file list from another thread: tar starts writing before it has read the whole list
+    def send_file_list():
+        stdin.write("".join(f"{name}\n" for name in file_names))
+        stdin.channel.shutdown_write()
+
+    writer = threading.Thread(target=send_file_list, daemon=True)
+    writer.start()
+
+    try:
+        if compression == "zstd":
+            tar = tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(stdout), mode="r|")
+        else:
+            tar = tarfile.open(fileobj=stdout, mode="r|gz")
+
+        with tar:
+            for member in tar:
+                # Only accept the plain files that were asked for, never paths outside local_directory
+                if not member.isfile() or member.name not in requested:
+                    continue
+                local_path = os.path.join(local_directory, member.name)
+                partial_path = f"{local_path}.part"
+                with tar.extractfile(member) as source, open(partial_path, "wb") as target:
+                    while True:
+                        chunk = source.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                os.replace(partial_path, local_path)
+                report.total_bytes += member.size
+                report.transferred.append((local_path, f"{remote_directory}/{member.name}"))
+    except STREAM_ERRORS as e:
+        stream_error = e
+    else:
+        stream_error = None
+    writer.join()
+
+    # Exit status 127: the server has no zstd, try again with gzip
+    if stdout.channel.recv_exit_status() == 127 and compression == "zstd" and not report.transferred:
+        logger.info("zstd is not available on the server, using gzip")
+        return download_files_stream(ssh, remote_directory, file_names, local_directory, compression="gzip")
+
+    if stream_error is not None:
+        logger.error(f"ERROR!!! Broken {compression} tar stream from {remote_directory}: {stream_error}")
+
+    extracted = {os.path.relpath(local_path, local_directory) for local_path, remote_path in report.transferred}
+    for name in file_names:
+        if name not in extracted:
+            logger.error(f"ERROR!!! File not found: {remote_directory}/{name}")
+            report.missing.append((os.path.join(local_directory, name), f"{remote_directory}/{name}"))
+
+    report.elapsed = time.time() - start
+    logger.info(report.summary())
+    return report
+
+
+def fetch_output_files(ssh, remote_directory, file_names, local_directory, progress_callback=None):
+    """Download output files, as one tar stream when there are many of them, otherwise in parallel."""
+    file_names = list(dict.fromkeys(file_names))
+    if len(file_names) >= STREAM_TRANSFER_MIN_FILES:
+        report = download_files_stream(ssh, remote_directory, file_names, local_directory)
+        if progress_callback:
+            progress_callback(len(file_names), len(file_names), f"{len(report.transferred)} files")
+        return report
+
+    return download_files_parallel(ssh, [(os.path.join(local_directory, name), f"{remote_directory}/{name}")
+                                         for name in file_names],
+                                   progress_callback=progress_callback)
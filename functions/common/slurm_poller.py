@@ -0,0 +1,217 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from functions.common.ssh_pool import exec_remote_command
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between two queries of the scheduler: short right after a change, growing while nothing happens
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 60.0
+POLL_BACKOFF_FACTOR = 1.5
+# Failed queries in a row (about half an hour with the backoff) after which the watched jobs are given up
+POLL_MAX_FAILURES = 40
+
+# sacct states of a job that ended without error
+SLURM_SUCCESS_STATES = ("COMPLETED",)
+# squeue states of a job that has started on a node
+SLURM_STARTED_STATES = ("RUNNING", "COMPLETING")
+
+
+def parse_squeue_output(squeue_output):
+    """{job_id: state} of the jobs still known to squeue (`-o '%i %T'`).
+
+    Array tasks are folded into their array job ID, which has started as soon as one of them has.
+    """
+    queued = {}
+    for line in squeue_output.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        job_id = fields[0].split("_")[0]
+        state = fields[1] if len(fields) > 1 else "UNKNOWN"
+        if job_id not in queued or state in SLURM_STARTED_STATES:
+            queued[job_id] = state
+    return queued
+
+
+def parse_sacct_output(sacct_output):
+    """{job_id: (state, exit_code)} from `sacct -n -P -X -o JobID,State,ExitCode`.
+
+    The tasks of an array job are folded into one entry: the first task that did not complete wins.
+    """
+    finished = {}
+    for line in sacct_output.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) < 3:
+            continue
+        job_id = fields[0].split("_")[0]
+        state = fields[1].split()[0] if fields[1] else "UNKNOWN"
+        if job_id not in finished or finished[job_id][0] in SLURM_SUCCESS_STATES:
+            finished[job_id] = (state, fields[2])
+    return finished
+
+
+class SlurmPoller:
+    """Watches every outstanding SLURM job of one (server, user, key) with one squeue call per tick.
+
+    watch(job_id) returns a Future resolved with {"job_id", "state", "exit_code"} once the job has
+    left the queue, and can also call back when squeue first shows the job running. The interval
+    between ticks starts at POLL_MIN_INTERVAL and backs off up to POLL_MAX_INTERVAL while no job
+    changes state; a new or finished job resets it. If the queue cannot be queried POLL_MAX_FAILURES
+    times in a row, every watched job ends as UNKNOWN.
+    """
+
+    def __init__(self, name_server, name_user, ssh_key_options,
+                 min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self._server = (name_server, name_user, ssh_key_options)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._interval = min_interval
+        self._futures = {}
+        # Callbacks of the watched jobs that squeue has not shown running yet
+        self._started_callbacks = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._failures = 0
+
+    def watch(self, job_id, callback=None, started_callback=None):
+        """Start tracking job_id. callback(status) is also called when it finishes, and
+        started_callback() when it leaves PENDING for a node."""
+        job_id = str(job_id)
+        with self._lock:
+            future = self._futures.get(job_id)
+            if future is None:
+                future = Future()
+                self._futures[job_id] = future
+            if started_callback:
+                self._started_callbacks.setdefault(job_id, []).append(started_callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll_loop, daemon=True, name="slurm-poller")
+                self._thread.start()
+        if callback:
+            future.add_done_callback(lambda done: callback(done.result()))
+        self._interval = self._min_interval
+        self._wakeup.set()
+        return future
+
+    def wait(self, job_id, timeout=None):
+        """Block until job_id has left the queue and return its final status."""
+        return self.watch(job_id).result(timeout=timeout)
+
+    def refresh(self):
+        """Query the queue now instead of after the current interval (e.g. right after a scancel)."""
+        self._interval = self._min_interval
+        self._wakeup.set()
+
+    def outstanding(self):
+        with self._lock:
+            return sorted(self._futures)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _poll_loop(self):
+        while not self._stopped:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            with self._lock:
+                job_ids = sorted(self._futures)
+                if not job_ids:
+                    # Nothing left to watch: the next watch() starts a new thread
+                    self._thread = None
+                    return
+            try:
+                changed = self._tick(job_ids)
+                self._failures = 0
+            except Exception as e:
+                logger.error(f"ERROR!!! Could not query the SLURM queue on {self._server[0]}: {e}")
+                changed = False
+                self._failures += 1
+                if self._failures >= POLL_MAX_FAILURES:
+                    self._give_up(job_ids)
+            if changed:
+                self._interval = self._min_interval
+            else:
+                self._interval = min(self._interval * POLL_BACKOFF_FACTOR, self._max_interval)
+
+    def _give_up(self, job_ids):
+        logger.error(f"ERROR!!! Giving up SLURM jobs {', '.join(job_ids)} on {self._server[0]}: "
+                     f"the queue could not be queried {self._failures} times in a row")
+        self._failures = 0
+        for job_id in job_ids:
+            with self._lock:
+                future = self._futures.pop(job_id, None)
+                self._started_callbacks.pop(job_id, None)
+            if future is not None:
+                future.set_result({"job_id": job_id, "state": "UNKNOWN", "exit_code": ""})
+
+    def _tick(self, job_ids):
+        """One round trip for the queue state of every job (two if some of them have just finished)."""
+        # List the whole queue of the user: `squeue -j` fails outright as soon as one of the IDs has been purged
+        output, error = exec_remote_command(*self._server, f"squeue -h -o '%i %T' -u {self._server[1]}")
+        if error and not output:
+            raise IOError(error.strip())
+        queued = parse_squeue_output(output)
+        started = []
+        with self._lock:
+            for job_id in job_ids:
+                if job_id not in queued:
+                    # Finished before a tick saw it running: only its finished callback is called
+                    self._started_callbacks.pop(job_id, None)
+                elif queued[job_id] in SLURM_STARTED_STATES:
+                    started += self._started_callbacks.pop(job_id, [])
+        for started_callback in started:
+            started_callback()
+        finished_ids = [job_id for job_id in job_ids if job_id not in queued]
+        if not finished_ids:
+            return bool(started)
+
+        output, error = exec_remote_command(*self._server, f"sacct -n -P -X -o JobID,State,ExitCode "
+                                                           f"-j {','.join(finished_ids)}")
+        accounting = parse_sacct_output(output)
+        for job_id in finished_ids:
+            state, exit_code = accounting.get(job_id, ("UNKNOWN", ""))
+            with self._lock:
+                future = self._futures.pop(job_id, None)
+            if future is not None:
+                logger.info(f"SLURM job {job_id} finished: {state}")
+                future.set_result({"job_id": job_id, "state": state, "exit_code": exit_code})
+        return True
+
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+
+def get_slurm_poller(name_server, name_user, ssh_key_options):
+    """The shared poller of a (server, user, key); all jobs submitted there are polled together."""
+    key = (name_server, name_user, ssh_key_options)
+    with _pollers_lock:
+        if key not in _pollers:
+            _pollers[key] = SlurmPoller(name_server, name_user, ssh_key_options)
+        return _pollers[key]
+
+
+def cancel_slurm_jobs(name_server, name_user, ssh_key_options, job_ids):
+    """scancel some jobs (or whole job arrays) and have their poller notice it at once."""
+    output, error = exec_remote_command(name_server, name_user, ssh_key_options, f"scancel {' '.join(job_ids)}")
+    if error:
+        logger.error(f"ERROR!!! scancel {' '.join(job_ids)} on {name_server}: {error.strip()}")
+    get_slurm_poller(name_server, name_user, ssh_key_options).refresh()
+
+
+def _stop_pollers():
+    with _pollers_lock:
+        for poller in _pollers.values():
+            poller.stop()
+
+
+atexit.register(_stop_pollers)
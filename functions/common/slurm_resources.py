@@ -0,0 +1,164 @@
+import os
+import re
+import math
+import logging
+import xml.etree.ElementTree as ET
+from functions.common.ssh_pool import exec_remote_command
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Conservative starting point of the cost of each program, replaced by the sacct calibration once
+# there are enough previous runs: memory = base + per atom, time = base + per atom
+DEFAULT_RESOURCE_MODELS = {
+    "topology": {"cpus": 1, "base_mem_mb": 500, "mem_kb_per_atom": 4.0, "base_time_s": 300,
+                 "time_ms_per_atom": 2.0},
+    "replicate_polymer": {"cpus": 1, "base_mem_mb": 1000, "mem_kb_per_atom": 10.0, "base_time_s": 600,
+                          "time_ms_per_atom": 5.0},
+}
+# SLURM job names of each program (comma separated), used to find its previous runs in sacct
+SLURM_JOB_NAMES = {"topology": "topology_job", "replicate_polymer": "replicate_sweep,replicate_job"}
+# Headroom over the estimate: jobs that hit --mem or --time are killed
+MEMORY_SAFETY_FACTOR = 1.5
+TIME_SAFETY_FACTOR = 2.0
+MIN_TIME_S = 600
+# Previous runs needed before the sacct calibration replaces the default model
+MIN_CALIBRATION_SAMPLES = 3
+CALIBRATION_PERCENTILE = 0.9
+SACCT_HISTORY_DAYS = 90
+# Atom count is stored in the job comment, so sacct can relate a job's cost to its size. SLURM only
+# keeps comments with AccountingStoreFlags=job_comment: the local job history comes first
+ATOMS_COMMENT_PREFIX = "torepo_atoms="
+
+
+def count_atoms(path):
+    """Number of atoms of a PDB, MOL2 or XSD file, or None if it cannot be read."""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == ".pdb":
+            with open(path, "r") as f:
+                return sum(1 for line in f if line.startswith(("ATOM", "HETATM")))
+        if extension == ".mol2":
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+            # The line after the molecule name holds: num_atoms num_bonds ...
+            start = lines.index("@<TRIPOS>MOLECULE")
+            return int(lines[start + 2].split()[0])
+        if extension == ".xsd":
+            return sum(1 for element in ET.parse(path).iter() if element.tag == "Atom3d")
+    except (OSError, ValueError, IndexError, ET.ParseError) as e:
+        logger.error(f"ERROR!!! Could not count the atoms of {path}: {e}")
+    return None
+
+
+def parse_slurm_duration(duration):
+    """Seconds of a SLURM duration: [D-]HH:MM:SS[.ms], MM:SS[.ms] or MM:SS."""
+    if not duration or duration in ("UNLIMITED", "INVALID"):
+        return None
+    days = 0
+    if "-" in duration:
+        days, duration = duration.split("-", 1)
+    fields = [float(field) for field in duration.split(":")]
+    while len(fields) < 3:
+        fields.insert(0, 0.0)
+    hours, minutes, seconds = fields
+    return int(days) * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def parse_slurm_memory(memory):
+    """MB of a SLURM memory value such as 123456K, 512M or 2.5G."""
+    match = re.match(r"^([\d.]+)([KMGT]?)", memory or "")
+    if not match:
+        return None
+    units = {"": 1.0 / 1024 ** 2, "K": 1.0 / 1024, "M": 1.0, "G": 1024.0, "T": 1024.0 ** 2}
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def format_slurm_time(seconds):
+    """--time value ([D-]HH:MM:SS) for a number of seconds."""
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    time_value = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{days}-{time_value}" if days else time_value
+
+
+def sbatch_resource_lines(cpus_per_task=None, mem=None, time_limit=None, atom_count=None):
+    """#SBATCH lines requesting the resources of a job; unset values keep the partition defaults."""
+    lines = ""
+    if cpus_per_task:
+        lines += f"#SBATCH --cpus-per-task={cpus_per_task}\n"
+    if mem:
+        lines += f"#SBATCH --mem={mem}\n"
+    if time_limit:
+        lines += f"#SBATCH --time={time_limit}\n"
+    if atom_count:
+        lines += f"#SBATCH --comment={ATOMS_COMMENT_PREFIX}{atom_count}\n"
+    return lines
+
+
+def fetch_sacct_samples(name_server, name_user, ssh_key_options, program, days=SACCT_HISTORY_DAYS,
+                        exclude_job_ids=()):
+    """(atoms, elapsed seconds, MaxRSS MB) of the completed runs of a program found in sacct.
+
+    Jobs whose comment holds no atom count (not stored by the cluster) and exclude_job_ids are left out.
+    """
+    output, error = exec_remote_command(name_server, name_user, ssh_key_options,
+                                        f"sacct -n -P -u {name_user} --name={SLURM_JOB_NAMES[program]} "
+                                        f"-S now-{days}days -s CD -o JobID,Elapsed,MaxRSS,Comment")
+    jobs = {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) < 4:
+            continue
+        job_id, elapsed, max_rss, comment = fields[:4]
+        # Steps (<id>.batch) carry the MaxRSS, the job line carries the comment
+        job = jobs.setdefault(job_id.split(".")[0], {"atoms": None, "elapsed": None, "max_rss": 0.0})
+        if comment.startswith(ATOMS_COMMENT_PREFIX):
+            job["atoms"] = int(comment[len(ATOMS_COMMENT_PREFIX):])
+        if "." not in job_id:
+            job["elapsed"] = parse_slurm_duration(elapsed)
+        job["max_rss"] = max(job["max_rss"], parse_slurm_memory(max_rss) or 0.0)
+
+    without_atoms = sum(1 for job in jobs.values() if not job["atoms"])
+    if without_atoms:
+        logger.info(f"{without_atoms} {program} jobs in sacct have no atom count in their comment")
+    return [(job["atoms"], job["elapsed"], job["max_rss"]) for job_id, job in jobs.items()
+            if job_id not in exclude_job_ids and job["atoms"] and job["elapsed"] and job["max_rss"]]
+
+
+def calibrate_model(program, samples):
+    """Resource model of a program with its per-atom costs fitted to previous runs.
+
+    The per-atom cost of each run is taken after subtracting the base cost; the model uses a high
+    percentile of them, so that most runs of a similar size fit in the request.
+    """
+    model = dict(DEFAULT_RESOURCE_MODELS[program])
+    if len(samples) < MIN_CALIBRATION_SAMPLES:
+        return model
+
+    def percentile(values):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(CALIBRATION_PERCENTILE * len(values)))]
+
+    model["mem_kb_per_atom"] = percentile([max(0.0, (max_rss - model["base_mem_mb"]) * 1024 / atoms)
+                                           for atoms, elapsed, max_rss in samples])
+    model["time_ms_per_atom"] = percentile([max(0.0, (elapsed - model["base_time_s"]) * 1000 / atoms)
+                                            for atoms, elapsed, max_rss in samples])
+    model["calibrated_from"] = len(samples)
+    return model
+
+
+def estimate_resources(program, atom_count, image_multiplier=1, samples=()):
+    """Suggested {"cpus_per_task", "mem", "time_limit"} for a run on atom_count * image_multiplier atoms."""
+    model = calibrate_model(program, list(samples))
+    total_atoms = (atom_count or 0) * image_multiplier
+    memory_mb = (model["base_mem_mb"] + model["mem_kb_per_atom"] * total_atoms / 1024) * MEMORY_SAFETY_FACTOR
+    time_s = (model["base_time_s"] + model["time_ms_per_atom"] * total_atoms / 1000) * TIME_SAFETY_FACTOR
+    return {"cpus_per_task": model["cpus"],
+            "mem": f"{int(math.ceil(memory_mb / 100.0) * 100)}M",
+            "time_limit": format_slurm_time(max(time_s, MIN_TIME_S)),
+            "calibrated_from": model.get("calibrated_from", 0)}
@@ -0,0 +1,128 @@
+import threading
+import atexit
+import socket
+import time
+import logging
+import paramiko
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between SSH keepalive packets sent on every pooled transport
+KEEPALIVE_INTERVAL = 30
+# A connection idle for longer than this is probed before being handed out again
+HEALTH_CHECK_INTERVAL = 60
+
+# Errors that mean the underlying transport is gone and the connection must be rebuilt
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, socket.error)
+SSH_PORT = 22
+
+
+def split_name_server(name_server):
+    """(host, port) of a server given as host or host:port (e.g. the local SSH server of local_scheduler)."""
+    host, separator, port = name_server.partition(":")
+    if separator and port.isdigit():
+        return host, int(port)
+    return name_server, SSH_PORT
+
+
+class SSHConnectionPool:
+    """Process-wide pool of authenticated SSH connections keyed by (server, user, key)."""
+
+    def __init__(self, keepalive_interval=KEEPALIVE_INTERVAL, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self._keepalive_interval = keepalive_interval
+        self._health_check_interval = health_check_interval
+        self._clients = {}
+        self._last_used = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _connect(self, name_server, name_user, ssh_key_options, timeout=None):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        host, port = split_name_server(name_server)
+        ssh.connect(host, port, username=name_user, key_filename=ssh_key_options, timeout=timeout)
+        ssh.get_transport().set_keepalive(self._keepalive_interval)
+        logger.info(f"New SSH connection to {name_user}@{name_server}")
+        return ssh
+
+    def _is_healthy(self, key, ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+
+        # Only probe connections that have been idle for a while, the keepalive covers the rest
+        if time.time() - self._last_used.get(key, 0) > self._health_check_interval:
+            try:
+                transport.send_ignore()
+            except CONNECTION_ERRORS:
+                return False
+        return True
+
+    def get_client(self, name_server, name_user, ssh_key_options, timeout=None):
+        """Return a live pooled SSHClient, reconnecting if the cached one is dead. Never close it."""
+        key = (name_server, name_user, ssh_key_options)
+        with self._get_key_lock(key):
+            ssh = self._clients.get(key)
+            if ssh is not None and not self._is_healthy(key, ssh):
+                logger.info(f"Stale SSH connection to {name_user}@{name_server}, reconnecting")
+                ssh.close()
+                ssh = None
+
+            if ssh is None:
+                ssh = self._connect(name_server, name_user, ssh_key_options, timeout=timeout)
+                self._clients[key] = ssh
+
+            self._last_used[key] = time.time()
+            return ssh
+
+    def invalidate(self, name_server, name_user, ssh_key_options):
+        """Drop (and close) the pooled connection so the next borrower reconnects."""
+        key = (name_server, name_user, ssh_key_options)
+        with self._get_key_lock(key):
+            ssh = self._clients.pop(key, None)
+            self._last_used.pop(key, None)
+        if ssh is not None:
+            ssh.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._last_used.clear()
+        for ssh in clients:
+            ssh.close()
+
+
+_ssh_pool = SSHConnectionPool()
+atexit.register(_ssh_pool.close_all)
+
+
+def get_ssh_pool():
+    return _ssh_pool
+
+
+def get_ssh_client(name_server, name_user, ssh_key_options, timeout=None):
+    """Borrow the pooled connection for (server, user, key). Callers must not close it."""
+    return _ssh_pool.get_client(name_server, name_user, ssh_key_options, timeout=timeout)
+
+
+def exec_remote_command(name_server, name_user, ssh_key_options, command, timeout=None):
+    """Run a command over the pooled connection, retrying once on a fresh connection if the old one died."""
+    for attempt in range(2):
+        ssh = get_ssh_client(name_server, name_user, ssh_key_options, timeout=timeout)
+        try:
+            stdin, stdout, stderr = ssh.exec_command(command)
+            return stdout.read().decode(), stderr.read().decode()
+        except CONNECTION_ERRORS:
+            _ssh_pool.invalidate(name_server, name_user, ssh_key_options)
+            if attempt:
+                raise
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import subprocess
+import paramiko
+import pytest
+from functions.common import local_scheduler
+from functions.common.local_ssh_server import LocalSSHServer
+from functions.common.execution_backend import (build_sbatch_script, SlurmBackend, SLURM_SCRIPT_NAME,
+                                                TASK_DIRECTORY_PREFIX, RUN_COMPLETED, RUN_CANCELLED)
+from functions.common.remote_run import MANIFEST_FILENAME, manifest_file_names
+
+FINISH_TIMEOUT = 30
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    """sbatch, squeue, sacct and scancel of the local scheduler first on the PATH, with their own state."""
+    bin_directory = str(tmp_path / "bin")
+    monkeypatch.setenv("TOREPO_SCHEDULER_DIR", str(tmp_path / "scheduler"))
+    monkeypatch.setenv("TOREPO_SCHEDULER_SLOTS", "2")
+    local_scheduler.install(bin_directory)
+    monkeypatch.setenv("PATH", f"{bin_directory}{os.pathsep}{os.environ['PATH']}")
+    return bin_directory
+
+
+def run(*command):
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout
+
+
+def submit(run_directory, commands, **options):
+    """sbatch a script of build_sbatch_script, as SlurmBackend does. Returns the job ID."""
+    os.makedirs(run_directory, exist_ok=True)
+    script_path = os.path.join(run_directory, SLURM_SCRIPT_NAME)
+    with open(script_path, "w") as f:
+        f.write(build_sbatch_script("test_job", run_directory, commands, os.devnull, **options))
+    return run("sbatch", "--parsable", script_path).strip()
+
+
+def squeue(job_id):
+    return dict(line.split() for line in run("squeue", "-h", "-o", "%i %T", "-j", job_id).splitlines())
+
+
+def sacct(job_id):
+    lines = run("sacct", "-n", "-P", "-X", "-o", "JobID,State,ExitCode", "-j", job_id).splitlines()
+    return {job: (state, exit_code) for job, state, exit_code in (line.split("|") for line in lines)}
+
+
+def wait_finished(*job_ids):
+    deadline = time.time() + FINISH_TIMEOUT
+    while any(squeue(job_id) for job_id in job_ids):
+        assert time.time() < deadline, "jobs still queued"
+        time.sleep(0.2)
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILENAME), "r") as f:
+        return json.load(f)
+
+
+#   ============================    sbatch scripts   ============================    #
+
+def test_sbatch_script(scheduler, tmp_path):
+    run_directory = str(tmp_path / "run")
+
+    job_id = submit(run_directory, ["echo done > out.txt"], resources={"cpus_per_task": 1, "mem": "1G"})
+    wait_finished(job_id)
+
+    assert sacct(job_id) == {job_id: ("COMPLETED", "0:0")}
+    manifest = read_manifest(run_directory)
+    assert manifest["exit_status"] == 0
+    assert "out.txt" in manifest_file_names(manifest)
+    assert os.path.exists(os.path.join(run_directory, "slurm.out"))
+
+
+def test_sbatch_array(scheduler, tmp_path):
+    run_directory = str(tmp_path / "run")
+
+    job_id = submit(run_directory, ["echo $SLURM_ARRAY_TASK_ID > task.txt"], array_size=3)
+    wait_finished(job_id)
+
+    assert sacct(job_id) == {f"{job_id}_{number}": ("COMPLETED", "0:0") for number in range(3)}
+    for number in range(3):
+        task_directory = os.path.join(run_directory, f"{TASK_DIRECTORY_PREFIX}{number}")
+        with open(os.path.join(task_directory, "task.txt"), "r") as f:
+            assert f.read().strip() == str(number)
+        assert read_manifest(task_directory)["exit_status"] == 0
+
+
+def test_sbatch_dependency(scheduler, tmp_path):
+    first_directory = str(tmp_path / "first")
+    second_directory = str(tmp_path / "second")
+
+    first_job = submit(first_directory, ["sleep 1", "echo first > first.txt"])
+    second_job = submit(second_directory, [f"cat {first_directory}/first.txt > second.txt"], dependency=first_job)
+    # The second job waits for the first one
+    assert squeue(second_job) == {second_job: "PENDING"}
+    wait_finished(first_job, second_job)
+
+    assert sacct(second_job) == {second_job: ("COMPLETED", "0:0")}
+    with open(os.path.join(second_directory, "second.txt"), "r") as f:
+        assert f.read().strip() == "first"
+
+
+def test_sbatch_dependency_failed(scheduler, tmp_path):
+    failed_job = submit(str(tmp_path / "failed"), ["false"])
+    never_job = submit(str(tmp_path / "never"), ["echo never"], dependency=failed_job)
+    wait_finished(failed_job, never_job)
+
+    assert sacct(failed_job) == {failed_job: ("FAILED", "1:0")}
+    # --kill-on-invalid-dep: the job that can no longer start is cancelled
+    assert sacct(never_job) == {never_job: ("CANCELLED", "0:0")}
+    assert not os.path.exists(os.path.join(tmp_path, "never", MANIFEST_FILENAME))
+
+
+#   ============================    In-process SSH server   ============================    #
+
+def test_slurm_backend_over_local_ssh_server(scheduler, tmp_path):
+    key = paramiko.RSAKey.generate(2048)
+    key_path = str(tmp_path / "id_rsa")
+    key.write_private_key_file(key_path)
+    authorized_keys_path = tmp_path / "authorized_keys"
+    authorized_keys_path.write_text(f"{key.get_name()} {key.get_base64()} test\n")
+    server = LocalSSHServer(str(authorized_keys_path), bin_directory=scheduler).start()
+    try:
+        backend = SlurmBackend(server.name_server, "user", key_path, os.devnull, str(tmp_path / "working"))
+        first = backend.submit("sleep 1 && echo first > first.txt", job_name="first")
+        second = backend.submit(f"cat {first.run_directory}/first.txt > second.txt", job_name="second",
+                                dependency=first.job_id)
+        failed = backend.submit("false", job_name="failed")
+        never = backend.submit("echo never", job_name="never", dependency=failed.job_id)
+
+        assert backend.wait(second, FINISH_TIMEOUT) == RUN_COMPLETED
+        assert backend.wait(never, FINISH_TIMEOUT) == RUN_CANCELLED
+        output, error, output_folder = backend.collect(second, file_patterns=["*.txt"])
+        assert os.listdir(output_folder) == ["second.txt"]
+    finally:
+        server.stop()
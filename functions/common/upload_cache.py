@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import uuid
+import shlex
+import hashlib
+import logging
+import threading
+from functions.common.sftp_transfer import upload_files
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory (inside the remote working directory) holding one blob per uploaded input, named by its sha256
+REMOTE_CACHE_DIRNAME = ".torepo_cache"
+REMOTE_CACHE_MANIFEST = "manifest.json"
+# Blobs not reused for this many days are deleted to keep the cache small
+REMOTE_CACHE_MAX_AGE_DAYS = 30
+
+_hash_memo = {}
+_hash_memo_lock = threading.Lock()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """sha256 of a local file, memoized by (path, mtime, size) so unchanged inputs are only hashed once."""
+    file_stat = os.stat(path)
+    memo_key = (os.path.realpath(path), file_stat.st_mtime_ns, file_stat.st_size)
+    with _hash_memo_lock:
+        if memo_key in _hash_memo:
+            return _hash_memo[memo_key]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+
+    with _hash_memo_lock:
+        _hash_memo[memo_key] = digest
+    return digest
+
+
+def _read_remote_manifest(sftp, manifest_path):
+    try:
+        with sftp.open(manifest_path, "r") as f:
+            return json.loads(f.read().decode())
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_remote_manifest(sftp, manifest_path, manifest, upload_token):
+    # The manifest is informative only: if a concurrent run replaced it first, its version is kept
+    partial_path = f"{manifest_path}.{upload_token}.part"
+    try:
+        with sftp.open(partial_path, "w") as f:
+            f.write(json.dumps(manifest, indent=4))
+        sftp.posix_rename(partial_path, manifest_path)
+    except IOError as e:
+        logger.info(f"Remote cache manifest not updated: {e}")
+
+
+def upload_files_cached(ssh, sftp, file_pairs, working_directory):
+    """Upload (local_path, remote_path) pairs, only sending files whose content is not already cached remotely.
+
+    Every input is stored once as <working_directory>/.torepo_cache/<sha256> and then hard-linked (or
+    copied, if the filesystem does not allow it) to its remote path. Returns the number of files reused.
+    """
+    if not file_pairs:
+        return 0
+    cache_directory = f"{working_directory}/{REMOTE_CACHE_DIRNAME}"
+    hashed_pairs = [(local_path, remote_path, file_sha256(local_path)) for local_path, remote_path in file_pairs]
+
+    # Round trip 1: prune stale blobs and list the ones still present
+    stdin, stdout, stderr = ssh.exec_command(
+        f"mkdir -p {shlex.quote(cache_directory)} && cd {shlex.quote(cache_directory)} && "
+        f"find . -maxdepth 1 -type f -name '[0-9a-f]*' -mtime +{REMOTE_CACHE_MAX_AGE_DAYS} -delete; "
+        f"ls -1")
+    cached_hashes = set(stdout.read().decode().split())
+
+    # Upload the missing blobs under a temporary name unique to this upload, so neither an interrupted
+    # upload nor two runs sending the same input at once can leave a truncated blob in the cache
+    upload_token = uuid.uuid4().hex[:8]
+    missing = {}
+    for local_path, remote_path, digest in hashed_pairs:
+        if digest not in cached_hashes and digest not in missing:
+            missing[digest] = local_path
+    if missing:
+        report = upload_files(sftp, [(local_path, f"{cache_directory}/{digest}.{upload_token}.part")
+                                     for digest, local_path in missing.items()])
+        for local_path, remote_path in report.transferred:
+            sftp.posix_rename(remote_path, remote_path[:-len(f".{upload_token}.part")])
+
+    # Round trip 2: link every blob to the path the program expects (touching it marks it as recently used)
+    link_commands = []
+    for local_path, remote_path, digest in hashed_pairs:
+        blob = shlex.quote(f"{cache_directory}/{digest}")
+        target = shlex.quote(remote_path)
+        link_commands.append(f"touch {blob} && (ln -f {blob} {target} 2>/dev/null || cp -f {blob} {target})")
+    stdin, stdout, stderr = ssh.exec_command(" && ".join(link_commands))
+    link_error = stderr.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError(f"ERROR!!! Could not place cached inputs in {working_directory}: {link_error}")
+
+    manifest_path = f"{cache_directory}/{REMOTE_CACHE_MANIFEST}"
+    manifest = _read_remote_manifest(sftp, manifest_path)
+    manifest = {digest: entry for digest, entry in manifest.items() if digest in cached_hashes}
+    for local_path, remote_path, digest in hashed_pairs:
+        entry = manifest.setdefault(digest, {"name": os.path.basename(local_path),
+                                             "size": os.path.getsize(local_path),
+                                             "uploaded": time.strftime("%Y-%m-%d %H:%M:%S")})
+        entry["last_used"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    _write_remote_manifest(sftp, manifest_path, manifest, upload_token)
+
+    reused = len(hashed_pairs) - len(missing)
+    logger.info(f"Inputs: {len(missing)} uploaded, {reused} reused from the remote cache")
+    return reused
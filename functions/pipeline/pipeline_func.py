@@ -0,0 +1,153 @@
+import os
+import shlex
+import logging
+import tempfile
+from functions.common.slurm_resources import count_atoms
+from functions.common.execution_backend import SlurmBackend, BACKEND_SLURM, RUN_COMPLETED, RUN_FAILED, RUN_CANCELLED
+from functions.common.job_store import record_run, update_run, forget_run
+from functions.common.job_engine import on_cancel, cancel_requested
+from functions.common.remote_run import new_run_id
+from functions.topology.topology_func import topology_cmd_arguments
+from functions.replicate_polymer.replicate_func import replicate_polymer_arguments
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Stages, named as the directories of example_PE and example_iPP (and of the downloaded outputs)
+PREPARE_STAGE = "01-PREPARE"
+REPLICATE_STAGE = "02-REPLICATE"
+MINIMIZATION_STAGE = "03-MINIMIZATION"
+PIPELINE_STAGES = (PREPARE_STAGE, REPLICATE_STAGE, MINIMIZATION_STAGE)
+STAGE_JOB_NAMES = {PREPARE_STAGE: "topology_job", REPLICATE_STAGE: "replicate_job",
+                   MINIMIZATION_STAGE: "minimization_job"}
+STAGE_PROGRAMS = {PREPARE_STAGE: "topology", REPLICATE_STAGE: "replicate_polymer",
+                  MINIMIZATION_STAGE: "minimization"}
+# Files brought back from each stage: intermediates stay on the cluster, in its run directory
+STAGE_DOWNLOADS = {PREPARE_STAGE: ["InfoTopology.log", "slurm.out", "slurm.err"],
+                   REPLICATE_STAGE: ["Info.log", "*_replicate.top", "slurm.out", "slurm.err"],
+                   MINIMIZATION_STAGE: ["*"]}
+MDRUN_THREADS = 8
+
+
+def run_pipeline_remote(backend, input_file, renumber_pdb, assign_residues, filemap,
+                        separate_chains, pattern, isunwrap, guess_improper,
+                        xml_file, image_x, image_y, image_z, minimization_mdp,
+                        mdengine=None, noh=False, index=None,
+                        boxlength_a=None, boxlength_b=None, boxlength_c=None,
+                        boxangle_alpha=None, boxangle_beta=None, boxangle_gamma=None,
+                        impropers=None, npairs=None, verbose=False,
+                        mdrun_threads=MDRUN_THREADS, progress_callback=None, output_callback=None):
+    """Topology -> Replicate Polymer -> GROMACS minimization as three jobs of backend (a SlurmBackend)
+    chained with afterok.
+
+    Every stage runs in its own run directory and reads the outputs of the previous one from there, on
+    the cluster, so only the inputs are uploaded and only the final artifacts (see STAGE_DOWNLOADS) are
+    downloaded.
+    """
+    pipeline_run_id = new_run_id()
+    atom_count = count_atoms(input_file)
+    image_multiplier = image_x * image_y * image_z
+
+    # The structure replicated in the next stage: topology_cmd always writes <pattern>.pdb, and renumbers
+    # it with assigned residues into <pattern>_residues.pdb when given both the HEAD TAIL and RESIDUE files
+    topology_structure = f"{pattern}_residues.pdb" if renumber_pdb and assign_residues else f"{pattern}.pdb"
+    topology_arguments = topology_cmd_arguments(input_file, renumber_pdb, assign_residues, filemap,
+                                                separate_chains, pattern, isunwrap, guess_improper)
+    replicate_arguments = replicate_polymer_arguments(topology_structure, xml_file, image_x, image_y, image_z,
+                                                      mdengine, noh, index, boxlength_a, boxlength_b, boxlength_c,
+                                                      boxangle_alpha, boxangle_beta, boxangle_gamma,
+                                                      impropers, npairs, verbose)
+    # Every input goes to the stage that reads it
+    stage_inputs = {PREPARE_STAGE: (input_file, renumber_pdb, assign_residues, filemap),
+                    REPLICATE_STAGE: (xml_file, impropers),
+                    MINIMIZATION_STAGE: (minimization_mdp,)}
+    stage_handles = {}
+    stage_accounting = {}
+
+    def submit(stage, command):
+        """Submit one stage, once the previous one (if any) has completed successfully."""
+        previous_stages = PIPELINE_STAGES[:PIPELINE_STAGES.index(stage)]
+        stage_accounting[stage] = {"program": STAGE_PROGRAMS[stage], "atom_count": atom_count,
+                                   "task_parameters": {0: (1 if stage == PREPARE_STAGE else image_multiplier,
+                                                           {"pipeline": pipeline_run_id})}}
+        stage_handles[stage] = backend.submit(
+            command, stage_inputs[stage], job_name=STAGE_JOB_NAMES[stage], accounting=stage_accounting[stage],
+            dependency=stage_handles[previous_stages[-1]].job_id if previous_stages else None)
+        return shlex.quote(stage_handles[stage].run_directory)
+
+    try:
+        prepare_directory = submit(PREPARE_STAGE, f"topology_cmd {topology_arguments}")
+        replicate_directory = submit(REPLICATE_STAGE, f"cp {prepare_directory}/{topology_structure} . && "
+                                                      f"replicate_polymer {replicate_arguments}")
+        submit(MINIMIZATION_STAGE, " && ".join([
+            f"TOP=$(ls {replicate_directory}/*_replicate.top | head -n 1)",
+            f"GRO=$(ls {replicate_directory}/*_replicate.gro | head -n 1)",
+            f"gmx grompp -f {os.path.basename(minimization_mdp)} -p $TOP -c $GRO -o new_topol.tpr -maxwarn 10 "
+            f"> out_grompp.dat 2>&1",
+            f"gmx mdrun -nt {mdrun_threads} -s new_topol.tpr -noappend -v > out_md.dat 2>&1"]))
+    except Exception:
+        # A chain missing a stage is of no use
+        for handle in stage_handles.values():
+            backend.cancel(handle)
+        raise
+
+    message = "Submitted pipeline: " + ", ".join(f"{stage} job {handle.job_id}"
+                                                 for stage, handle in stage_handles.items())
+    logger.info(message)
+    if output_callback:
+        output_callback([("stdout", message)])
+
+    # The stages are followed as one run of the job store, which collect_pipeline_outputs resumes
+    stages = []
+    for stage, handle in stage_handles.items():
+        forget_run(handle.run_id)
+        stages.append([stage, handle.run_id, handle.run_directory, handle.job_id, stage_accounting[stage]])
+    record_run(pipeline_run_id, BACKEND_SLURM, stage_handles[PREPARE_STAGE].run_directory,
+               " ".join(handle.job_id for handle in stage_handles.values()),
+               "functions.pipeline.pipeline_func.collect_pipeline_outputs",
+               {"options": backend.options, "run_id": pipeline_run_id, "stages": stages},
+               {"input_file": input_file, "xml_file": xml_file, "pattern": pattern,
+                "images": [image_x, image_y, image_z]})
+    return wait_pipeline_stages(backend, pipeline_run_id, stage_handles, progress_callback, output_callback)
+
+
+def collect_pipeline_outputs(options, run_id, stages, progress_callback=None, output_callback=None):
+    """Follow the stages of a pipeline submitted by another session and fetch their final artifacts."""
+    backend = SlurmBackend(**options)
+    stage_handles = {}
+    for stage, stage_run_id, run_directory, job_id, accounting in stages:
+        stage_handles[stage] = backend.attach(stage_run_id, run_directory, STAGE_JOB_NAMES[stage], job_id,
+                                              accounting)
+        on_cancel(lambda handle=stage_handles[stage]: backend.cancel(handle))
+    return wait_pipeline_stages(backend, run_id, stage_handles, progress_callback, output_callback)
+
+
+def wait_pipeline_stages(backend, run_id, stage_handles, progress_callback=None, output_callback=None):
+    """Wait for the stages of a pipeline, in order, and fetch their final artifacts into one folder per stage."""
+    for stage, handle in stage_handles.items():
+        backend.wait(handle)
+        message = f"{stage} (job {handle.job_id}) finished: {handle.state}"
+        logger.info(message)
+        if output_callback:
+            output_callback([("stdout", message)])
+    output = "\n".join(f"{stage}: job {handle.job_id} {handle.state}" for stage, handle in stage_handles.items())
+
+    # Stopping the job cancels every stage, whichever is running
+    if cancel_requested():
+        for handle in stage_handles.values():
+            backend.remove_run_directory(handle)
+        update_run(run_id, state=RUN_CANCELLED)
+        return output, "Pipeline cancelled", None
+
+    # The stages left after a failed one are cancelled by SLURM: collect removes their run directory
+    output_folder = tempfile.mkdtemp()
+    for stage, handle in stage_handles.items():
+        os.makedirs(os.path.join(output_folder, stage), exist_ok=True)
+        backend.collect(handle, os.path.join(output_folder, stage), progress_callback, STAGE_DOWNLOADS[stage])
+
+    failed_stages = [stage for stage, handle in stage_handles.items() if handle.state != RUN_COMPLETED]
+    error = f"Failed stages: {', '.join(failed_stages)}" if failed_stages else ""
+    update_run(run_id, state=RUN_FAILED if failed_stages else RUN_COMPLETED, output_folder=output_folder)
+    return output, error, output_folder
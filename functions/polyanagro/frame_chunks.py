@@ -0,0 +1,342 @@
+import os
+import math
+import fnmatch
+import struct
+import logging
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# First int of every XTC frame; 2023 frames store the size of their coordinates in 64 bits
+XTC_MAGIC = 1995
+XTC_MAGIC_LARGE = 2023
+# magic, natoms, step, time, box (9 floats), natoms again
+XTC_HEADER_BYTES = 56
+# precision, minint (3 ints), maxint (3 ints), smallidx
+XTC_COMPRESSION_HEADER_BYTES = 32
+# A chunk starts at the beginning of a part (instead of a cut inside one) when that is at most this
+# fraction of a chunk away from the ideal split point
+PART_BOUNDARY_TOLERANCE = 0.1
+# How the outputs of the chunks of an analysis are merged, by tool: the rule of the first pattern the
+# file name matches. Logs are concatenated; any other output is not mergeable (see merge_chunk_outputs)
+MERGE_BINNED = "binned"
+MERGE_TIME_SERIES = "time_series"
+MERGE_LOG = "log"
+MERGE_RULES = {
+    # g(r), bond/angle/dihedral distributions and phi-psi maps: every table they write is a histogram
+    "pair_distribution": [("*.dat", MERGE_BINNED)],
+    "bonded_distribution": [("*.dat", MERGE_BINNED)],
+    "2D_torsion_density_maps": [("*.dat", MERGE_BINNED)],
+    # As in example_PE/04-EQUILIBRATION/PAIR_DISTRIBUTION: one row per frame, and distributions. The
+    # autocorrelations and the gnuplot scripts (with the averages written in) are not mergeable
+    "polymer_size": [("Rg.dat", MERGE_TIME_SERIES), ("Rg_mass.dat", MERGE_TIME_SERIES),
+                     ("Ree.dat", MERGE_TIME_SERIES), ("Ree2Rg2.dat", MERGE_TIME_SERIES),
+                     ("Cn.dat", MERGE_TIME_SERIES), ("*_distribution.dat", MERGE_BINNED),
+                     ("cn_internal_distances.dat", MERGE_BINNED)],
+}
+# Column holding the time in the time series of a tool, the first one by default (polymer_size
+# starts with the frame number, which starts over in every chunk)
+TIME_COLUMNS = {"polymer_size": 1}
+
+
+def xtc_frame_offsets(path, partial=False):
+    """Byte offsets of the frames of an XTC trajectory and, last, of its end, read from the frame headers
+    without decoding any coordinates.
+
+    A truncated last frame (a trajectory still being written) is an error, unless partial is True:
+    then the offsets stop at the last complete frame.
+    """
+    offsets = [0]
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while offsets[-1] < file_size:
+            header = f.read(XTC_HEADER_BYTES)
+            complete = len(header) == XTC_HEADER_BYTES
+            if complete:
+                magic, natoms = struct.unpack(">ii", header[:8])
+                if magic not in (XTC_MAGIC, XTC_MAGIC_LARGE):
+                    raise ValueError(f"ERROR!!! {path} is not an XTC trajectory (frame {len(offsets) - 1})")
+                if natoms <= 9:
+                    # Small systems are stored uncompressed
+                    f.seek(natoms * 3 * 4, os.SEEK_CUR)
+                else:
+                    f.seek(XTC_COMPRESSION_HEADER_BYTES, os.SEEK_CUR)
+                    size_format = ">q" if magic == XTC_MAGIC_LARGE else ">i"
+                    size_bytes = f.read(struct.calcsize(size_format))
+                    complete = len(size_bytes) == struct.calcsize(size_format)
+                    if complete:
+                        byte_count, = struct.unpack(size_format, size_bytes)
+                        f.seek(byte_count + (-byte_count % 4), os.SEEK_CUR)
+            if not complete or f.tell() > file_size:
+                if partial:
+                    break
+                raise ValueError(f"ERROR!!! Truncated frame {len(offsets) - 1} in {path}")
+            offsets.append(f.tell())
+    return offsets
+
+
+def xtc_frame_count(path):
+    """Frames of an XTC trajectory (see xtc_frame_offsets)."""
+    return len(xtc_frame_offsets(path)) - 1
+
+
+def slice_xtc(path, offsets, first_frame, end_frame, output_path):
+    """Write the frames [first_frame, end_frame) of an XTC trajectory to output_path.
+
+    offsets are those of xtc_frame_offsets: frames are whole records, copied without decoding them.
+    """
+    with open(path, "rb") as source, open(output_path, "wb") as destination:
+        source.seek(offsets[first_frame])
+        remaining = offsets[end_frame] - offsets[first_frame]
+        while remaining > 0:
+            data = source.read(min(remaining, 1024 ** 2))
+            if not data:
+                raise ValueError(f"ERROR!!! {path} is shorter than its frames")
+            destination.write(data)
+            remaining -= len(data)
+    return output_path
+
+
+def partition_trajectories(paths, stride, workers, folder):
+    """Split the frames of a trajectory (one or more parts) into at most workers contiguous chunks of
+    similar size.
+
+    Returns [(chunk paths, frames analysed)] or None if the trajectory cannot be split. A chunk only
+    starts at a frame that a single run over every part would also analyse (its global index is a
+    multiple of stride), so that the chunks analyse exactly the frames a single run would. Chunks
+    start at the beginning of a part when one is close enough; otherwise the part is cut between
+    two frame records (see slice_xtc) into folder/chunk_<n>/, under its own name. Only XTC parts can
+    be split.
+    """
+    stride = stride or 1
+    if workers < 2 or not paths or not all(path.lower().endswith(".xtc") for path in paths):
+        return None
+    try:
+        part_offsets = [xtc_frame_offsets(path) for path in paths]
+    except (IOError, ValueError) as e:
+        logger.error(f"ERROR!!! Could not count the frames of the trajectory: {e}")
+        return None
+
+    # First global frame of every part, and of the end of the trajectory
+    part_starts = [0]
+    for offsets in part_offsets:
+        part_starts.append(part_starts[-1] + len(offsets) - 1)
+    total = part_starts[-1]
+
+    # The analysed frame closest to each ideal split point, or the start of a part near it
+    tolerance = PART_BOUNDARY_TOLERANCE * total / workers
+    starts = [0]
+    for number in range(1, workers):
+        target = total * number / workers
+        start = min(round(target / stride) * stride, total)
+        boundaries = [frame for frame in part_starts[1:-1] if frame % stride == 0 and abs(frame - target) <= tolerance]
+        if boundaries:
+            start = min(boundaries, key=lambda frame: abs(frame - target))
+        if starts[-1] < start < total:
+            starts.append(start)
+    if len(starts) < 2:
+        return None
+
+    chunks = []
+    for number, (first, end) in enumerate(zip(starts, starts[1:] + [total])):
+        chunk_paths = []
+        for path, offsets, part_start, part_end in zip(paths, part_offsets, part_starts, part_starts[1:]):
+            if part_end <= first or part_start >= end:
+                continue
+            if first <= part_start and part_end <= end:
+                chunk_paths.append(path)
+                continue
+            chunk_folder = os.path.join(folder, f"chunk_{number}")
+            os.makedirs(chunk_folder, exist_ok=True)
+            chunk_paths.append(slice_xtc(path, offsets, max(first - part_start, 0), min(end, part_end) - part_start,
+                                         os.path.join(chunk_folder, os.path.basename(path))))
+        chunks.append((chunk_paths, math.ceil((end - first) / stride)))
+    return chunks
+
+
+def _read_table(path):
+    """(comment lines, rows of number tokens) of a text table, None if it is not one."""
+    comments = []
+    rows = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if stripped[0] in "#@;&":
+                    comments.append(line.rstrip("\n"))
+                    continue
+                tokens = stripped.split()
+                for token in tokens:
+                    float(token)
+                rows.append(tokens)
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not rows:
+        return None
+    return comments, rows
+
+
+def _format_like(value, token):
+    """value written with the format of token (same decimals, exponent or not)."""
+    mantissa = token.lower().split("e")[0]
+    decimals = len(mantissa.split(".")[1]) if "." in mantissa else 0
+    if "e" in token.lower():
+        return f"{value:.{decimals}e}"
+    if "." in token:
+        return f"{value:.{decimals}f}"
+    return f"{value:.10g}"
+
+
+def _is_count(token):
+    return token.lstrip("+-").isdigit()
+
+
+def binned_sums(path, weight):
+    """Sums of the binned table at path, whose averages are over weight frames, None if it is not a table.
+
+    {"comments", "rows", "tokens", "weight"}: each row holds its bin, then the integers (counts) as they
+    are and the other values (averages) times weight. tokens are the rows as read, whose format the
+    merged table is written with (see write_binned_sums). The sums are JSON-serializable.
+    """
+    table = _read_table(path)
+    if table is None:
+        return None
+    comments, rows = table
+    sum_rows = [[row[0]] + [int(token) if _is_count(token) else float(token) * weight for token in row[1:]]
+                for row in rows]
+    return {"comments": comments, "rows": sum_rows, "tokens": rows, "weight": weight}
+
+
+def add_binned_sums(sums, other_sums):
+    """binned_sums of two tables over the same bins added up, None if they are not such tables.
+
+    The first column holds the bins and must be the same in both (equally long tables of anything
+    else, such as time series, are not binned outputs), and so must the counts and averages columns.
+    """
+    if [len(row) for row in sums["rows"]] != [len(row) for row in other_sums["rows"]]:
+        return None
+    merged_rows = []
+    for row, other_row in zip(sums["rows"], other_sums["rows"]):
+        if float(row[0]) != float(other_row[0]):
+            return None
+        merged_row = [row[0]]
+        for value, other_value in zip(row[1:], other_row[1:]):
+            if isinstance(value, int) != isinstance(other_value, int):
+                return None
+            merged_row.append(value + other_value)
+        merged_rows.append(merged_row)
+    return {"comments": sums["comments"], "rows": merged_rows, "tokens": other_sums["tokens"],
+            "weight": sums["weight"] + other_sums["weight"]}
+
+
+def write_binned_sums(sums, output_path):
+    """Write the table of binned_sums: the counts, and the averages over all their frames."""
+    with open(output_path, "w") as f:
+        for comment in sums["comments"]:
+            f.write(comment + "\n")
+        for row, tokens in zip(sums["rows"], sums["tokens"]):
+            values = [row[0]] + [str(value) if isinstance(value, int) else _format_like(value / sums["weight"], token)
+                                 for value, token in zip(row[1:], tokens[1:])]
+            f.write(" ".join(values) + "\n")
+
+
+def merge_binned_files(paths, weights, output_path, sums=None):
+    """Merge the same binned output of several chunks into output_path. Returns the binned_sums of the
+    merged table, None if it cannot be merged.
+
+    Integer values are counts and are summed; the other values are averages over the frames of each
+    chunk, merged by their mean weighted by those frames (see add_binned_sums). With sums (those of
+    paths[0], kept from an earlier merge) paths[0] is not read back, so no precision is lost to its format.
+    """
+    merged_sums = sums
+    for number, (path, weight) in enumerate(zip(paths, weights)):
+        if number == 0 and sums is not None:
+            continue
+        table_sums = binned_sums(path, weight)
+        if table_sums is None:
+            return None
+        merged_sums = table_sums if merged_sums is None else add_binned_sums(merged_sums, table_sums)
+        if merged_sums is None:
+            return None
+    write_binned_sums(merged_sums, output_path)
+    return merged_sums
+
+
+def concatenate_tables(paths, output_path, time_column=0):
+    """Write the rows of several numeric tables with the same columns (time series of consecutive
+    chunks) one after the other into output_path. Returns False if they are not such tables.
+
+    The time (in time_column) must keep increasing from one chunk to the next: tables that start
+    over in every chunk, such as histograms, would otherwise be stacked.
+    """
+    tables = [_read_table(path) for path in paths]
+    if any(table is None for table in tables):
+        return False
+    if len({len(row) for comments, rows in tables for row in rows}) != 1:
+        return False
+    times = [float(row[time_column]) for comments, rows in tables for row in rows]
+    if any(later <= earlier for earlier, later in zip(times, times[1:])):
+        return False
+    with open(output_path, "w") as f:
+        for comment in tables[0][0]:
+            f.write(comment + "\n")
+        for comments, rows in tables:
+            for row in rows:
+                f.write(" ".join(row) + "\n")
+    return True
+
+
+def merge_rule(tool, name, log_file_names=()):
+    """How the output name of tool is merged (see MERGE_RULES), None if it is not mergeable."""
+    if name in log_file_names or name.endswith(".log"):
+        return MERGE_LOG
+    for pattern, rule in MERGE_RULES.get(tool, []):
+        if fnmatch.fnmatchcase(name, pattern):
+            return rule
+    return None
+
+
+def merge_chunk_outputs(chunk_folders, weights, output_folder, tool, log_file_names=(), titles=None, sums=None):
+    """Merge the outputs of tool of every chunk into output_folder. Returns the names that could not be merged.
+
+    Following MERGE_RULES, binned tables are merged (see merge_binned_files) and time series are
+    concatenated (see concatenate_tables). Logs are concatenated too, each chunk under its title (None
+    for no title, "Chunk n of m" by default). Any other file, or one that turns out not to be what its
+    rule expects, is taken from the first chunk that has it and reported. sums holds the binned_sums of
+    binned outputs of the first folder by name, used instead of those files; it is updated with the
+    sums of the merged ones.
+    """
+    names = sorted({name for folder in chunk_folders for name in os.listdir(folder)
+                    if os.path.isfile(os.path.join(folder, name))})
+    not_merged = []
+    for name in names:
+        paths = [os.path.join(folder, name) for folder in chunk_folders]
+        output_path = os.path.join(output_folder, name)
+        present = [(path, weight) for path, weight in zip(paths, weights) if os.path.exists(path)]
+        rule = merge_rule(tool, name, log_file_names)
+        if rule == MERGE_LOG:
+            with open(output_path, "w") as output_file:
+                for number, (path, weight) in enumerate(present):
+                    title = titles[paths.index(path)] if titles else f"Chunk {number + 1} of {len(present)}"
+                    if title:
+                        output_file.write(f"#   ====  {title} ({weight} frames)  ====    #\n")
+                    with open(path, "r", errors="replace") as f:
+                        output_file.write(f.read())
+            continue
+        if len(present) == len(paths):
+            merged_sums = merge_binned_files(paths, weights, output_path, (sums or {}).get(name)) \
+                if rule == MERGE_BINNED else None
+            if merged_sums is not None:
+                if sums is not None:
+                    sums[name] = merged_sums
+                continue
+            if rule == MERGE_TIME_SERIES and concatenate_tables(paths, output_path, TIME_COLUMNS.get(tool, 0)):
+                continue
+        with open(present[0][0], "rb") as source, open(output_path, "wb") as destination:
+            destination.write(source.read())
+        not_merged.append(name)
+    return not_merged
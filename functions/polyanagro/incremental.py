@@ -0,0 +1,132 @@
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import logging
+from functions.polyanagro.result_cache import normalized_command
+from functions.polyanagro.frame_chunks import xtc_frame_offsets, slice_xtc, merge_rule, binned_sums, MERGE_BINNED
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Accumulated outputs of incremental analyses, next to the results in the directory of the outputs
+INCREMENTAL_DIRNAME = ".polyanagro_incremental"
+STATE_FILENAME = "state.json"
+OUTPUTS_DIRNAME = "outputs"
+# Stands for the trajectory in the command that identifies an incremental analysis
+TRAJECTORY_PLACEHOLDER = "__trajectory__"
+
+
+def incremental_directory(build_command, traj_files, results_folder):
+    """Directory of the state of the incremental analysis build_command(traj_files) (see
+    run_polyanagro_incremental), None if it cannot be identified.
+
+    It depends on the options, the content of the other inputs and the first trajectory part, not on
+    the parts added since.
+    """
+    command, input_files = build_command(TRAJECTORY_PLACEHOLDER)
+    words = normalized_command(command, [path for path in input_files if path != TRAJECTORY_PLACEHOLDER])
+    if words is None:
+        return None
+    words.append(os.path.basename(traj_files.split()[0]))
+    key = hashlib.sha256(json.dumps(words).encode()).hexdigest()
+    return os.path.join(results_folder, INCREMENTAL_DIRNAME, key)
+
+
+def trajectory_parts(paths):
+    """[{"path", "name", "offsets", "frames", "head"}] of the complete frames of some XTC parts.
+
+    head is the sha256 of the first frame: a part rewritten since the last run has another one.
+    """
+    parts = []
+    for path in paths:
+        offsets = xtc_frame_offsets(path, partial=True)
+        with open(path, "rb") as f:
+            head = hashlib.sha256(f.read(offsets[1] if len(offsets) > 1 else 0)).hexdigest()
+        parts.append({"path": path, "name": os.path.basename(path), "offsets": offsets,
+                      "frames": len(offsets) - 1, "head": head})
+    return parts
+
+
+def load_state(state_directory):
+    try:
+        with open(os.path.join(state_directory, STATE_FILENAME), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def resume_frame(state, parts, stride):
+    """Frame (over every part) from which the analysis of state goes on, 0 if it must start over
+    because the trajectory is not the one it has analysed followed by new frames."""
+    if state is None or state.get("stride") != stride:
+        return 0
+    if len(parts) < len(state["parts"]):
+        return 0
+    for previous, part in zip(state["parts"], parts):
+        if previous["name"] != part["name"] or previous["head"] != part["head"]:
+            return 0
+        if part["frames"] < previous["frames"]:
+            return 0
+    # Only the last part analysed may have grown: the earlier ones must be whole
+    if any(part["frames"] != previous["frames"] for previous, part in zip(state["parts"][:-1], parts)):
+        return 0
+    return state["frame_cursor"]
+
+
+def new_frame_files(parts, first_frame, folder):
+    """Files with the frames of the parts from first_frame on (over every part), written into folder.
+
+    Parts that are wholly new are used as they are; the others are cut to their new frames, and the
+    last one to the frames counted, as it may still grow while the analysis runs.
+    """
+    files = []
+    frames_before = 0
+    for number, part in enumerate(parts):
+        start = max(first_frame - frames_before, 0)
+        frames_before += part["frames"]
+        if start >= part["frames"]:
+            continue
+        if start == 0 and number < len(parts) - 1:
+            files.append(part["path"])
+        else:
+            files.append(slice_xtc(part["path"], part["offsets"], start, part["frames"],
+                                   os.path.join(folder, part["name"])))
+    return files
+
+
+def first_analysed_frame(frame_cursor, stride):
+    """First frame from frame_cursor on that a single run with stride would analyse."""
+    return math.ceil(frame_cursor / stride) * stride
+
+
+def output_sums(folder, tool, weight):
+    """binned_sums of the binned outputs of tool in folder (see MERGE_RULES), by name."""
+    sums = {}
+    for name in os.listdir(folder):
+        if merge_rule(tool, name) == MERGE_BINNED:
+            table_sums = binned_sums(os.path.join(folder, name), weight)
+            if table_sums is not None:
+                sums[name] = table_sums
+    return sums
+
+
+def save_state(state_directory, parts, stride, command, analysed, outputs_folder, sums=None):
+    """Keep the outputs accumulated so far, the sums and counts of their binned tables (see binned_sums)
+    and the frames they cover; returns the new state."""
+    state = {"command": command, "stride": stride, "frame_cursor": sum(part["frames"] for part in parts),
+             "analysed": analysed, "sums": sums or {}, "updated": time.time(),
+             "parts": [{"name": part["name"], "frames": part["frames"], "head": part["head"]} for part in parts]}
+    partial_directory = f"{state_directory}.part"
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    shutil.copytree(outputs_folder, os.path.join(partial_directory, OUTPUTS_DIRNAME))
+    with open(os.path.join(partial_directory, STATE_FILENAME), "w") as f:
+        json.dump(state, f, indent=4)
+    # Renamed into place, so that an interrupted update leaves the previous state
+    shutil.rmtree(state_directory, ignore_errors=True)
+    os.rename(partial_directory, state_directory)
+    return state
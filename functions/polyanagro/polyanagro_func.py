@@ -0,0 +1,461 @@
+import streamlit as st
+import os
+import re
+import math
+import time
+import shlex
+import base64
+import shutil
+import logging
+import tempfile
+from functions.common.common_functions import create_tar_gz, render_output_box
+from functions.common.execution_backend import (get_local_backend, RUN_PENDING, RUN_COMPLETED, RUN_PRIORITY_HIGH,
+                                                RUN_PRIORITY_NORMAL, RUN_PRIORITY_LOW)
+from functions.polyanagro.result_cache import result_key, load_result, store_result
+from functions.polyanagro.frame_chunks import partition_trajectories, merge_chunk_outputs
+from functions.polyanagro.incremental import (incremental_directory, trajectory_parts, load_state, resume_frame,
+                                              first_analysed_frame, new_frame_files, output_sums, save_state,
+                                              OUTPUTS_DIRNAME)
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the status of the runs of a job
+STATUS_INTERVAL = 0.5
+# Bytes read from the end of the log of a running tool to find how far it has got
+LOG_TAIL_BYTES = 8192
+
+# Quick inspections go before the passes over whole trajectories when the local pool is busy
+POLYANAGRO_PRIORITIES = {
+    "info_trj": RUN_PRIORITY_HIGH,
+    "energy_analysis": RUN_PRIORITY_HIGH,
+    "neighbor_sphere": RUN_PRIORITY_HIGH,
+    "pair_distribution": RUN_PRIORITY_LOW,
+    "bonded_distribution": RUN_PRIORITY_LOW,
+    "2D_torsion_density_maps": RUN_PRIORITY_LOW,
+    "polymer_size": RUN_PRIORITY_LOW,
+}
+
+# Progress lines of the tools: "45%", "Frame 10 of 200", "10/200 frames"...
+PROGRESS_PERCENT = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+BATCH_EXIT_LINE = re.compile(r"^(\S+): exit (\d+)$", re.M)
+PROGRESS_COUNTS = [re.compile(r"\b(?:frame|step|snapshot|configuration)s?\s+(\d+)\s*(?:of|/)\s*(\d+)", re.I),
+                   re.compile(r"\b(\d+)\s*(?:of|/)\s*(\d+)\s+(?:frame|step|snapshot|configuration)s?\b", re.I)]
+
+
+def input_names(paths):
+    """Base names of a field with one or more paths separated by spaces, as seen from the run directory
+    and quoted for the shell."""
+    return " ".join(shlex.quote(os.path.basename(path)) for path in paths.split())
+
+
+def shell_words(value):
+    """A value typed by the user as shell words: its spaces still separate arguments, but each word is
+    quoted, so nothing else in it is interpreted by the shell."""
+    return " ".join(shlex.quote(word) for word in str(value).split())
+
+
+def input_paths(*fields):
+    """Every path of the given fields (empty ones skipped), to be staged next to the command."""
+    return [path for field in fields if field for path in field.split()]
+
+
+def tool_name(command):
+    """Name of the polyanagro tool a command runs (the script name for `python script.py ...`)."""
+    words = command.split()
+    if words[0].startswith("python") and len(words) > 1:
+        return os.path.splitext(os.path.basename(words[1]))[0]
+    return words[0]
+
+
+def parse_log_progress(text):
+    """Fraction (0 to 1) of the work done according to the last progress line of text, None if there is none."""
+    for line in reversed(text.splitlines()):
+        for pattern in PROGRESS_COUNTS:
+            match = pattern.search(line)
+            if match and int(match.group(2)) > 0:
+                return min(int(match.group(1)) / int(match.group(2)), 1.0)
+        match = PROGRESS_PERCENT.search(line)
+        if match:
+            return min(float(match.group(1)) / 100, 1.0)
+    return None
+
+
+def _log_file_names(command):
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return []
+    return [words[index + 1] for index, word in enumerate(words[:-1]) if word == "--log"]
+
+
+def _read_log_tail(run_directory, log_file_name):
+    """End of the log of a run of this workstation ("" if it is elsewhere or not written yet)."""
+    for name in (log_file_name, f"{log_file_name}.log"):
+        path = os.path.join(run_directory, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                f.seek(max(0, os.path.getsize(path) - LOG_TAIL_BYTES))
+                return f.read().decode(errors="replace")
+    return ""
+
+
+def _run_progress(run_directory, log_file_names, recent_output):
+    """Mean progress of the tools of a run that report one in their log, else the progress in its output."""
+    progresses = [parse_log_progress(_read_log_tail(run_directory, name)) for name in log_file_names]
+    progresses = [progress for progress in progresses if progress is not None]
+    if progresses:
+        return sum(progresses) / len(progresses)
+    return parse_log_progress("\n".join(recent_output))
+
+
+def _report(output_callback, message):
+    """Log a message of a polyanagro job and add it to the output of the job."""
+    logger.info(message)
+    if output_callback:
+        output_callback([("stdout", message)])
+    return message
+
+
+def _wait_runs(backend, handles, name, log_file_names, recent_output, output_callback=None):
+    """Wait for some runs to finish, adding to the output of the job where they stand: their place in
+    the queue of the local pool, then how far the tools have got according to their logs or output.
+
+    The runs are not cancelled here: the STOP button of the job and its time limit cancel them through
+    the callbacks the backend registered when they were submitted (see JobEngine).
+    """
+    started = time.time()
+    last_status = None
+    while not all(handle.wait(STATUS_INTERVAL) for handle in handles):
+        running = [handle for handle in handles if handle.state != RUN_PENDING]
+        if not running:
+            position = backend.queue_position(handles[0]) if hasattr(backend, "queue_position") else None
+            status = f"{name} is waiting for a free core" + (f", {position} runs ahead" if position else "")
+        else:
+            progresses = [_run_progress(handle.run_directory, log_file_names, recent_output)
+                          if not handle.is_finished else 1.0 for handle in handles]
+            chunks = f", {len(running)} of {len(handles)} chunks started" if len(handles) > 1 else ""
+            if any(progress is None for progress in progresses):
+                status = f"Running {name}{chunks}"
+            else:
+                # In steps of 10%, so that the output is not flooded with status lines
+                progress = math.floor(sum(progresses) / len(progresses) * 10) / 10
+                status = f"Running {name}: {progress:.0%}{chunks}"
+        if status != last_status:
+            _report(output_callback, f"{status} ({time.time() - started:.0f} s)")
+            last_status = status
+
+
+def _cached_result(key, name, output_callback=None):
+    """(output, error, output_folder) of the cached result of key in a new folder, None on a miss."""
+    output_folder = tempfile.mkdtemp()
+    cached = load_result(key, output_folder)
+    if not cached:
+        shutil.rmtree(output_folder, ignore_errors=True)
+        return None
+    note = _report(output_callback, f"{name}: same inputs and options as a run of "
+                                    f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(cached['created']))}, "
+                                    f"its results are reused")
+    return f"{note}\n{cached['output']}", cached["error"], output_folder
+
+
+def run_polyanagro_command(command, input_files=(), backend=None, job_name=None, priority=None, use_cache=True,
+                           progress_callback=None, output_callback=None):
+    """Run a polyanagro command on backend (the process pool of this workstation by default).
+
+    Meant to be submitted to the JobEngine, which passes the two callbacks: returns the (output, error,
+    output_folder) of the command, output_folder a new folder with its outputs (None if it was cancelled).
+
+    The command waits for a free core of the pool shared by every session, the quick tools first
+    (see POLYANAGRO_PRIORITIES); meanwhile the output of the job tells where it stands (see _wait_runs).
+    The STOP button of the job and its time limit cancel the run, and its outputs are not fetched.
+
+    The outputs of a successful run are kept in the result cache: the same command over inputs with
+    the same content is not run again (unless use_cache is False), its outputs are copied back.
+    """
+    backend = backend or get_local_backend()
+    name = job_name or tool_name(command)
+    key = result_key(command, input_files) if use_cache else None
+    cached = _cached_result(key, name, output_callback)
+    if cached:
+        return cached
+    log_file_names = _log_file_names(command)
+    if priority is None:
+        priority = POLYANAGRO_PRIORITIES.get(name, RUN_PRIORITY_NORMAL)
+    recent_output = []
+
+    def keep_output(lines):
+        recent_output[:] = (recent_output + [line for stream, line in lines])[-50:]
+        if output_callback:
+            output_callback(lines)
+
+    handle = backend.submit(command, input_files, job_name=name, output_callback=keep_output,
+                            priority=priority)
+    _wait_runs(backend, [handle], name, log_file_names, recent_output, output_callback)
+
+    output, error, output_folder = backend.collect(handle, progress_callback=progress_callback)
+    if output_folder is not None and handle.state == RUN_COMPLETED:
+        try:
+            store_result(key, command, output, error, output_folder)
+        except Exception as e:
+            logger.error(f"ERROR!!! Could not keep the result of {name} in the cache: {e}")
+    return output, error, output_folder
+
+
+def _copy_files(folder, destination):
+    for file_name in os.listdir(folder):
+        shutil.copy2(os.path.join(folder, file_name), os.path.join(destination, file_name))
+
+
+def _run_parts(backend, commands, name, log_file_names, output_callback=None):
+    """Submit every (command, input_files, job_name) at once, wait for them (see _wait_runs) and collect
+    each run into a new temporary folder.
+
+    Returns (output, error, folders, failed_folder): failed_folder is None if every run completed,
+    else the outputs of the first one that did not ("" if it has none).
+    """
+    priority = POLYANAGRO_PRIORITIES.get(name, RUN_PRIORITY_NORMAL)
+    handles = [backend.submit(command, input_files, job_name=job_name, output_callback=output_callback,
+                              priority=priority)
+               for command, input_files, job_name in commands]
+    _wait_runs(backend, handles, name, log_file_names, [], output_callback)
+
+    folders = []
+    outputs = []
+    errors = []
+    failed_folder = None
+    for handle in handles:
+        folders.append(tempfile.mkdtemp())
+        output, error, output_folder = backend.collect(handle, output_folder=folders[-1])
+        outputs.append(output)
+        if error:
+            errors.append(error)
+        if handle.state != RUN_COMPLETED and failed_folder is None:
+            failed_folder = output_folder or ""
+    return "\n".join(outputs), "\n".join(errors), folders, failed_folder
+
+
+def run_polyanagro_chunked(build_command, traj_files, stride=None, workers=1, backend=None, job_name=None,
+                           progress_callback=None, output_callback=None):
+    """Run a histogram analysis as up to workers runs over contiguous chunks of the trajectory, at the
+    same time, and merge their binned outputs (see frame_chunks) into the output folder of the job.
+
+    build_command(traj_files) returns the (command, input_files) of the analysis over some parts of
+    the trajectory (traj_files, space separated). A trajectory that cannot be split (not XTC, too
+    few frames...) runs as one command. Returns (output, error, output_folder) like run_polyanagro_command.
+    """
+    command, input_files = build_command(traj_files)
+    name = job_name or tool_name(command)
+    if not workers or workers < 2:
+        return run_polyanagro_command(command, input_files, backend, job_name=job_name,
+                                      progress_callback=progress_callback, output_callback=output_callback)
+    # Cached like the single run over the whole trajectory: the merged outputs are the same
+    key = result_key(command, input_files)
+    cached = _cached_result(key, name, output_callback)
+    if cached:
+        return cached
+
+    # Parts cut between two frames for the chunks, kept until every chunk has run
+    slice_folder = tempfile.mkdtemp()
+    try:
+        chunks = partition_trajectories(traj_files.split(), stride, workers, slice_folder)
+        if chunks is None:
+            note = _report(output_callback, f"{name}: the trajectory cannot be split into chunks (only XTC "
+                                            f"trajectories with enough frames can), it runs unchunked")
+            output, error, output_folder = run_polyanagro_command(command, input_files, backend, job_name=job_name,
+                                                                  progress_callback=progress_callback,
+                                                                  output_callback=output_callback)
+            return f"{note}\n{output}", error, output_folder
+        return _run_chunks(build_command, command, key, chunks, name, backend, output_callback)
+    finally:
+        shutil.rmtree(slice_folder, ignore_errors=True)
+
+
+def _run_chunks(build_command, command, key, chunks, name, backend, output_callback=None):
+    """Run the chunks of run_polyanagro_chunked, merge their outputs into a new folder and keep them in
+    the result cache under key."""
+    backend = backend or get_local_backend()
+    log_file_names = _log_file_names(command)
+
+    _report(output_callback, f"{name} split into {len(chunks)} chunks of "
+                             f"{', '.join(str(frames) for _, frames in chunks)} frames")
+    commands = [build_command(" ".join(chunk_files)) + (f"{name} ({number + 1}/{len(chunks)})",)
+                for number, (chunk_files, frames) in enumerate(chunks)]
+    output, error, fetch_folders, failed_folder = _run_parts(backend, commands, name, log_file_names,
+                                                             output_callback)
+
+    output_folder = None
+    if failed_folder:
+        # The outputs (and log) of the first chunk that failed tell why
+        output_folder = tempfile.mkdtemp()
+        _copy_files(failed_folder, output_folder)
+    elif failed_folder is None:
+        output_folder = tempfile.mkdtemp()
+        not_merged = merge_chunk_outputs(fetch_folders, [frames for _, frames in chunks], output_folder,
+                                         tool_name(command), log_file_names)
+        if not_merged:
+            logger.error(f"ERROR!!! {name}: {', '.join(not_merged)} could not be merged, taken from the first chunk")
+            error += f"\nNot merged (taken from the first chunk): {', '.join(not_merged)}"
+        else:
+            try:
+                store_result(key, command, output, error, output_folder)
+            except Exception as e:
+                logger.error(f"ERROR!!! Could not keep the result of {name} in the cache: {e}")
+    for fetch_folder in fetch_folders:
+        shutil.rmtree(fetch_folder, ignore_errors=True)
+    return output, error, output_folder
+
+
+def run_polyanagro_incremental(build_command, traj_files, stride=None, backend=None, job_name=None,
+                               progress_callback=None, output_callback=None):
+    """Run an analysis over the frames added to a growing XTC trajectory since its last run, and
+    merge them into the outputs accumulated so far (see incremental and frame_chunks).
+
+    build_command is that of run_polyanagro_chunked. The accumulated outputs, the sums and counts of
+    their binned tables, the frames they cover and the number analysed are kept in INCREMENTAL_DIRNAME
+    of the current directory; the merged outputs go to the output folder of the job. Only the outputs
+    of MERGE_RULES are updated, the others are kept from the last run and reported. The analysis starts
+    over when the options, the other inputs or the frames already analysed have changed. A trajectory
+    that is not XTC runs as one command. Returns (output, error, output_folder) like run_polyanagro_command.
+    """
+    stride = stride or 1
+    command, input_files = build_command(traj_files)
+    paths = traj_files.split()
+    state_directory = incremental_directory(build_command, traj_files, os.getcwd())
+    try:
+        parts = trajectory_parts(paths) if state_directory and all(path.lower().endswith(".xtc")
+                                                                   for path in paths) else None
+    except (IOError, ValueError) as e:
+        logger.error(f"ERROR!!! Could not count the frames of the trajectory: {e}")
+        parts = None
+    if parts is None:
+        note = _report(output_callback, "Only XTC trajectories can be analysed incrementally, the whole "
+                                        "trajectory is analysed")
+        output, error, output_folder = run_polyanagro_command(command, input_files, backend, job_name=job_name,
+                                                              progress_callback=progress_callback,
+                                                              output_callback=output_callback)
+        return f"{note}\n{output}", error, output_folder
+
+    backend = backend or get_local_backend()
+    name = job_name or tool_name(command)
+    log_file_names = _log_file_names(command)
+    notes = []
+    state = load_state(state_directory)
+    frame_cursor = resume_frame(state, parts, stride)
+    if state and not frame_cursor:
+        notes.append(_report(output_callback, f"{name}: the trajectory or the options have changed since the "
+                                              f"last run, starting over"))
+    previous_analysed = state["analysed"] if frame_cursor else 0
+    first_frame = first_analysed_frame(frame_cursor, stride)
+    total_frames = sum(part["frames"] for part in parts)
+    output_folder = tempfile.mkdtemp()
+    if first_frame >= total_frames:
+        notes.append(_report(output_callback, f"{name}: no new frames since the last run "
+                                              f"({previous_analysed} frames analysed)"))
+        _copy_files(os.path.join(state_directory, OUTPUTS_DIRNAME), output_folder)
+        return "\n".join(notes), "", output_folder
+
+    new_analysed = math.ceil((total_frames - first_frame) / stride)
+    slice_folder = tempfile.mkdtemp()
+    try:
+        new_files = new_frame_files(parts, first_frame, slice_folder)
+        new_command, new_inputs = build_command(" ".join(new_files))
+        notes.append(_report(output_callback, f"{name}: analysing frames {first_frame} to {total_frames - 1} "
+                                              f"({previous_analysed} frames analysed before)"))
+        output, error, fetch_folders, failed_folder = _run_parts(backend, [(new_command, new_inputs, name)], name,
+                                                                 log_file_names, output_callback)
+    finally:
+        shutil.rmtree(slice_folder, ignore_errors=True)
+
+    if failed_folder:
+        _copy_files(failed_folder, output_folder)
+    elif failed_folder is None:
+        if previous_analysed:
+            added = time.strftime("%Y-%m-%d %H:%M")
+            # The binned tables are added to their sums, not to the rounded values of the last outputs
+            sums = dict(state.get("sums") or {})
+            not_merged = merge_chunk_outputs([os.path.join(state_directory, OUTPUTS_DIRNAME), fetch_folders[0]],
+                                             [previous_analysed, new_analysed], output_folder, tool_name(command),
+                                             log_file_names,
+                                             titles=[None, f"Frames {first_frame}-{total_frames - 1}, {added}"],
+                                             sums=sums)
+        else:
+            _copy_files(fetch_folders[0], output_folder)
+            sums = output_sums(output_folder, tool_name(command), new_analysed)
+            not_merged = []
+        if not_merged:
+            logger.error(f"ERROR!!! {name}: {', '.join(not_merged)} could not be merged, kept from the last run")
+            error += f"\nNot merged (kept from the last run): {', '.join(not_merged)}"
+        save_state(state_directory, parts, stride, command, previous_analysed + new_analysed, output_folder, sums)
+        notes.append(_report(output_callback, f"{name}: {new_analysed} new frames analysed, "
+                                              f"{previous_analysed + new_analysed} in all"))
+    else:
+        # Cancelled before it wrote anything
+        shutil.rmtree(output_folder, ignore_errors=True)
+        output_folder = None
+    for fetch_folder in fetch_folders:
+        shutil.rmtree(fetch_folder, ignore_errors=True)
+    return "\n".join(notes + [output]), error, output_folder
+
+
+def batch_command(commands):
+    """One command running every {name: command} one after the other, in the same run directory.
+
+    The tools run in turn, so that the batch takes the one core of the local pool it was given. Each
+    tool writes to batch_<name>.out and batch_<name>.err. The combined command prints one
+    "<name>: exit <code>" line per tool and fails if any of them did.
+    """
+    lines = ["batch_status=0"]
+    lines += [f"( {command} ) > batch_{name}.out 2> batch_{name}.err; code=$?; echo \"{name}: exit $code\"; "
+              f"[ $code -eq 0 ] || batch_status=1" for name, command in commands.items()]
+    lines.append("[ $batch_status -eq 0 ]")
+    return "; ".join(lines)
+
+
+def parse_batch_output(output):
+    """{name: exit code} from the output of batch_command."""
+    return {match.group(1): int(match.group(2)) for match in BATCH_EXIT_LINE.finditer(output)}
+
+
+def run_polyanagro_batch(commands, input_files=(), backend=None, progress_callback=None, output_callback=None):
+    """Run several polyanagro tools over the same inputs as one run (see batch_command).
+
+    The inputs are staged once, but each tool reads and decodes the trajectory itself: the frames are
+    not shared between them. Returns (output, error, output_folder) like run_polyanagro_command; the
+    exit code of each tool is in the output (see parse_batch_output).
+    """
+    return run_polyanagro_command(batch_command(commands), input_files, backend,
+                                  job_name=f"batch of {len(commands)} analyses", priority=RUN_PRIORITY_LOW,
+                                  progress_callback=progress_callback, output_callback=output_callback)
+
+
+def show_polyanagro_results(job):
+    """Outputs of a finished polyanagro job (see show_jobs_panel): a link to download them all as
+    <job name>.tar.gz, the output of the job and the content of its logs."""
+    output, error, output_folder = job.result
+    if not output_folder:
+        # Nothing was fetched: a run reported as cancelled, or one that produced no outputs
+        st.warning(f"No output files to show. {error}".strip())
+        return
+    st.success("JOB DONE!!!")
+    if error:
+        st.warning(error)
+
+    output_file_paths = sorted(os.path.join(output_folder, f) for f in os.listdir(output_folder)
+                               if f != "output_files.tar.gz")
+    tar_file_path = create_tar_gz(output_folder, output_file_paths)
+    download_link = (f'<a href="data:application/tar+gzip;base64,'
+                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
+                     f'" download="{job.name}.tar.gz">'
+                     f'Download {job.name} compressed file</a>')
+    st.markdown(download_link, unsafe_allow_html=True)
+    render_output_box(st.empty(), output)
+
+    # The tools may add the extension to the log name themselves
+    for log_file_path in [path for path in output_file_paths if path.endswith(".log")]:
+        st.write(f"### {os.path.basename(log_file_path)}")
+        with open(log_file_path, "r", errors="replace") as f:
+            st.text_area("File content:", value=f.read(), height=300,
+                         key=f"polyanagro_log_{job.job_id}_{os.path.basename(log_file_path)}")
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import shlex
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from functions.common.upload_cache import file_sha256
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Outputs of finished polyanagro runs, one directory per (tool, input contents, options)
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".torepo", "polyanagro_cache")
+# The least recently used results are evicted once the cache is larger than this
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+ENTRY_FILENAME = "entry.json"
+OUTPUTS_DIRNAME = "outputs"
+
+_cache_lock = threading.Lock()
+
+
+def _is_option(word):
+    return word.startswith("-") and len(word) > 1 and not word[1].isdigit() and word[1] != "."
+
+
+def normalized_command(command, input_files):
+    """The command as a list of words where every input is replaced by the sha256 of its content and
+    the options are sorted, or None if it reads something that cannot be hashed (a directory).
+
+    Inputs are the base names of input_files (as staged next to the command) or paths of local files.
+    """
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    inputs = {os.path.basename(path): path for path in input_files if path}
+
+    def normalize(word):
+        path = inputs.get(word, word)
+        if os.path.isdir(path):
+            raise IsADirectoryError(path)
+        if word in inputs or (os.path.isabs(path) and os.path.isfile(path)):
+            return f"sha256:{file_sha256(path)}"
+        return word
+
+    try:
+        words = [normalize(word) for word in words]
+    except (IsADirectoryError, OSError):
+        return None
+
+    # Tool and positional arguments first, then the options (each with its values) in a fixed order
+    head = []
+    options = []
+    for word in words:
+        if _is_option(word):
+            options.append([word])
+        elif options:
+            options[-1].append(word)
+        else:
+            head.append(word)
+    return head + [word for option in sorted(options) for word in option]
+
+
+def result_key(command, input_files):
+    """Key of the cached result of command run over input_files, None if it cannot be cached."""
+    words = normalized_command(command, input_files)
+    if words is None:
+        return None
+    return hashlib.sha256(json.dumps(words).encode()).hexdigest()
+
+
+def _entry_directory(key, cache_dir):
+    return os.path.join(cache_dir, key)
+
+
+def _read_entry(entry_directory):
+    try:
+        with open(os.path.join(entry_directory, ENTRY_FILENAME), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_entry(entry_directory, entry):
+    partial_path = os.path.join(entry_directory, f"{ENTRY_FILENAME}.part")
+    with open(partial_path, "w") as f:
+        json.dump(entry, f, indent=4)
+    os.replace(partial_path, os.path.join(entry_directory, ENTRY_FILENAME))
+
+
+def load_result(key, destination, cache_dir=RESULT_CACHE_DIR):
+    """Copy the cached outputs of key into destination and return their entry, None on a miss."""
+    if key is None:
+        return None
+    with _cache_lock:
+        entry_directory = _entry_directory(key, cache_dir)
+        entry = _read_entry(entry_directory)
+        if entry is None:
+            return None
+        try:
+            for name in entry["files"]:
+                shutil.copy2(os.path.join(entry_directory, OUTPUTS_DIRNAME, name), os.path.join(destination, name))
+        except IOError as e:
+            logger.error(f"ERROR!!! Cached result {key} is incomplete, discarding it: {e}")
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            return None
+        entry["last_used"] = time.time()
+        _write_entry(entry_directory, entry)
+    logger.info(f"Result of '{entry['command']}' taken from the cache")
+    return entry
+
+
+def store_result(key, command, output, error, output_folder, cache_dir=RESULT_CACHE_DIR,
+                 max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Keep the files of output_folder as the result of key, then evict down to max_bytes."""
+    if key is None:
+        return
+    file_names = sorted(name for name in os.listdir(output_folder)
+                        if os.path.isfile(os.path.join(output_folder, name)))
+    size = sum(os.path.getsize(os.path.join(output_folder, name)) for name in file_names)
+    if size > max_bytes:
+        logger.info(f"Result of '{command}' ({size} bytes) is larger than the whole cache, not kept")
+        return
+
+    with _cache_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Built aside and renamed, so that a half-written entry is never read
+        partial_directory = tempfile.mkdtemp(dir=cache_dir, prefix=".part-")
+        os.makedirs(os.path.join(partial_directory, OUTPUTS_DIRNAME))
+        for name in file_names:
+            shutil.copy2(os.path.join(output_folder, name), os.path.join(partial_directory, OUTPUTS_DIRNAME, name))
+        now = time.time()
+        _write_entry(partial_directory, {"key": key, "tool": command.split()[0], "command": command,
+                                         "output": output, "error": error, "files": file_names, "size": size,
+                                         "created": now, "last_used": now})
+        entry_directory = _entry_directory(key, cache_dir)
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        os.rename(partial_directory, entry_directory)
+        _evict(cache_dir, max_bytes)
+
+
+def _evict(cache_dir, max_bytes):
+    entries = list_results(cache_dir)
+    total = sum(entry["size"] for entry in entries)
+    for entry in sorted(entries, key=lambda entry: entry["last_used"]):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(_entry_directory(entry["key"], cache_dir), ignore_errors=True)
+        total -= entry["size"]
+        logger.info(f"Evicted cached result of '{entry['command']}' ({entry['size']} bytes)")
+
+
+def list_results(cache_dir=RESULT_CACHE_DIR):
+    """Entries of the cached results, most recently used first."""
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = [_read_entry(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)
+               if not name.startswith(".")]
+    return sorted((entry for entry in entries if entry), key=lambda entry: entry["last_used"], reverse=True)
+
+
+def forget_result(key, cache_dir=RESULT_CACHE_DIR):
+    with _cache_lock:
+        shutil.rmtree(_entry_directory(key, cache_dir), ignore_errors=True)
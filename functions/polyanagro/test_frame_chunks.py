@@ -0,0 +1,227 @@
+import os
+import json
+import struct
+import pytest
+from functions.polyanagro.frame_chunks import (xtc_frame_offsets, xtc_frame_count, partition_trajectories,
+                                               merge_binned_files, merge_chunk_outputs, merge_rule, XTC_MAGIC,
+                                               XTC_MAGIC_LARGE, MERGE_BINNED, MERGE_LOG)
+
+
+def xtc_frame(step, natoms=3, magic=XTC_MAGIC, compressed_bytes=5):
+    """One XTC frame record: coordinates stored as floats for natoms <= 9, else a compressed block."""
+    header = struct.pack(">iiif9fi", magic, natoms, step, float(step), *([1.0] * 9), natoms)
+    if natoms <= 9:
+        return header + struct.pack(f">{natoms * 3}f", *([0.5] * natoms * 3))
+    size = struct.pack(">q" if magic == XTC_MAGIC_LARGE else ">i", compressed_bytes)
+    return header + bytes(32) + size + bytes(compressed_bytes + (-compressed_bytes % 4))
+
+
+def write_xtc(path, steps, **frame_options):
+    with open(path, "wb") as f:
+        for step in steps:
+            f.write(xtc_frame(step, **frame_options))
+    return str(path)
+
+
+def frame_steps(paths):
+    """Steps of the frames of some XTC parts, one after the other."""
+    steps = []
+    for path in paths:
+        offsets = xtc_frame_offsets(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        steps += [struct.unpack(">i", data[offset + 8:offset + 12])[0] for offset in offsets[:-1]]
+    return steps
+
+
+def write_table(path, rows, comments=()):
+    with open(path, "w") as f:
+        for comment in comments:
+            f.write(comment + "\n")
+        for row in rows:
+            f.write(" ".join(row) + "\n")
+    return str(path)
+
+
+def read_rows(path):
+    with open(path, "r") as f:
+        return [line.split() for line in f if not line.startswith("#")]
+
+
+#   ============================    XTC frames   ============================    #
+
+@pytest.mark.parametrize("frame_options", [{"natoms": 3}, {"natoms": 20, "compressed_bytes": 7},
+                                           {"natoms": 20, "magic": XTC_MAGIC_LARGE, "compressed_bytes": 9}])
+def test_xtc_frame_offsets(tmp_path, frame_options):
+    frame_size = len(xtc_frame(0, **frame_options))
+    path = write_xtc(tmp_path / "traj.xtc", range(4), **frame_options)
+
+    assert xtc_frame_offsets(path) == [number * frame_size for number in range(5)]
+    assert xtc_frame_count(path) == 4
+
+
+def test_xtc_frame_offsets_truncated(tmp_path):
+    path = write_xtc(tmp_path / "traj.xtc", range(3))
+    with open(path, "ab") as f:
+        f.write(xtc_frame(3)[:30])
+
+    with pytest.raises(ValueError):
+        xtc_frame_offsets(path)
+    assert len(xtc_frame_offsets(path, partial=True)) == 4
+
+
+def test_xtc_frame_offsets_not_xtc(tmp_path):
+    path = tmp_path / "traj.xtc"
+    path.write_bytes(bytes(100))
+
+    with pytest.raises(ValueError):
+        xtc_frame_offsets(str(path))
+
+
+#   ============================    Partition   ============================    #
+
+def test_partition_single_file(tmp_path):
+    path = write_xtc(tmp_path / "traj.xtc", range(100))
+    folder = tmp_path / "slices"
+    folder.mkdir()
+
+    chunks = partition_trajectories([path], 3, 4, str(folder))
+
+    assert len(chunks) == 4
+    # Together the chunks hold every frame once, each one starting at a frame a single run analyses
+    chunk_steps = [frame_steps(chunk_paths) for chunk_paths, frames in chunks]
+    assert sum(chunk_steps, []) == list(range(100))
+    assert all(steps[0] % 3 == 0 for steps in chunk_steps)
+    assert [frames for chunk_paths, frames in chunks] == [-(-len(steps) // 3) for steps in chunk_steps]
+    assert sum(frames for chunk_paths, frames in chunks) == 34
+    assert all(os.path.basename(chunk_paths[0]) == "traj.xtc" for chunk_paths, frames in chunks)
+
+
+def test_partition_keeps_whole_parts(tmp_path):
+    paths = [write_xtc(tmp_path / f"part{number}.xtc", range(number * 50, number * 50 + 50)) for number in range(2)]
+
+    chunks = partition_trajectories(paths, 2, 2, str(tmp_path))
+
+    assert chunks == [([paths[0]], 25), ([paths[1]], 25)]
+
+
+def test_partition_cuts_parts(tmp_path):
+    paths = [write_xtc(tmp_path / f"part{number}.xtc", range(number * 30, number * 30 + 30)) for number in range(3)]
+    folder = tmp_path / "slices"
+    folder.mkdir()
+
+    chunks = partition_trajectories(paths, 1, 2, str(folder))
+
+    assert [frame_steps(chunk_paths) for chunk_paths, frames in chunks] == [list(range(45)), list(range(45, 90))]
+    assert chunks[0][0][0] == paths[0]
+    assert chunks[1][0][-1] == paths[2]
+
+
+def test_partition_cannot_split(tmp_path):
+    path = write_xtc(tmp_path / "traj.xtc", range(3))
+
+    assert partition_trajectories([path], 1, 1, str(tmp_path)) is None
+    assert partition_trajectories([path], 5, 4, str(tmp_path)) is None
+    assert partition_trajectories([str(tmp_path / "traj.dcd")], 1, 4, str(tmp_path)) is None
+
+
+#   ============================    Merge   ============================    #
+
+def test_merge_binned_files_three_chunks(tmp_path):
+    # bin, count, constant float, average
+    chunks = [[["0.5", "1", "2.0", "1.000"], ["1.5", "4", "2.0", "3.000"]],
+              [["0.5", "2", "2.0", "2.000"], ["1.5", "4", "2.0", "3.000"]],
+              [["0.5", "3", "2.0", "4.000"], ["1.5", "4", "2.0", "6.000"]]]
+    paths = [write_table(tmp_path / f"rdf_{number}.dat", rows, ["# r count norm g(r)"])
+             for number, rows in enumerate(chunks)]
+    output_path = str(tmp_path / "rdf.dat")
+
+    assert merge_binned_files(paths, [10, 10, 20], output_path)
+    # Equal integer counts are summed too, not taken from the first chunk
+    assert read_rows(output_path) == [["0.5", "6", "2.0", "2.750"], ["1.5", "12", "2.0", "4.500"]]
+
+
+def test_merge_binned_files_different_bins(tmp_path):
+    paths = [write_table(tmp_path / "a.dat", [["0.0", "1.0"], ["1.0", "2.0"]]),
+             write_table(tmp_path / "b.dat", [["2.0", "1.0"], ["3.0", "2.0"]])]
+
+    assert not merge_binned_files(paths, [1, 1], str(tmp_path / "merged.dat"))
+
+
+def test_merge_binned_files_with_sums(tmp_path):
+    # Averages written with one decimal, merged as an incremental analysis does: 0.0 (1 frame), 0.1 (2 frames)
+    # and 0.0 (3 frames) average 0.033, but 0.067 was written as 0.1 after the second chunk
+    merged_path = str(tmp_path / "merged.dat")
+    sums = merge_binned_files([write_table(tmp_path / "a.dat", [["0.5", "1", "0.0"]])], [1], merged_path)
+    for number, (count, average, frames) in enumerate([("2", "0.1", 2), ("3", "0.0", 3)]):
+        # The sums are kept in the JSON state between runs
+        sums = json.loads(json.dumps(sums))
+        new_path = write_table(tmp_path / f"new{number}.dat", [["0.5", count, average]])
+        sums = merge_binned_files([merged_path, new_path], [sums["weight"], frames], merged_path, sums)
+
+    assert read_rows(merged_path) == [["0.5", "6", "0.0"]]
+    assert sums["weight"] == 6
+
+
+def test_merge_chunk_outputs(tmp_path):
+    folders = [tmp_path / f"chunk{number}" for number in range(2)]
+    for folder in folders:
+        folder.mkdir()
+    # A time series goes on in the second chunk, a distribution with other bins starts over
+    write_table(folders[0] / "Rg.dat", [["0", "0.0", "1.0"], ["1", "10.0", "1.1"]])
+    write_table(folders[1] / "Rg.dat", [["0", "20.0", "1.2"], ["1", "30.0", "1.3"]])
+    write_table(folders[0] / "Rg_distribution.dat", [["0.0", "1"], ["0.5", "2"]])
+    write_table(folders[1] / "Rg_distribution.dat", [["0.0", "3"], ["0.5", "4"], ["1.0", "1"]])
+    # Binned, but an output of polymer_size that is not known to be mergeable
+    for folder in folders:
+        write_table(folder / "e2acf.dat", [["0.0", "1.0"], ["1.0", "0.5"]])
+    output_folder = tmp_path / "merged"
+    output_folder.mkdir()
+
+    not_merged = merge_chunk_outputs([str(folder) for folder in folders], [2, 2], str(output_folder), "polymer_size")
+
+    assert not_merged == ["Rg_distribution.dat", "e2acf.dat"]
+    assert read_rows(output_folder / "Rg.dat") == [["0", "0.0", "1.0"], ["1", "10.0", "1.1"],
+                                                   ["0", "20.0", "1.2"], ["1", "30.0", "1.3"]]
+    assert read_rows(output_folder / "Rg_distribution.dat") == [["0.0", "1"], ["0.5", "2"]]
+
+
+def test_merge_chunk_outputs_unknown_tool(tmp_path):
+    folders = [tmp_path / f"chunk{number}" for number in range(2)]
+    for folder in folders:
+        folder.mkdir()
+        write_table(folder / "hist.dat", [["0.0", "1"], ["0.5", "2"]])
+    output_folder = tmp_path / "merged"
+    output_folder.mkdir()
+
+    assert merge_chunk_outputs([str(folder) for folder in folders], [1, 1], str(output_folder),
+                               "info_trj") == ["hist.dat"]
+    assert merge_rule("pair_distribution", "hist.dat") == MERGE_BINNED
+    assert merge_rule("pair_distribution", "pol_rdf.log") == MERGE_LOG
+
+
+def test_merge_chunk_outputs_example_pe(tmp_path):
+    """Outputs of polymer_size in example_PE (its PAIR_DISTRIBUTION directory), split at a second frame."""
+    example_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  "example_PE", "04-EQUILIBRATION", "PAIR_DISTRIBUTION")
+    if not os.path.isdir(example_folder):
+        pytest.skip("example_PE is not there")
+    second_chunk = tmp_path / "chunk1"
+    second_chunk.mkdir()
+    for name in os.listdir(example_folder):
+        with open(os.path.join(example_folder, name), "r") as f:
+            content = f.read()
+        # The frame of the second chunk comes 10 ps later
+        (second_chunk / name).write_text(content.replace("0.000      1025.", "10.000      1025."))
+    output_folder = tmp_path / "merged"
+    output_folder.mkdir()
+
+    not_merged = merge_chunk_outputs([example_folder, str(second_chunk)], [1, 1], str(output_folder),
+                                     "polymer_size", log_file_names=["test"])
+
+    assert not_merged == ["gnuplot_charratio.gnu", "gnuplot_dimensions.gnu", "gnuplot_distributions.gnu"]
+    assert read_rows(output_folder / "Rg.dat") == [["0", "0.000", "1025.01", "64.57", "3.579"],
+                                                   ["0", "10.000", "1025.01", "64.57", "3.579"]]
+    assert [row[1] for row in read_rows(output_folder / "Rg_mass.dat")] == ["0.000", "10.000"]
+    with open(output_folder / "test", "r") as f:
+        assert f.read().count("Polymer size calculations") == 2
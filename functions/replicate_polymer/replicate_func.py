@@ -1,11 +1,11 @@
 import streamlit as st
-import paramiko
 import tempfile
 import os
-import time
 import logging
 import shutil
 from tkinter import filedialog
+from functions.common.slurm_resources import count_atoms
+from functions.common.execution_backend import SSHDirectBackend, SlurmBackend
 
 
 # Logger configuration
@@ -13,10 +13,38 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def upload_file_to_server(ssh, local_path, remote_path):
-    sftp = ssh.open_sftp()
-    sftp.put(local_path, remote_path)
-    sftp.close()
+def replicate_polymer_arguments(structure_file, xml_file, image_x, image_y, image_z,
+                                mdengine=None, noh=False, index=None,
+                                boxlength_a=None, boxlength_b=None, boxlength_c=None,
+                                boxangle_alpha=None, boxangle_beta=None, boxangle_gamma=None,
+                                impropers=None, npairs=None, verbose=False):
+    """replicate_polymer options for inputs in the current directory (the run directory of every backend)."""
+    arguments = (f"-p {os.path.basename(structure_file)} -f {os.path.basename(xml_file)}"
+                 f" --images {image_x} {image_y} {image_z}")
+    if mdengine:
+        arguments += f" -e {mdengine}"
+    if noh:
+        arguments += " --noh"
+    if index:
+        arguments += f" --index {index}"
+    if boxlength_a and boxlength_b and boxlength_c:
+        arguments += f" --boxlength {boxlength_a} {boxlength_b} {boxlength_c}"
+    if boxangle_alpha and boxangle_beta and boxangle_gamma:
+        arguments += f" --boxangle {boxangle_alpha} {boxangle_beta} {boxangle_gamma}"
+    if impropers:
+        arguments += f" --impropers {os.path.basename(impropers)}"
+    if npairs:
+        arguments += f" --npairs {npairs}"
+    if verbose:
+        arguments += " --verbose"
+    return arguments
+
+
+def replicate_accounting(structure_file, image_x, image_y, image_z, parameters=None):
+    """What the job history records about a replicate_polymer run (see record_slurm_accounting)."""
+    parameters = dict(parameters or {}, images=[image_x, image_y, image_z])
+    return {"program": "replicate_polymer", "atom_count": count_atoms(structure_file),
+            "task_parameters": {0: (image_x * image_y * image_z, parameters)}}
 
 
 def run_replicate_cmd_remote(name_server, name_user, ssh_key_options, path_virtualenv,
@@ -25,294 +53,109 @@ def run_replicate_cmd_remote(name_server, name_user, ssh_key_options, path_virtu
                              mdengine, noh, index,
                              boxlength_a, boxlength_b, boxlength_c,
                              boxangle_alpha, boxangle_beta, boxangle_gamma,
-                             impropers, npairs, verbose):
-
-    activate_virtualenv = f"source {path_virtualenv}"
-
-    # Navigate to the remote working directory before running the command
-    command = (f"cd {working_directory} && replicate_polymer -p {working_directory}/{os.path.basename(structure_file)}"
-               f" -f {working_directory}/{os.path.basename(xml_file)}"
-               f" --images {working_directory}/{image_x}"
-               f" {working_directory}/{image_y}"
-               f" {working_directory}/{image_z}")
-
+                             impropers, npairs, verbose, backend=None, progress_callback=None,
+                             output_callback=None):
+    """Run replicate_polymer on backend (straight over SSH on the server by default) and fetch its outputs."""
+    backend = backend or SSHDirectBackend(name_server, name_user, ssh_key_options, path_virtualenv,
+                                          working_directory)
+    arguments = replicate_polymer_arguments(structure_file, xml_file, image_x, image_y, image_z,
+                                            mdengine, noh, index, boxlength_a, boxlength_b, boxlength_c,
+                                            boxangle_alpha, boxangle_beta, boxangle_gamma,
+                                            impropers, npairs, verbose)
+    return backend.run(f"replicate_polymer {arguments}", [structure_file, xml_file, impropers],
+                       job_name="replicate_job",
+                       accounting=replicate_accounting(structure_file, image_x, image_y, image_z,
+                                                       {"npairs": npairs, "noh": noh}),
+                       progress_callback=progress_callback, output_callback=output_callback)
+
+
+def parse_sweep_values(text, group_size=1, cast=float):
+    """Parse "2,2,2; 3,3,3" (group_size 3) or "1 2 3" (group_size 1) into a list of tuples or values."""
+    groups = [group for group in text.replace("\n", ";").split(";") if group.strip()]
+    if group_size == 1:
+        return [cast(value) for group in groups for value in group.replace(",", " ").split()]
+
+    values = []
+    for group in groups:
+        fields = group.replace(",", " ").split()
+        if len(fields) != group_size:
+            raise ValueError(f"ERROR!!! '{group.strip()}' must have {group_size} values")
+        values.append(tuple(cast(field) for field in fields))
+    return values
+
+
+def build_replicate_sweep(images, boxlengths=None, npairs=None):
+    """Every combination of images (x, y, z), box lengths (a, b, c) and npairs, one dict per array task."""
+    return [{"images": image, "boxlength": boxlength, "npairs": npair}
+            for image in images
+            for boxlength in (boxlengths or [None])
+            for npair in (npairs or [None])]
+
+
+# Arguments of every task of a sweep, one line per task, next to the shared inputs
+SWEEP_ARGUMENTS_FILENAME = "sweep_arguments.txt"
+
+
+def sweep_image_multiplier(task):
+    image_x, image_y, image_z = task["images"]
+    return image_x * image_y * image_z
+
+
+def _sweep_task_arguments(task):
+    arguments = "--images {} {} {}".format(*task["images"])
+    if task["boxlength"]:
+        arguments += " --boxlength {} {} {}".format(*task["boxlength"])
+    if task["npairs"] is not None:
+        arguments += f" --npairs {task['npairs']}"
+    return arguments
+
+
+def run_replicate_sweep_remote(name_server, name_user, ssh_key_options, path_virtualenv,
+                               working_directory, structure_file, xml_file, sweep,
+                               mdengine=None, noh=False, index=None,
+                               boxangle_alpha=None, boxangle_beta=None, boxangle_gamma=None,
+                               impropers=None, verbose=False, backend=None,
+                               progress_callback=None, output_callback=None):
+    """Run every parameter set of a sweep (see build_replicate_sweep) as one SLURM job array on backend.
+
+    The shared inputs are staged once in the run directory, task i runs in task_<i>/ with the
+    arguments on line i+1 of sweep_arguments.txt (copied to task_<i>/task_arguments.txt), and all
+    the outputs are fetched in bulk when the array has finished, keeping the task_<i>/ layout.
+    """
+    backend = backend or SlurmBackend(name_server, name_user, ssh_key_options, path_virtualenv, working_directory)
+
+    # Options shared by all the tasks, whose inputs are in the run directory above theirs
+    shared_options = ""
     if mdengine:
-        command += f" -e {working_directory}/{mdengine}"
+        shared_options += f" -e {mdengine}"
     if noh:
-        command += f" --noh"
+        shared_options += " --noh"
     if index:
-        command += f" --index {working_directory}/{index}"
-    if boxlength_a and boxlength_b and boxlength_c:
-        command += (f" --boxlength {working_directory}/{boxlength_a}"
-                    f" {working_directory}/{boxlength_b}"
-                    f" {working_directory}/{boxlength_c}")
+        shared_options += f" --index {index}"
     if boxangle_alpha and boxangle_beta and boxangle_gamma:
-        command += (f" --boxangle {working_directory}/{boxangle_alpha}"
-                    f" {working_directory}/{boxangle_beta}"
-                    f" {working_directory}/{boxangle_gamma}")
+        shared_options += f" --boxangle {boxangle_alpha} {boxangle_beta} {boxangle_gamma}"
     if impropers:
-        command += f" --impropers {working_directory}/{os.path.basename(impropers)}"
-    if npairs:
-        command += f" --npairs {working_directory}/{npairs}"
+        shared_options += f" --impropers ../{os.path.basename(impropers)}"
     if verbose:
-        command += f" --verbose"
-
-    full_command = f"{activate_virtualenv} && {command}"
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(name_server, username=name_user, key_filename=ssh_key_options)
-
-    # Upload input files to the remote server's working directory
-    upload_file_to_server(ssh, structure_file, f"{working_directory}/{os.path.basename(structure_file)}")
-    upload_file_to_server(ssh, xml_file, f"{working_directory}/{os.path.basename(xml_file)}")
-
-    if impropers:
-        upload_file_to_server(ssh, impropers, f"{working_directory}/{os.path.basename(impropers)}")
-
-    # Execute command in the remote server
-    stdin, stdout, stderr = ssh.exec_command(full_command)
-
-    # Read output and errors of the command
-    output = stdout.read().decode()
-    error = stderr.read().decode()
-
-    # Download generated files from remote server
-    sftp = ssh.open_sftp()
-    output_folder = tempfile.mkdtemp()
-    os.makedirs(output_folder, exist_ok=True)
-
-    # File list to download
-    output_files = ["allatom_idx_replicate.dat",
-                    "backbone_idx_replicate.dat",
-                    "listendtoend_replicate.dat",
-                    "Info.log"]
-
-    structure_file_name = os.path.splitext(os.path.basename(structure_file))[0]
-
-    if noh:
-        if not mdengine:
-            output_files.extend([f"{structure_file_name}_noH.gro",
-                                 f"{structure_file_name}_noH.pdb",
-                                 f"{structure_file_name}_noH.top",
-                                 f"{structure_file_name}_noH_replicate.gro",
-                                 f"{structure_file_name}_noH_replicate.pdb",
-                                 f"{structure_file_name}_noH_replicate.top"])
-        else:
-            output_files.extend([f"{structure_file_name}_noH_replicate_clean.inp",
-                                 f"{structure_file_name}_noH_replicate_clean.lmp",
-                                 f"{structure_file_name}_noH.gro",
-                                 f"{structure_file_name}_noH.pdb",
-                                 f"{structure_file_name}_noH.top",
-                                 f"{structure_file_name}_noH_replicate.gro",
-                                 f"{structure_file_name}_noH_replicate.pdb",
-                                 f"{structure_file_name}_noH_replicate.top"])
-
-    # Check and download each output file
-    for file in output_files:
-        remote_file_path = f"{working_directory}/{file}"
-        local_file_path = os.path.join(output_folder, file)
-        try:
-            sftp.stat(remote_file_path)  # Check if the file exists
-            sftp.get(remote_file_path, local_file_path)
-        except FileNotFoundError:
-            logger.error(f"File not found in {working_directory}: {file}")
-
-            # Check if Info.log exists in the home directory and is recently modified
-            if file == "Info.log":
-                command_find_file = f"find $HOME -name {file} -mmin -10 2>/dev/null"
-                stdin, stdout, stderr = ssh.exec_command(command_find_file)
-                find_results = stdout.read().decode().splitlines()
-                find_errors = stderr.read().decode().splitlines()
-
-                if find_errors:
-                    logger.error(f"Find command errors: {find_errors}")
-
-                if find_results:
-                    remote_file_path_home = find_results[0]
-                    try:
-                        sftp.stat(remote_file_path_home)
-                        sftp.get(remote_file_path_home, local_file_path)
-                        logger.info(f"Successfully downloaded {file} from {remote_file_path_home}")
-                    except FileNotFoundError:
-                        logger.error(f"File not found in home directory: {file}")
-                else:
-                    logger.error(f"No recent 'Info.log' found in home directory")
-
-                # Check if allatom_idx_replicate.dat exists in the home directory and is recently modified
-                if file == "allatom_idx_replicate.dat":
-                    command_find_file = f"find $HOME -name {file} -mmin -10 2>/dev/null"
-                    stdin, stdout, stderr = ssh.exec_command(command_find_file)
-                    find_results = stdout.read().decode().splitlines()
-                    find_errors = stderr.read().decode().splitlines()
-
-                    if find_errors:
-                        logger.error(f"Find command errors: {find_errors}")
-
-                    if find_results:
-                        remote_file_path_home = find_results[0]
-                        try:
-                            sftp.stat(remote_file_path_home)
-                            sftp.get(remote_file_path_home, local_file_path)
-                            logger.info(f"Successfully downloaded {file} from {remote_file_path_home}")
-                        except FileNotFoundError:
-                            logger.error(f"File not found in home directory: {file}")
-                    else:
-                        logger.error(f"No recent 'allatom_idx_replicate.dat' found in home directory")
-
+        shared_options += " --verbose"
+    command = (f'task_arguments=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" ../{SWEEP_ARGUMENTS_FILENAME})'
+               f' && echo "$task_arguments" > task_arguments.txt'
+               f" && replicate_polymer -p ../{os.path.basename(structure_file)}"
+               f" -f ../{os.path.basename(xml_file)} $task_arguments{shared_options}")
+    accounting = {"program": "replicate_polymer", "atom_count": count_atoms(structure_file),
+                  "task_parameters": {task_number: (sweep_image_multiplier(task), task)
+                                      for task_number, task in enumerate(sweep)}}
+
+    temp_dir = tempfile.mkdtemp()
     try:
-        sftp.remove(f"{working_directory}/{os.path.basename(structure_file)}")
-        sftp.remove(f"{working_directory}/{os.path.basename(xml_file)}")
-        # if impropers is not None:
-        #     sftp.remove(f"{working_directory}/{os.path.basename(impropers)}")
-
-    except FileNotFoundError:
-        logger.error(f"File {os.path.basename(structure_file)} not found in remote directory")
-        logger.error(f"File {os.path.basename(xml_file)} not found in remote directory")
-        logger.error(f"File {os.path.basename(impropers)} not found in remote directory")
-
-    sftp.close()
-    ssh.close()
-
-    return output, error, output_folder
-
-
-def run_replicate_cmd_remote_with_partition(name_server, name_user, ssh_key_options, path_virtualenv,
-                                            input_file, renumber_pdb, assign_residues, filemap,
-                                            separate_chains, pattern, isunwrap, guess_improper,
-                                            working_directory, submit_with=None,
-                                            check_status=None, script_before_run="", script_after_run=""):
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(name_server, username=name_user, key_filename=ssh_key_options)
-
-    temp_dir = None
-
-    try:
-        # Create local temporal working directory
-        temp_dir = tempfile.mkdtemp()
-        output_folder = os.path.join(temp_dir, "output")
-        os.makedirs(output_folder, exist_ok=True)
-        print(f"Temporary directory created: {temp_dir}")
-        print(f"Using output folder: {output_folder}")
-
-        # Create SLURM script
-        slurm_script_path = os.path.join(temp_dir, "slurm_job.sh")
-        slurm_script_content = "#!/bin/bash\n"
-        slurm_script_content += "#SBATCH --job-name=topology_job\n"
-        slurm_script_content += "#SBATCH --output=topology_job.out\n"
-        slurm_script_content += "#SBATCH --error=topology_job.err\n"
-        if submit_with:
-            slurm_script_content += f"#SBATCH --{submit_with}\n"
-
-        # Add the script before job run
-        if script_before_run:
-            slurm_script_content += script_before_run + "\n"
-
-        # Commands to activate the virtual environment and execute the program
-        slurm_script_content += f"source {path_virtualenv}\n"
-        slurm_script_content += "export LD_LIBRARY_PATH=/usr/lib/x86_64-linux-gnu:$LD_LIBRARY_PATH\n"
-        slurm_script_content += f"cd {working_directory}\n"
-        slurm_script_content += f"topology_cmd -i {os.path.basename(input_file)}"
-
-        if renumber_pdb:
-            slurm_script_content += f" -r {os.path.basename(renumber_pdb)}"
-        if assign_residues:
-            slurm_script_content += f" -a {os.path.basename(assign_residues)}"
-        if filemap:
-            slurm_script_content += f" --filemap {os.path.basename(filemap)}"
-        if separate_chains:
-            slurm_script_content += " --separate_chains"
-        if pattern:
-            slurm_script_content += f" -p {pattern}"
-        if isunwrap:
-            slurm_script_content += " -w"
-        if guess_improper:
-            slurm_script_content += " --guess_improper"
-
-        # # Add the script after job run
-        if script_after_run:
-            slurm_script_content += "\n" + script_after_run + "\n"
-
-        with open(slurm_script_path, "w") as slurm_script:
-            slurm_script.write(slurm_script_content)
-
-        # Upload SLURM script and needed files to remote server
-        upload_file_to_server(ssh, slurm_script_path, f"{working_directory}/slurm_job.sh")
-        upload_file_to_server(ssh, input_file, f"{working_directory}/{os.path.basename(input_file)}")
-        if renumber_pdb:
-            upload_file_to_server(ssh, renumber_pdb, f"{working_directory}/{os.path.basename(renumber_pdb)}")
-        if assign_residues:
-            upload_file_to_server(ssh, assign_residues, f"{working_directory}/{os.path.basename(assign_residues)}")
-        if filemap:
-            upload_file_to_server(ssh, filemap, f"{working_directory}/{os.path.basename(filemap)}")
-
-        # Execute SLURM script using SBATCH
-        stdin, stdout, stderr = ssh.exec_command(f"cd {working_directory} && sbatch slurm_job.sh")
-        job_submission_output = stdout.read().decode()
-        job_submission_error = stderr.read().decode()
-
-        if job_submission_error:
-            return f"Error submitting job: {job_submission_error}", "", temp_dir
-        else:
-            job_id = job_submission_output.strip().split()[-1]
-
-        if check_status:
-            while True:
-                stdin, stdout, stderr = ssh.exec_command(f"squeue -j {job_id}")
-                job_status_output = stdout.read().decode()
-                if job_id not in job_status_output:
-                    break
-                time.sleep(10)
-
-        # Download output files
-        sftp = ssh.open_sftp()
-        output_files = [f"{pattern}.pdb", "topology_job.out", "topology_job.err", "InfoTopology.log"]
-        if assign_residues:
-            output_files.extend([f"{pattern}_residues.gro", f"{pattern}_residues.pdb", f"{pattern}_residues.psf"])
-        if renumber_pdb and not assign_residues:
-            output_files.extend([f"{pattern}_renumber.gro", f"{pattern}_renumber.pdb", f"{pattern}_renumber.psf"])
-        if separate_chains:
-            separate_chains_files = sftp.listdir(working_directory)
-            separate_chains_files = [f for f in separate_chains_files if f.startswith(pattern) and f.endswith('.pdb')]
-            output_files.extend(separate_chains_files)
-
-        for file in output_files:
-            remote_file_path = f"{working_directory}/{file}"
-            local_file_path = os.path.join(output_folder, file)
-            try:
-                sftp.stat(remote_file_path)
-                sftp.get(remote_file_path, local_file_path)
-            except FileNotFoundError:
-                print(f"File not found: {file}")
-
-        # try:
-        #     sftp.remove(f"{working_directory}/{os.path.basename(input_file)}")
-        #     if renumber_pdb is not None:
-        #         sftp.remove(f"{working_directory}/{os.path.basename(renumber_pdb)}")
-        #     if assign_residues is not None:
-        #         sftp.remove(f"{working_directory}/{os.path.basename(assign_residues)}")
-        #     if filemap is not None:
-        #         sftp.remove(f"{working_directory}/{os.path.basename(filemap)}")
-        #
-        # except FileNotFoundError:
-        #     logger.error(f"File {os.path.basename(input_file)} not found in remote directory")
-        #     logger.error(f"File {os.path.basename(renumber_pdb)} not found in remote directory")
-        #     logger.error(f"File {os.path.basename(assign_residues)} not found in remote directory")
-        #     logger.error(f"File {os.path.basename(filemap)} not found in remote directory")
-
-        sftp.close()
-        print("Job Done!")
-        print(f"Output folder content: {os.listdir(output_folder)}")
-        return "Job completed successfully", "", output_folder
-
+        arguments_path = os.path.join(temp_dir, SWEEP_ARGUMENTS_FILENAME)
+        with open(arguments_path, "w") as arguments_file:
+            arguments_file.write("".join(f"{_sweep_task_arguments(task)}\n" for task in sweep))
+        return backend.run(command, [structure_file, xml_file, impropers, arguments_path],
+                           job_name="replicate_sweep", accounting=accounting, task_count=len(sweep),
+                           progress_callback=progress_callback, output_callback=output_callback)
     finally:
-        # If exists temporal directory, remove it
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            print(f"Temporary directory removed: {temp_dir}")
-        ssh.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 def handle_button_click(option, input_key, action):
@@ -362,8 +205,13 @@ def reset_replicate_options():
     st.session_state.noh = False
     st.session_state.verbose = False
 
+    st.session_state.sweep_mode = False
+    st.session_state.sweep_images = "1,1,1"
+    st.session_state.sweep_boxlengths = ""
+    st.session_state.sweep_npairs = ""
+
 
-def show_info_log_content(output_file_paths):
+def show_info_log_content(output_file_paths, key=None):
 
     # Check if 'Info.log' is present in the output file list
     info_replicate_log_path = next((path for path in output_file_paths if "Info.log" in path), None)
@@ -372,7 +220,7 @@ def show_info_log_content(output_file_paths):
         st.write(f"### {os.path.basename(info_replicate_log_path)}")
         with open(info_replicate_log_path, "r") as output_file:
             file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
+            st.text_area("File content:", value=file_content, height=300, key=key)
     else:
         st.error("'Info.log' not found in the output files")
         return
@@ -1,9 +1,59 @@
 import streamlit as st
 import json
+import time
+import shlex
+import logging
+import threading
 import paramiko
+from functions.common.ssh_pool import get_ssh_client, exec_remote_command
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Python snippet run on the server to gather every fact about the remote environment in one round trip
+REMOTE_PROBE_SCRIPT = """
+import json, os, shutil, socket, subprocess, sys
+path_virtualenv, working_directory = sys.argv[1], sys.argv[2]
+bin_directory = os.path.dirname(path_virtualenv)
+try:
+    cpu_count = len(os.sched_getaffinity(0))
+except AttributeError:
+    cpu_count = os.cpu_count()
+env = {
+    "hostname": socket.gethostname(),
+    "cpu_count": cpu_count,
+    "virtualenv_exists": os.path.isfile(path_virtualenv),
+    "working_directory_exists": os.path.isdir(working_directory),
+    "working_directory_writable": os.path.isdir(working_directory) and os.access(working_directory, os.W_OK),
+    "free_disk_bytes": None,
+    "quota": None,
+    "slurm": dict((cmd, shutil.which(cmd) is not None) for cmd in ("sbatch", "squeue", "sinfo")),
+    "programs": dict((cmd, os.access(os.path.join(bin_directory, cmd), os.X_OK))
+                     for cmd in ("topology_cmd", "replicate_polymer")),
+}
+if env["working_directory_exists"]:
+    env["free_disk_bytes"] = shutil.disk_usage(working_directory).free
+if shutil.which("quota"):
+    try:
+        process = subprocess.Popen(["quota", "-s"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        env["quota"] = process.communicate(timeout=10)[0].decode().strip() or None
+    except Exception:
+        pass
+print(json.dumps(env))
+"""
+
+# Seconds a validation result for one server-options tuple is reused across Streamlit reruns
+VALIDATION_CACHE_TTL = 300
+
+_validation_cache = {}
+_validation_cache_lock = threading.Lock()
 
 
 def reset_server_options():
+    invalidate_server_validation(st.session_state.get("validated_server_key"))
+    st.session_state.validated_server_key = None
     st.session_state.server_options = {}
     st.session_state.json_filename = ""
     st.session_state.input_placeholder = ""
@@ -34,10 +84,8 @@ def save_options_to_json(name_server, name_user, ssh_key_options, path_virtualen
 
 def check_username_and_name_server(name_server, name_user, ssh_key_options):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(name_server, username=name_user, key_filename=ssh_key_options, timeout=0.5)
-        ssh.close()
+        # The connection stays in the pool and is reused by the following checks and runs
+        get_ssh_client(name_server, name_user, ssh_key_options, timeout=0.5)
         return True  # Succesfull conection
     except paramiko.AuthenticationException:
         return False
@@ -47,27 +95,79 @@ def check_username_and_name_server(name_server, name_user, ssh_key_options):
         return False
 
 
-def verify_virtualenv_path(name_server, name_user, ssh_key_options, path_virtualenv):
-    """Verifies if the virtual environment path exists on the remote server."""
+def probe_remote_environment(name_server, name_user, ssh_key_options, path_virtualenv, working_directory):
+    """Gathers virtualenv, working directory, disk, SLURM, program and CPU facts with a single remote command.
+
+    Returns a dictionary, or None if the probe could not be run or parsed.
+    """
+
+    python_args = (f"-c {shlex.quote(REMOTE_PROBE_SCRIPT)} "
+                   f"{shlex.quote(path_virtualenv)} {shlex.quote(working_directory)}")
+    venv_python = shlex.quote(f"{path_virtualenv.rsplit('/', 1)[0]}/python")
+    command = (f"for py in {venv_python} python3 python; do "
+               f"if command -v $py >/dev/null 2>&1; then exec $py {python_args}; fi; done; "
+               f"echo 'No python interpreter found' >&2; exit 1")
+
+    output, error = exec_remote_command(name_server, name_user, ssh_key_options, command)
+    try:
+        return json.loads(output)
+    except ValueError:
+        logger.error(f"ERROR!!! Remote environment probe failed: {error.strip()}")
+        return None
+
+
+def validate_server_options(name_server, name_user, ssh_key_options, path_virtualenv, working_directory):
+    """Runs the remote checks.
+
+    Returns (error_message, remote_environment); error_message is None if the server options are valid.
+    """
+
+    if not check_username_and_name_server(name_server, name_user, ssh_key_options):
+        return (f"ERROR!!! Name server '{name_server}'"
+                f" or username '{name_user}' do not exist. Please, check them"), None
+
+    remote_environment = probe_remote_environment(name_server, name_user, ssh_key_options,
+                                                  path_virtualenv, working_directory)
+    if remote_environment is None:
+        return "ERROR!!! Could not inspect the remote environment (is python available on the server?)", None
+
+    if not remote_environment["virtualenv_exists"]:
+        return (f"ERROR!!! Virtual environment path '{path_virtualenv}' does not exist on the remote server",
+                remote_environment)
+
+    if not remote_environment["working_directory_exists"]:
+        return f"ERROR!!! Working directory '{working_directory}' does not exist", remote_environment
+
+    if not remote_environment["working_directory_writable"]:
+        return f"ERROR!!! Working directory '{working_directory}' is not writable", remote_environment
+
+    return None, remote_environment
+
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(name_server, username=name_user, key_filename=ssh_key_options)
+def get_server_validation(server_key, ttl=VALIDATION_CACHE_TTL):
+    """Returns the cached (error_message, remote_environment) for a server-options tuple.
 
-    stdin, stdout, stderr = ssh.exec_command(f"test -f '{path_virtualenv}' && echo 'exists' || echo 'not exists'")
-    env_check = stdout.read().decode().strip()
-    return env_check == 'exists'
+    The remote checks are only run again once the TTL expires.
+    """
+    now = time.time()
+    with _validation_cache_lock:
+        cached = _validation_cache.get(server_key)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
 
+    validation = validate_server_options(*server_key)
+    with _validation_cache_lock:
+        _validation_cache[server_key] = (now, validation)
+    return validation
 
-def verify_working_directory(name_server, name_user, ssh_key_options, working_directory):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(name_server, username=name_user, key_filename=ssh_key_options)
 
-    stdin, stdout, stderr = ssh.exec_command(f"if [ -d '{working_directory}' ];"
-                                             f" then echo 'exists'; else echo 'not exists'; fi")
-    result = stdout.read().decode().strip()
-    return result == "exists"
+def invalidate_server_validation(server_key):
+    """Forgets the cached validation of one server-options tuple (nothing if server_key is None: this
+    session never validated any, and the cache is shared by every session)."""
+    if server_key is None:
+        return
+    with _validation_cache_lock:
+        _validation_cache.pop(server_key, None)
 
 
 def clean_server_options():  # Only clean if you have loaded it
@@ -1,6 +1,11 @@
 import streamlit as st
 import paramiko
 import os
+import sys
+
+# The shared transfer helpers live in the package next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.common.sftp_transfer import open_sftp_session, upload_files  # noqa: E402
 
 
 # Conect to remote server
@@ -11,15 +16,6 @@ def connect_to_server(hostname, username, password):
     return ssh_client
 
 
-# Upload file to remote server
-def upload_file_to_server(ssh_client, local_file_path, remote_working_dir):
-    sftp = ssh_client.open_sftp()
-    remote_file_path = os.path.join(remote_working_dir, os.path.basename(local_file_path))
-    sftp.put(local_file_path, remote_file_path)
-    sftp.close()
-    return remote_file_path
-
-
 # Execute 'sbatch' command
 def execute_sbatch(ssh_client, remote_file_path):
     stdin, stdout, stderr = ssh_client.exec_command(f'cd {os.path.dirname(remote_file_path)}'
@@ -55,7 +51,12 @@ if st.sidebar.button("RUN"):
             st.write(f"{uploaded_file.name} file uploaded correctly.")
 
             # Upload file to remote server
-            remote_file_path = upload_file_to_server(ssh_client, local_file_path, remote_working_dir)
+            remote_file_path = os.path.join(remote_working_dir, os.path.basename(local_file_path))
+            sftp = open_sftp_session(ssh_client)
+            try:
+                upload_files(sftp, [(local_file_path, remote_file_path)])
+            finally:
+                sftp.close()
             st.write(f"Uploaded file to server: {remote_file_path}")
 
             # Execute 'sbatch' in the file
@@ -4,6 +4,9 @@ from torepo_gui_external.topology_gui import TopologyScreen
 from torepo_gui_external.replicate_gui import ReplicateScreen
 from torepo_gui_external.polyanagro_gui import run_page_polyanagro
 from torepo_gui_external.stmol_viewer import StmolScreen
+from torepo_gui_external.job_history_gui import JobHistoryScreen
+from torepo_gui_external.pipeline_gui import PipelineScreen
+from functions.common.job_store import reattach_runs
 
 
 #   ============================    Title configuration   ============================    #
@@ -37,10 +40,17 @@ def main_page():
 def main():
 
     main_page()
+
+    # Runs left unfinished by a previous Streamlit process are followed again, once per session
+    if "runs_reattached" not in st.session_state:
+        st.session_state.runs_reattached = reattach_runs()
+    if st.session_state.runs_reattached:
+        st.sidebar.info(f"{st.session_state.runs_reattached} runs of an earlier session are followed again")
+
     st.sidebar.markdown("<h1 style='font-size:32px;'>Program selection</h1>", unsafe_allow_html=True)
     page_selection = st.sidebar.selectbox('Please select a program',
                                           ['Select a program', 'Topology', 'Replicate Polymer',
-                                           'Polyanagro', 'Stmol Viewer'])
+                                           'Pipeline', 'Polyanagro', 'Stmol Viewer', 'Job History'])
 
     # Run selected page
     if page_selection == "Topology":
@@ -49,11 +59,17 @@ def main():
     elif page_selection == "Replicate Polymer":
         replicate_obj = ReplicateScreen()
         replicate_obj.show_screen()
+    elif page_selection == "Pipeline":
+        pipeline_obj = PipelineScreen()
+        pipeline_obj.show_screen()
     elif page_selection == "Polyanagro":
         run_page_polyanagro()
     elif page_selection == "Stmol Viewer":
         stmol_obj = StmolScreen()
         stmol_obj.show_screen()
+    elif page_selection == "Job History":
+        history_obj = JobHistoryScreen()
+        history_obj.show_screen()
 
 #   ============================    Logo configuration   ============================    #
 
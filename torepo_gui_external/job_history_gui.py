@@ -0,0 +1,67 @@
+import streamlit as st
+import pandas as pd
+from functions.common.job_history import load_history, HISTORY_DB_PATH
+
+
+class JobHistoryScreen:
+    def __init__(self):
+        self._program = None
+        self._only_completed = None
+
+    def show_screen(self):
+
+        #   ============================    Welcome Job History   ============================    #
+
+        st.markdown("<h1 style='font-size:32px;'>Job History</h1>", unsafe_allow_html=True)
+        st.write(f"SLURM accounting (sacct) of the jobs run from TOREPO, stored in `{HISTORY_DB_PATH}`")
+
+        history = load_history()
+        if not history:
+            st.info("No SLURM jobs recorded yet. Jobs are added when a run through the queuing system finishes.")
+            return
+
+        jobs = pd.DataFrame(history)
+        jobs["total_atoms"] = jobs["atom_count"] * jobs["image_multiplier"]
+        jobs["elapsed_min"] = jobs["elapsed_s"] / 60.0
+        jobs["recorded_at"] = pd.to_datetime(jobs["recorded_at"], unit="s")
+
+        #   ============================    Filters   ============================    #
+
+        self._program = st.selectbox("Program", ["All"] + sorted(jobs["program"].unique()))
+        self._only_completed = st.toggle("Only completed jobs", True)
+        if self._program != "All":
+            jobs = jobs[jobs["program"] == self._program]
+        if self._only_completed:
+            jobs = jobs[jobs["state"] == "COMPLETED"]
+        if jobs.empty:
+            st.warning("No jobs match the selection")
+            return
+
+        #   ============================    Scaling charts   ============================    #
+
+        st.markdown("<h1 style='font-size:22px;'>Runtime and memory against system size</h1>",
+                    unsafe_allow_html=True)
+        sized_jobs = jobs.dropna(subset=["total_atoms"])
+        left_col, right_col = st.columns(2)
+        with left_col:
+            st.write("Runtime (min) against atoms")
+            st.scatter_chart(sized_jobs, x="total_atoms", y="elapsed_min", color="program")
+        with right_col:
+            st.write("MaxRSS (MB) against atoms")
+            st.scatter_chart(sized_jobs, x="total_atoms", y="max_rss_mb", color="program")
+
+        left_col, right_col = st.columns(2)
+        with left_col:
+            st.write("Runtime (min) against image multiplier")
+            st.scatter_chart(jobs, x="image_multiplier", y="elapsed_min", color="program")
+        with right_col:
+            st.write("MaxRSS (MB) against image multiplier")
+            st.scatter_chart(jobs, x="image_multiplier", y="max_rss_mb", color="program")
+
+        #   ============================    Jobs table   ============================    #
+
+        st.markdown("<h1 style='font-size:22px;'>Jobs</h1>", unsafe_allow_html=True)
+        st.dataframe(jobs[["recorded_at", "server", "job_id", "program", "state", "exit_code", "elapsed_min",
+                           "max_rss_mb", "cpu_efficiency", "alloc_cpus", "req_mem", "atom_count",
+                           "image_multiplier", "parameters"]].sort_values("recorded_at", ascending=False),
+                     hide_index=True)
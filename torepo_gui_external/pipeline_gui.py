@@ -0,0 +1,181 @@
+import streamlit as st
+import os
+import base64
+from torepo_gui_external.server_options import ServerScreen
+from functions.common.common_functions import create_tar_gz, show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.common.execution_backend import BACKEND_SLURM
+from functions.pipeline.pipeline_func import run_pipeline_remote, PIPELINE_STAGES, MDRUN_THREADS
+
+
+class PipelineScreen:
+    def __init__(self):
+        self._about = """
+                Topology -> Replicate Polymer -> Minimization pipeline
+                  ----------------------------------------------
+
+            The three stages are submitted at once as SLURM jobs chained with
+            --dependency=afterok, so each stage starts as soon as the previous one
+            succeeds without going back to the GUI. The intermediate files stay
+            on the cluster, in the run directory of each stage; only the logs,
+            the replicated topology and the minimization outputs are downloaded.
+                    """
+
+        self._input_files = {
+            "pipeline_input_file": "**Input file for Topology (XSD, PDB, or MOL2)***",
+            "pipeline_renumber_pdb": "HEAD TAIL file for renumbering pdb (DAT)",
+            "pipeline_assign_residues": "SETUP RESIDUE file for assigning residues (DAT)",
+            "pipeline_filemap": "FILEMAP for matching LAMMPS type with name and element (DAT)",
+            "pipeline_xml_file": "**Forcefield for Replicate Polymer (XML)***",
+            "pipeline_impropers": "Impropers file for Replicate Polymer",
+            "pipeline_minimization_mdp": "**GROMACS parameters of the minimization (MDP)***",
+        }
+
+        self._input_paths = None
+        self._pattern = None
+        self._separate_chains = None
+        self._isunwrap = None
+        self._guess_improper = None
+        self._image_x = None
+        self._image_y = None
+        self._image_z = None
+        self._mdengine = None
+        self._noh = None
+        self._mdrun_threads = None
+
+        server_screen = ServerScreen()
+        self._server_valid = server_screen.show_screen_sidebar()
+
+        self._remote_environment = server_screen._remote_environment
+        self._max_runtime = server_screen._max_runtime
+        self._backend = server_screen.execution_backend()
+
+    def show_screen(self):
+
+        #   ============================    Welcome Pipeline   ============================    #
+
+        st.markdown("<h1 style='font-size:32px;'>Pipeline</h1>", unsafe_allow_html=True)
+
+        with st.expander("INFO"):
+            st.text(self._about)
+
+        st.markdown("<h1 style='font-size:22px;'>Pipeline options</h1>", unsafe_allow_html=True)
+        st.write("Fields in"
+                 " **bold**"
+                 " and with '*' are required")
+
+        #   ============================    Input files   ============================    #
+
+        self._input_paths = {}
+        for input_key, option in self._input_files.items():
+            self._input_paths[input_key] = st.text_input(option, st.session_state.get(input_key, ""),
+                                                         key=f"{input_key}_input_text")
+            st.session_state[input_key] = self._input_paths[input_key]
+
+        left_col, right_col = st.columns(2)
+        with left_col:
+
+            #   ============================    Topology options   ============================    #
+
+            self._pattern = st.text_input("**String pattern to name the new files***",
+                                          st.session_state.get("pipeline_pattern", ""))
+            st.session_state.pipeline_pattern = self._pattern
+
+            self._separate_chains = st.toggle("Create a pdb file for each chain",
+                                              st.session_state.get("pipeline_separate_chains", False))
+            st.session_state.pipeline_separate_chains = self._separate_chains
+
+            self._isunwrap = st.toggle("Unwrap coordinates in the final structure",
+                                       st.session_state.get("pipeline_isunwrap", False))
+            st.session_state.pipeline_isunwrap = self._isunwrap
+
+            self._guess_improper = st.toggle("Guess improper angles in the system",
+                                             st.session_state.get("pipeline_guess_improper", False))
+            st.session_state.pipeline_guess_improper = self._guess_improper
+
+        with right_col:
+
+            #   ============================    Replicate and minimization options   ============================    #
+
+            self._image_x = st.number_input("Number of images in dimension X*", min_value=1, step=1, value=1)
+            self._image_y = st.number_input("Number of images in dimension Y*", min_value=1, step=1, value=1)
+            self._image_z = st.number_input("Number of images in dimension Z*", min_value=1, step=1, value=1)
+
+            self._mdengine = st.text_input("MD package to perform calculations",
+                                           st.session_state.get("pipeline_mdengine", ""))
+            st.session_state.pipeline_mdengine = self._mdengine
+
+            self._noh = st.toggle("Remove hydrogens for a united atom representation",
+                                  st.session_state.get("pipeline_noh", False))
+            st.session_state.pipeline_noh = self._noh
+
+            self._mdrun_threads = st.number_input("Threads of gmx mdrun", min_value=1, step=1, value=MDRUN_THREADS)
+
+        #   ============================    Run button   ============================    #
+
+        if st.button("RUN PIPELINE"):
+            self._submit_run()
+
+        #   ============================    Background jobs   ============================    #
+        show_jobs_panel("Pipeline", show_pipeline_results)
+
+    def _submit_run(self):
+        if not self._server_valid:
+            st.error("ERROR!!! Please enter all server options correctly")
+            return
+
+        for input_key in ("pipeline_input_file", "pipeline_xml_file", "pipeline_minimization_mdp"):
+            if not self._input_paths[input_key]:
+                st.error(f"ERROR!!! Please enter the {self._input_files[input_key].strip('*')}")
+                return
+        missing_files = [path for path in self._input_paths.values() if path and not os.path.isfile(path)]
+        if missing_files:
+            st.error(f"ERROR!!! File not found: {', '.join(missing_files)}")
+            return
+
+        if not self._pattern:
+            st.error("ERROR!!! Please string pattern to name the new files")
+            return
+
+        # Neither this workstation nor a direct SSH run can chain the stages on the cluster
+        if self._backend.name != BACKEND_SLURM or \
+                (self._remote_environment and not self._remote_environment["slurm"]["sbatch"]):
+            st.error("ERROR!!! The pipeline needs SLURM (sbatch) on the server: please check 'Use queuing system'")
+            return
+
+        paths = {input_key: path or None for input_key, path in self._input_paths.items()}
+        job_name = (f"{self._pattern} ({os.path.basename(paths['pipeline_input_file'])}, "
+                    f"{self._image_x}x{self._image_y}x{self._image_z})")
+        get_job_engine().submit("Pipeline", job_name, run_pipeline_remote, self._backend,
+                                input_file=paths["pipeline_input_file"],
+                                renumber_pdb=paths["pipeline_renumber_pdb"],
+                                assign_residues=paths["pipeline_assign_residues"],
+                                filemap=paths["pipeline_filemap"],
+                                separate_chains=self._separate_chains, pattern=self._pattern,
+                                isunwrap=self._isunwrap, guess_improper=self._guess_improper,
+                                xml_file=paths["pipeline_xml_file"],
+                                image_x=self._image_x, image_y=self._image_y, image_z=self._image_z,
+                                minimization_mdp=paths["pipeline_minimization_mdp"],
+                                mdengine=self._mdengine, noh=self._noh, impropers=paths["pipeline_impropers"],
+                                mdrun_threads=self._mdrun_threads, max_runtime=self._max_runtime)
+        st.success("Pipeline submitted. Each stage starts on the cluster as soon as the previous one succeeds.")
+
+
+def show_pipeline_results(job):
+    output, error, output_folder = job.result
+    if error:
+        st.warning(error)
+    else:
+        st.success("JOB DONE!!!")
+    st.text(output)
+
+    #   ============================    Getting output files    ============================    #
+
+    # One directory per stage, as in example_PE and example_iPP
+    output_file_paths = [os.path.join(output_folder, stage) for stage in PIPELINE_STAGES]
+    tar_file_path = create_tar_gz(output_folder, output_file_paths)
+    download_link = (f'<a href="data:application/tar+gzip;base64,'
+                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
+                     f'" download="pipeline_output_files.tar.gz">'
+                     f'Download Pipeline output files</a>')
+    st.markdown(download_link, unsafe_allow_html=True)
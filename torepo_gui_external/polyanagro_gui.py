@@ -1,4 +1,5 @@
 import streamlit as st
+from torepo_gui_external.server_options import ServerScreen
 from torepo_gui_external.polyanagro_gui_external.torsion_density_maps_gui import run_page_2d_torsion
 from torepo_gui_external.polyanagro_gui_external.bonded_distribution_gui import run_page_bonded_distribution
 from torepo_gui_external.polyanagro_gui_external.energy_analysis_gui import run_page_energy_analysis
@@ -7,6 +8,8 @@ from torepo_gui_external.polyanagro_gui_external.neighbor_sphere_gui import run_
 from torepo_gui_external.polyanagro_gui_external.pair_distribution_gui import run_page_pair_distribution
 from torepo_gui_external.polyanagro_gui_external.polymer_size_gui import run_page_polymer_size
 from torepo_gui_external.polyanagro_gui_external.votca_analysis_gui import run_page_votca_analysis
+from torepo_gui_external.polyanagro_gui_external.batch_analysis_gui import run_page_batch_analysis
+from torepo_gui_external.polyanagro_gui_external.previous_results_gui import run_page_previous_results
 
 
 #   ============================    Subprograms mapping   ============================    #
@@ -18,25 +21,35 @@ def func_page_polyanagro():
     page_selection = st.selectbox('Select a subprogram',
                                   ['Select a subprogram', '2D Torsion Density Maps', 'Bonded Distribution',
                                    'Energy Analysis', 'Info TRJ', 'Neighbor Sphere',
-                                   'Pair Distribution', 'Polymer Size', 'VOTCA Analysis'])
+                                   'Pair Distribution', 'Polymer Size', 'VOTCA Analysis', 'Batch Analysis',
+                                   'Previous Results'])
+
+    # The analyses run where the server options of the sidebar say (None until they are valid)
+    server_screen = ServerScreen()
+    backend = server_screen.execution_backend() if server_screen.show_screen_sidebar() else None
+    max_runtime = server_screen._max_runtime
 
     # Run selected page
     if page_selection == "2D Torsion Density Maps":
-        run_page_2d_torsion()
+        run_page_2d_torsion(backend, max_runtime)
     elif page_selection == "Bonded Distribution":
-        run_page_bonded_distribution()
+        run_page_bonded_distribution(backend, max_runtime)
     elif page_selection == "Energy Analysis":
-        run_page_energy_analysis()
+        run_page_energy_analysis(backend, max_runtime)
     elif page_selection == "Info TRJ":
-        run_page_info_trj()
+        run_page_info_trj(backend, max_runtime)
     elif page_selection == "Neighbor Sphere":
-        run_page_neighbor_sphere()
+        run_page_neighbor_sphere(backend, max_runtime)
     elif page_selection == "Pair Distribution":
-        run_page_pair_distribution()
+        run_page_pair_distribution(backend, max_runtime)
     elif page_selection == "Polymer Size":
-        run_page_polymer_size()
+        run_page_polymer_size(backend, max_runtime)
     elif page_selection == "VOTCA Analysis":
-        run_page_votca_analysis()
+        run_page_votca_analysis(backend, max_runtime)
+    elif page_selection == "Batch Analysis":
+        run_page_batch_analysis(backend, max_runtime)
+    elif page_selection == "Previous Results":
+        run_page_previous_results()
 
 
 def main():
@@ -0,0 +1,211 @@
+import streamlit as st
+import os
+import shutil
+import logging
+import tempfile
+from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import run_polyanagro_batch, parse_batch_output, show_polyanagro_results
+from torepo_gui_external.polyanagro_gui_external.polymer_size_gui import polymer_size_command
+from torepo_gui_external.polyanagro_gui_external.pair_distribution_gui import (pair_distribution_command,
+                                                                               save_uploaded_file)
+from torepo_gui_external.polyanagro_gui_external.bonded_distribution_gui import bonded_distribution_calculate_command
+from torepo_gui_external.polyanagro_gui_external.torsion_density_maps_gui import torsion_density_maps_command
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_ANALYSES = {
+    "Polymer Size": "polymer_size",
+    "Pair Distribution": "pair_distribution",
+    "Bonded Distribution": "bonded_distribution",
+    "2D Torsion Density Maps": "torsion_density_maps",
+}
+
+
+def file_input(label, input_key, options, filetypes):
+    """Text input with Browse and Remove buttons, like the inputs of the other polyanagro pages."""
+    if input_key not in options:
+        options[input_key] = ""
+
+    # No widget key: the box shows the path chosen with Browse on the next run, and a typed one is kept
+    options[input_key] = st.text_input(label, options[input_key]).strip()
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Browse file", key=f"browse_{input_key}"):
+            input_filename = filedialog.askopenfilename(initialdir=os.getcwd(), title="Select an input file",
+                                                        filetypes=filetypes)
+            if input_filename:
+                options[input_key] = input_filename
+                st.session_state["batch_options"] = options
+                st.rerun()
+    with col2:
+        if options[input_key] and st.button("Remove file", key=f"remove_{input_key}"):
+            options[input_key] = ""
+            st.session_state["batch_options"] = options
+            st.rerun()
+    return options[input_key]
+
+
+def batch_commands(selected, traj_files, topo_file, stride, unwrap_coordinates, analysis_options):
+    """{tool: command} of the selected analyses and every input file they need (each listed once)."""
+    commands = {}
+    input_files = []
+    for analysis in selected:
+        name = BATCH_ANALYSES[analysis]
+        log_filename = f"batch_{name}.log"
+        extra = analysis_options.get(name, {})
+        if name == "polymer_size":
+            command, files = polymer_size_command(traj_files, topo_file, stride, None, None, False, None,
+                                                  log_filename, extra.get("distributions"),
+                                                  extra.get("bond_orientation"), unwrap_coordinates, False, False)
+        elif name == "pair_distribution":
+            command, files = pair_distribution_command(traj_files, topo_file, log_filename, stride,
+                                                       extra.get("sets") or "all", extra.get("dr"))
+        elif name == "bonded_distribution":
+            command, files = bonded_distribution_calculate_command(traj_files, topo_file, extra.get("bonds"),
+                                                                   extra.get("angles"), extra.get("dihedrals"),
+                                                                   extra.get("impropers"), stride, log_filename,
+                                                                   unwrap_coordinates)
+        else:
+            command, files = torsion_density_maps_command(traj_files, topo_file, extra.get("phipsi"),
+                                                          extra.get("phipsi_2"), log_filename, stride,
+                                                          unwrap_coordinates)
+        commands[name] = command
+        input_files += files
+    return commands, list(dict.fromkeys(input_files))
+
+
+def func_page_batch_analysis(backend, max_runtime):
+
+    st.markdown("<h1 style='font-size:24px;'>Batch Analysis</h1>", unsafe_allow_html=True)
+    with st.expander("INFO"):
+        st.text("""
+        Runs several polyanagro analyses over the same trajectory in one go. The trajectory,
+        the topology, the stride and the unwrap setting are given once and the inputs are
+        staged once; the selected analyses then run one after the other in a single run.
+        Each analysis still reads and decodes the trajectory itself: the frames are not
+        shared between them.
+            """)
+
+    with st.expander("OPTIONS", expanded=True):
+        st.write("Fields with '*' are required")
+
+        #   ============================    Input options   ============================    #
+
+        options = st.session_state.get("batch_options", {})
+        traj_files_path = file_input("Select a list of trajectories from MD simulations (XTC or TRR)*",
+                                     "batch_trajectory", options,
+                                     [("XTC files", "*.xtc"), ("TRR files", "*.trr")])
+        topo_file_path = file_input("Select a topology file (TPR or PSF)*", "batch_topology", options,
+                                    [("TPR files", "*.tpr"), ("PSF files", "*.psf")])
+        st.session_state["batch_options"] = options
+
+        #   ============================    Common options   ============================    #
+
+        stride = st.number_input("Frame numbers for each stride frames", min_value=1, step=1, value=None,
+                                 key="batch_stride")
+        unwrap_coordinates = st.toggle("Unwrap coordinates", key="batch_unwrap")
+
+        #   ============================    Analyses   ============================    #
+
+        selected = st.multiselect("Analyses to run*", list(BATCH_ANALYSES), key="batch_analyses")
+        analysis_options = {}
+        if "Polymer Size" in selected:
+            st.markdown("**Polymer Size**")
+            analysis_options["polymer_size"] = {
+                "distributions": st.toggle("Ree and Rg distributions", key="batch_ps_distributions"),
+                "bond_orientation": st.toggle("Bond orientation", key="batch_ps_bond_orientation")}
+        if "Pair Distribution" in selected:
+            st.markdown("**Pair Distribution**")
+            analysis_options["pair_distribution"] = {
+                "sets": st.text_input("Set of atoms to calculate the g(r)", help="E.g., 1-100 150-200",
+                                      key="batch_pd_sets"),
+                "dr": st.number_input("Bin width for the histogram (angstroms)", step=0.1, value=None,
+                                      format="%.1f", key="batch_pd_dr")}
+        if "Bonded Distribution" in selected:
+            st.markdown("**Bonded Distribution**")
+            analysis_options["bonded_distribution"] = {
+                "bonds": file_input("Bond list file (NDX)", "batch_bd_bonds", options, [("NDX files", "*.ndx")]),
+                "angles": file_input("Angle list file (NDX)", "batch_bd_angles", options, [("NDX files", "*.ndx")]),
+                "dihedrals": file_input("Dihedral list file (NDX)", "batch_bd_dihedrals", options,
+                                        [("NDX files", "*.ndx")]),
+                "impropers": file_input("Improper list file (NDX)", "batch_bd_impropers", options,
+                                        [("NDX files", "*.ndx")])}
+        if "2D Torsion Density Maps" in selected:
+            st.markdown("**2D Torsion Density Maps**")
+            analysis_options["torsion_density_maps"] = {
+                "phipsi": file_input("File with two labels of 'dihedral_data_dist.ndx'*", "batch_tm_phipsi",
+                                     options, [("NDX files", "dihedral_data_dist.ndx")]),
+                "phipsi_2": file_input("Another file 'dihedral_data_dist.ndx'*", "batch_tm_phipsi_2", options,
+                                       [("NDX files", "dihedral_data_dist.ndx")])}
+
+        #   ============================    Compressed file options   ============================    #
+
+        compressed_file_name = st.text_input("Enter the name for the output compressed file*",
+                                             key="batch_compressed_file_name")
+
+    #   ============================    BATCH RUN   ============================    #
+
+    if st.button("RUN", key="batch_run"):
+        if backend is None:
+            st.error("ERROR!!! Please enter all server options correctly")
+            return
+        if not traj_files_path:
+            st.error("Please select a list of trajectories before running the program")
+            return
+        if not topo_file_path:
+            st.error("Please select a topology file before running the program")
+            return
+        if not selected:
+            st.error("Please select at least one analysis")
+            return
+        bonded = analysis_options.get("bonded_distribution")
+        if bonded and not any(bonded.values()):
+            st.error("Please select at least one list file for Bonded Distribution")
+            return
+        torsion = analysis_options.get("torsion_density_maps")
+        if torsion and not (torsion["phipsi"] and torsion["phipsi_2"]):
+            st.error("Please select both 'dihedral_data_dist.ndx' files for 2D Torsion Density Maps")
+            return
+        if not compressed_file_name:
+            st.error("Please enter the name for the output compressed file")
+            return
+
+        # Uploaded inputs live in a temporary directory until the job has finished with them
+        temp_dir = tempfile.mkdtemp()
+        traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+        topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
+        commands, input_files = batch_commands(selected, traj_files_path, topo_file_path, stride,
+                                               unwrap_coordinates, analysis_options)
+        get_job_engine().submit("Batch Analysis", compressed_file_name, run_polyanagro_batch, commands, input_files,
+                                backend=backend, max_runtime=max_runtime,
+                                cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+        st.success(f"Batch Analysis job submitted ({backend.name}). You can keep working, "
+                   f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def show_batch_results(job):
+    """How each analysis of a finished batch ended, then its outputs (see show_polyanagro_results)."""
+    output, error, output_folder = job.result
+    exit_codes = parse_batch_output(output)
+    for analysis, name in BATCH_ANALYSES.items():
+        if name not in exit_codes:
+            continue
+        if exit_codes[name] == 0:
+            st.success(f"{analysis} executed successfully!")
+        else:
+            st.error(f"ERROR!!! {analysis} failed with exit code {exit_codes[name]}")
+    if not exit_codes:
+        st.error(f"ERROR!!! The analyses did not run: {error}")
+    show_polyanagro_results(job)
+
+
+def run_page_batch_analysis(backend, max_runtime=None):
+
+    func_page_batch_analysis(backend, max_runtime)
+    show_jobs_panel("Batch Analysis", show_batch_results)
@@ -1,14 +1,14 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, run_polyanagro_chunked, input_names,
+                                                  input_paths, show_polyanagro_results)
 
 
 # Logger configuration
@@ -16,27 +16,26 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_bonded_distribution_generate(traj_files, listbb_file, topo_file, log_filename):
+def run_bonded_distribution_generate(traj_files, listbb_file, topo_file, log_filename, backend=None,
+                                     progress_callback=None, output_callback=None):
 
-    bash_command = f"bonded_distribution generate -t {traj_files} --listbb {listbb_file}"
+    bash_command = f"bonded_distribution generate -t {input_names(traj_files)} --listbb {input_names(listbb_file)}"
 
     if topo_file:
-        bash_command += f" --topo {topo_file}"
+        bash_command += f" --topo {input_names(topo_file)}"
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    return run_polyanagro_command(bash_command, input_paths(traj_files, listbb_file, topo_file), backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
-    return output, error
 
+def bonded_distribution_calculate_command(traj_files, topo_file, bond_list_file, angle_list_file,
+                                          dihedral_list_file, improper_list_file, stride, log_filename,
+                                          unwrap_coordinates):
+    """bonded_distribution calculate command line and the input files it needs."""
 
-def run_bonded_distribution_calculate(traj_files, topo_file, bond_list_file,
-                                      angle_list_file, dihedral_list_file,
-                                      improper_list_file, stride, log_filename,
-                                      unwrap_coordinates):
-
-    bash_command = f"bonded_distribution calculate -t {traj_files} --topo {topo_file}"
+    bash_command = f"bonded_distribution calculate -t {input_names(traj_files)} --topo {input_names(topo_file)}"
 
     if unwrap_coordinates:
         bash_command += " --unwrap True"
@@ -44,27 +43,48 @@ def run_bonded_distribution_calculate(traj_files, topo_file, bond_list_file,
         bash_command += " --unwrap False"
 
     if bond_list_file:
-        bash_command += f" -b {bond_list_file}"
+        bash_command += f" -b {input_names(bond_list_file)}"
 
     if angle_list_file:
-        bash_command += f" -a {angle_list_file}"
+        bash_command += f" -a {input_names(angle_list_file)}"
 
     if dihedral_list_file:
-        bash_command += f" -d {dihedral_list_file}"
+        bash_command += f" -d {input_names(dihedral_list_file)}"
 
     if improper_list_file:
-        bash_command += f" -i {improper_list_file}"
+        bash_command += f" -i {input_names(improper_list_file)}"
 
     if stride:
         bash_command += f" --stride {stride}"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    return bash_command, input_paths(traj_files, topo_file, bond_list_file, angle_list_file,
+                                     dihedral_list_file, improper_list_file)
 
-    return output, error
+
+def run_bonded_distribution_calculate(traj_files, topo_file, bond_list_file,
+                                      angle_list_file, dihedral_list_file,
+                                      improper_list_file, stride, log_filename,
+                                      unwrap_coordinates, backend=None, workers=1,
+                                      progress_callback=None, output_callback=None):
+
+    if workers > 1:
+        # The distributions of each part of the trajectory are merged (see run_polyanagro_chunked)
+        return run_polyanagro_chunked(
+            lambda files: bonded_distribution_calculate_command(files, topo_file, bond_list_file, angle_list_file,
+                                                                dihedral_list_file, improper_list_file, stride,
+                                                                log_filename, unwrap_coordinates),
+            traj_files, stride, workers, backend,
+                                      progress_callback=progress_callback, output_callback=output_callback)
+
+    bash_command, input_files = bonded_distribution_calculate_command(traj_files, topo_file, bond_list_file,
+                                                                      angle_list_file, dihedral_list_file,
+                                                                      improper_list_file, stride, log_filename,
+                                                                      unwrap_coordinates)
+    return run_polyanagro_command(bash_command, input_files, backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -80,35 +100,7 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
-
-
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            tar.add(file_path, arcname=os.path.basename(file_path))
-
-    return temp_tar_path
-
-
-def func_page_bonded_distribution():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_bonded_distribution(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>Bonded Distribution</h1>", unsafe_allow_html=True)
 
@@ -217,6 +209,9 @@ def func_page_bonded_distribution():
 
             # Button to execute the subprogram with the select options
             if st.button("RUN"):
+                if backend is None:
+                    st.error("ERROR!!! Please enter all server options correctly")
+                    return
                 traj_files_path = options.get("input_file_1", "")
                 listbb_file_path = options.get("input_file_2", "")
                 topo_file_path = options.get("input_file_3", "")
@@ -237,66 +232,18 @@ def func_page_bonded_distribution():
                     return
 
                 if traj_files_path and listbb_file_path is not None:
-                    with st.spinner("Running Bonded Distribution. Please wait..."):
-                        warning_container = st.warning("Do not close the interface "
-                                                       "while Bonded Distribution is running.")
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Use the unique identifier to create a unique directory to the output
-                            output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                            os.makedirs(output_folder)
-
-                            # Save selected files in the temporal directory
-                            traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
-                            listbb_file_path = save_uploaded_file(listbb_file_path, temp_dir)
-                            topo_file_path = save_uploaded_file(topo_file_path, temp_dir) if topo_file_path else None
-
-                            # Execute the Bonded Distribution command with path files provided
-                            output, error = run_bonded_distribution_generate(
-                                traj_files_path,
-                                listbb_file_path,
-                                topo_file_path,
-                                log_filename
-                            )
-
-                            now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                            m = f"\n\t\tOutput from Bonded Distribution.({now})"
-                            m += f"\n\t\t{'*' * len(m)}\n"
-                            m += output.decode()
-                            m += error.decode()
-                            print(m) if logger is None else logger.info(m)
-
-                            st.success("Bonded Distribution subprogram executed successfully!")
-                            warning_container.empty()
-
-                            output_name = os.path.splitext(os.path.basename(log_filename))[0]
-
-                            #   Output common files
-                            output_files = [
-                                f"{output_name}",
-                                "pol_bonddist_gen"  # ==  ERROR OUTPUT  == #
-                            ]
-
-                            # Move generated files to single folder
-                            for filename in os.listdir(temp_dir):
-                                filepath = os.path.join(temp_dir, filename)
-                                if os.path.isfile(filepath):
-                                    shutil.move(filepath, os.path.join(output_folder, filename))
-
-                            if compressed_file_name:
-                                tar_file_path = create_tar_gz(output_folder, output_files)
-
-                                # Generate download link for output files
-                                download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                                 f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                                 f'" download="{compressed_file_name}.tar.gz">'
-                                                 f'Download {compressed_file_name} compressed file</a>')
-                                st.markdown(download_link, unsafe_allow_html=True)
-
-                                # Show output file names
-                                show_output_files_content(output_files, log_filename)
-
-                                if st.button("RESET"):
-                                    st.experimental_rerun()
+                    # Uploaded inputs live in a temporary directory until the job has finished with them
+                    temp_dir = tempfile.mkdtemp()
+                    traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+                    listbb_file_path = save_uploaded_file(listbb_file_path, temp_dir)
+                    topo_file_path = save_uploaded_file(topo_file_path, temp_dir) if topo_file_path else None
+                    get_job_engine().submit("Bonded Distribution", compressed_file_name,
+                                            run_bonded_distribution_generate,
+                                            traj_files_path, listbb_file_path, topo_file_path, log_filename,
+                                            backend=backend, max_runtime=max_runtime,
+                                            cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                    st.success(f"Bonded Distribution job submitted ({backend.name}). You can keep working, "
+                               f"or close the tab: the job is followed again when TOREPO is opened.")
 
     #   ============================    CALCULATE OPTIONS   ============================    #
 
@@ -381,6 +328,12 @@ def func_page_bonded_distribution():
             if log_filename.strip() == "":
                 log_filename = "pol_bonddist_gen.log"
 
+            #   ============================    Parallel options   ============================    #
+
+            workers = st.number_input("Parallel workers", min_value=1, step=1, value=1,
+                                      help="Runs over the parts of a split XTC trajectory at the same time and "
+                                           "merges their histograms")
+
             #   ============================    Compressed file options   ============================    #
 
             compressed_file_name = st.text_input("Enter the name for the output compressed file*")
@@ -389,6 +342,9 @@ def func_page_bonded_distribution():
 
             # Button to execute the subprogram with the select options
             if st.button("RUN"):
+                if backend is None:
+                    st.error("ERROR!!! Please enter all server options correctly")
+                    return
                 traj_files_path = options.get("input_file_1", "")
                 topo_file_path = options.get("input_file_2", "")
                 bond_list_file_path = options.get("input_file_3", "")
@@ -412,72 +368,30 @@ def func_page_bonded_distribution():
                     return
 
                 if traj_files_path and topo_file_path is not None:
-                    with st.spinner("Running Bonded Distribution. Please wait..."):
-                        warning_container = st.warning(
-                            "Do not close the interface while Bonded Distribution is running.")
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Use the unique identifier to create a unique directory to the output
-                            output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                            os.makedirs(output_folder)
-
-                            # Save selected files in the temporal directory
-                            traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
-                            topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
-                            bond_list_file_path = save_uploaded_file(bond_list_file_path,
-                                                                     temp_dir) if bond_list_file_path else None
-                            angle_list_file_path = save_uploaded_file(angle_list_file_path,
-                                                                      temp_dir) if angle_list_file_path else None
-                            dihedral_list_file_path = save_uploaded_file(dihedral_list_file_path,
-                                                                         temp_dir) if dihedral_list_file_path else None
-                            improper_list_file_path = save_uploaded_file(improper_list_file_path,
-                                                                         temp_dir) if improper_list_file_path else None
-
-                            # Execute the Bonded Distribution command with path files provided
-                            output, error = run_bonded_distribution_calculate(
-                                traj_files_path, topo_file_path,
-                                bond_list_file_path, angle_list_file_path,
-                                dihedral_list_file_path, improper_list_file_path,
-                                stride, log_filename, unwrap_coordinates
-                            )
-
-                            now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                            m = f"\n\t\tOutput from Bonded Distribution.({now})"
-                            m += f"\n\t\t{'*' * len(m)}\n"
-                            m += output.decode()
-                            m += error.decode()
-                            print(m) if logger is None else logger.info(m)
-
-                            st.success("Bonded Distribution subprogram executed successfully!")
-                            warning_container.empty()
-
-                            #   Output common files
-                            output_files = [
-                                f"{log_filename}"
-                            ]
-
-                            # Move generated files to single folder
-                            for filename in os.listdir(temp_dir):
-                                filepath = os.path.join(temp_dir, filename)
-                                if os.path.isfile(filepath):
-                                    shutil.move(filepath, os.path.join(output_folder, filename))
-
-                            if compressed_file_name:
-                                tar_file_path = create_tar_gz(output_folder, output_files)
-
-                                # Generate download link for output files
-                                download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                                 f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                                 f'" download="{compressed_file_name}.tar.gz">'
-                                                 f'Download {compressed_file_name} compressed file</a>')
-                                st.markdown(download_link, unsafe_allow_html=True)
-
-                                # Show output file names
-                                show_output_files_content(output_files, log_filename)
-
-                                if st.button("RESET"):
-                                    st.experimental_rerun()
-
-
-def run_page_bonded_distribution():
-
-    func_page_bonded_distribution()
+                    # Uploaded inputs live in a temporary directory until the job has finished with them
+                    temp_dir = tempfile.mkdtemp()
+                    traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+                    topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
+                    bond_list_file_path = save_uploaded_file(bond_list_file_path,
+                                                             temp_dir) if bond_list_file_path else None
+                    angle_list_file_path = save_uploaded_file(angle_list_file_path,
+                                                              temp_dir) if angle_list_file_path else None
+                    dihedral_list_file_path = save_uploaded_file(dihedral_list_file_path,
+                                                                 temp_dir) if dihedral_list_file_path else None
+                    improper_list_file_path = save_uploaded_file(improper_list_file_path,
+                                                                 temp_dir) if improper_list_file_path else None
+                    get_job_engine().submit("Bonded Distribution", compressed_file_name,
+                                            run_bonded_distribution_calculate,
+                                            traj_files_path, topo_file_path, bond_list_file_path, angle_list_file_path,
+                                            dihedral_list_file_path, improper_list_file_path, stride, log_filename,
+                                            unwrap_coordinates, workers=workers, backend=backend,
+                                            max_runtime=max_runtime,
+                                            cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                    st.success(f"Bonded Distribution job submitted ({backend.name}). You can keep working, "
+                               f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_bonded_distribution(backend, max_runtime=None):
+
+    func_page_bonded_distribution(backend, max_runtime)
+    show_jobs_panel("Bonded Distribution", show_polyanagro_results)
@@ -1,14 +1,14 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, input_names, input_paths,
+                                                  show_polyanagro_results)
 
 
 # Logger configuration
@@ -29,88 +29,47 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def run_energy_analysis_info(energy_list, log_filename):
+def run_energy_analysis_info(energy_list, log_filename, backend=None, progress_callback=None, output_callback=None):
 
-    bash_command = f"energy_analysis info -e {energy_list}"
+    bash_command = f"energy_analysis info -e {input_names(energy_list)}"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-    return output, error
+    return run_polyanagro_command(bash_command, input_paths(energy_list), backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def run_energy_analysis_calc(energy_list, log_filename, tbegin, tend,
-                             join_energy, groupterms, avg, acf_list):
+                             join_energy, groupterms, avg, acf_list, backend=None,
+                             progress_callback=None, output_callback=None):
 
-    bash_command = f"energy_analysis calc -e {energy_list}"
+    bash_command = f"energy_analysis calc -e {input_names(energy_list)}"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
     if tbegin:
         bash_command += f" --tbegin {tbegin}"
     if tend:
         bash_command += f" --tend {tend}"
     if join_energy:
-        bash_command += f" --joinpath {join_energy}"
+        bash_command += f" --joinpath {shlex.quote(join_energy)}"
     if groupterms:
         bash_command += " --groupterms"
     if avg:
         bash_command += " --avg"
     if acf_list:
-        bash_command += f" --acf {acf_list}"
+        bash_command += f" --acf {input_names(acf_list)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-    return output, error
-
-
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
-
-
-def create_tar_gz(output_folder, output_file_paths):
-    # Crear un archivo temporal para almacenar el .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Crear el archivo .tar.gz
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            if isinstance(file_path, list):  # Si es una lista, iterar sobre ella
-                for sub_path in file_path:
-                    if os.path.exists(sub_path):
-                        tar.add(sub_path, arcname=os.path.basename(sub_path))
-                    else:
-                        print(f"Warning: File not found - {sub_path}")
-            else:  # Si no es una lista, procesar normalmente
-                if os.path.exists(file_path):
-                    tar.add(file_path, arcname=os.path.basename(file_path))
-                else:
-                    print(f"Warning: File not found - {file_path}")
-
-    if os.path.exists(temp_tar_path):
-        return temp_tar_path
-    else:
-        return None
+    # join_energy is the path of a program (gmx), not an input
+    return run_polyanagro_command(bash_command, input_paths(energy_list, acf_list), backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 # ToDo: How to visualize molecules: VMD, JSMol or stmol?
 
 
-def func_page_energy_analysis():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_energy_analysis(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>Energy Analysis</h1>", unsafe_allow_html=True)
 
@@ -212,6 +171,9 @@ def func_page_energy_analysis():
 
             # Button to execute the program
             if st.button("RUN"):
+                if backend is None:
+                    st.error("ERROR!!! Please enter all server options correctly")
+                    return
                 energy_list_path = options.get("input_file_1", "")
 
                 if not energy_list_path:
@@ -226,57 +188,14 @@ def func_page_energy_analysis():
                     return
 
                 if energy_list_path is not None:
-                    with st.spinner("Running Energy Analysis. Please wait..."):
-                        warning_container = st.warning("Do not close the interface while Energy Analysis is running.")
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Use the unique identifier to create a unique directory to the output
-                            output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                            os.makedirs(output_folder)
-
-                            # Save selected files in the temporal directory
-                            energy_list_path = save_uploaded_file(energy_list_path, temp_dir)
-
-                            # Execute the command with path files provided
-                            output, error = run_energy_analysis_info(
-                                energy_list_path,
-                                log_filename)
-
-                            now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                            m = f"\n\t\tOutput from Energy Analysis.({now})"
-                            m += f"\n\t\t{'*' * len(m)}\n"
-                            m += output.decode()
-                            m += error.decode()
-                            print(m) if logger is None else logger.info(m)
-
-                            st.success("Energy Analysis subprogram executed successfully!")
-                            warning_container.empty()
-
-                            #   Output list of common files
-                            output_files = [
-                                f"{log_filename}"
-                            ]
-
-                            # Move generated files to the output directory
-                            for filename in os.listdir(temp_dir):
-                                filepath = os.path.join(temp_dir, filename)
-                                if os.path.isfile(filepath):
-                                    shutil.move(filepath, os.path.join(output_folder, filename))
-
-                            # Build compressed file '.tar.gz' of the output files
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link to the compressed output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
+                    # Uploaded inputs live in a temporary directory until the job has finished with them
+                    temp_dir = tempfile.mkdtemp()
+                    energy_list_path = save_uploaded_file(energy_list_path, temp_dir)
+                    get_job_engine().submit("Energy Analysis", compressed_file_name, run_energy_analysis_info,
+                                            energy_list_path, log_filename, backend=backend, max_runtime=max_runtime,
+                                            cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                    st.success(f"Energy Analysis job submitted ({backend.name}). You can keep working, "
+                               f"or close the tab: the job is followed again when TOREPO is opened.")
 
     #   ============================    CALCULATE OPTIONS   ============================    #
 
@@ -376,6 +295,9 @@ def func_page_energy_analysis():
             if st.button("RUN"):    # ValueError: Multi-dimensional indexing
                 # (e.g. `obj[:, None]`) is no longer supported.
                 # Convert to a numpy array before indexing instead
+                if backend is None:
+                    st.error("ERROR!!! Please enter all server options correctly")
+                    return
                 energy_list_path = options.get("input_file_1", "")
                 join_energy_path = options.get("input_file_2", "")
                 acf_list_path = options.get("input_file_3", "")
@@ -392,95 +314,22 @@ def func_page_energy_analysis():
                     return
 
                 if energy_list_path is not None:
-                    with st.spinner("Running Energy Analysis. Please wait..."):
-                        warning_container = st.warning("Do not close the interface while Energy Analysis is running.")
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Use the unique identifier to create a unique directory to the output
-                            output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                            os.makedirs(output_folder)
-
-                            # Save selected files in the temporal directory
-                            energy_list_path = save_uploaded_file(energy_list_path, temp_dir)
-                            join_energy_path = save_uploaded_file(join_energy_path,
-                                                                  temp_dir) if join_energy_path else None
-                            acf_list_path = save_uploaded_file(acf_list_path,
-                                                               temp_dir) if acf_list_path else None
-
-                            # Execute the command with path files provided
-                            output, error = run_energy_analysis_calc(
-                                energy_list_path, log_filename, tbegin, tend,
-                                join_energy_path, groupterms, avg, acf_list_path)
-
-                            now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                            m = f"\n\t\tOutput from Energy Analysis.({now})"
-                            m += f"\n\t\t{'*' * len(m)}\n"
-                            m += output.decode()
-                            m += error.decode()
-                            print(m) if logger is None else logger.info(m)
-
-                            st.success("Energy Analysis subprogram executed successfully!")
-                            warning_container.empty()
-
-                            # Output common directories
-                            output_directories = 'individual_energy'
-                            if not os.path.exists(output_directories):
-                                os.makedirs(output_directories)
-
-                            #   Output list of common files
-                            output_files = [
-                                f"{log_filename}"
-                            ]
-
-                            #   PROBLEMS WITH others output files
-
-                            # When use --joinpath options, include this aditional file
-                            if join_energy_path:
-                                output_files.extend([
-                                    "united_edr.edr"
-                                ])
-
-                            if groupterms:
-                                output_directories_add = ['grouped_energy', 'grouped_density']
-                                for directory in output_directories_add:
-                                    if not os.path.exists(directory):
-                                        os.makedirs(directory)
-                                output_files.extend(
-                                    output_directories_add)
-
-                            if acf_list_path:
-                                output_directories.append('individual_acf')
-                                output_files.extend([
-                                    "acf_data.dat"
-                                ])
-
-                            output_files.append(output_directories)
-
-                            # Move generated files to the output directory
-                            for filename in os.listdir(temp_dir):
-                                filepath = os.path.join(temp_dir, filename)
-                                if os.path.isfile(filepath):
-                                    shutil.move(filepath, os.path.join(output_folder, filename))
-
-                            output_files.append(output_directories)  # Add directories
-                            # output_files.append(output_directories_add)
-
-                            # Build compressed file '.tar.gz' of the output files
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link to the compressed output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
-
-
-def run_page_energy_analysis():
-
-    func_page_energy_analysis()
+                    # Uploaded inputs live in a temporary directory until the job has finished with them
+                    temp_dir = tempfile.mkdtemp()
+                    energy_list_path = save_uploaded_file(energy_list_path, temp_dir)
+                    join_energy_path = save_uploaded_file(join_energy_path,
+                                                          temp_dir) if join_energy_path else None
+                    acf_list_path = save_uploaded_file(acf_list_path,
+                                                       temp_dir) if acf_list_path else None
+                    get_job_engine().submit("Energy Analysis", compressed_file_name, run_energy_analysis_calc,
+                                            energy_list_path, log_filename, tbegin, tend, join_energy_path, groupterms,
+                                            avg, acf_list_path, backend=backend, max_runtime=max_runtime,
+                                            cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                    st.success(f"Energy Analysis job submitted ({backend.name}). You can keep working, "
+                               f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_energy_analysis(backend, max_runtime=None):
+
+    func_page_energy_analysis(backend, max_runtime)
+    show_jobs_panel("Energy Analysis", show_polyanagro_results)
@@ -1,14 +1,14 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, input_names, input_paths,
+                                                  show_polyanagro_results)
 
 
 # Logger configuration
@@ -16,7 +16,8 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_neighbor_sphere(coord_file, topo_file, log_filename):
+def run_neighbor_sphere(coord_file, topo_file, log_filename, backend=None,
+                        progress_callback=None, output_callback=None):
 
     # Get the directory path of the main code
     # script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -24,18 +25,16 @@ def run_neighbor_sphere(coord_file, topo_file, log_filename):
     # Build the path to the 'neighbor_sphere.py' code
     neighbor_sphere_script = "/home/cgarcia/Programs/polyanagro/polyanagro/cmds/neighbor_sphere.py"
 
-    bash_command = f"python {neighbor_sphere_script} -c {coord_file}"
+    bash_command = f"python {neighbor_sphere_script} -c {input_names(coord_file)}"
 
     if topo_file:
-        bash_command += f" -t {topo_file}"
+        bash_command += f" -t {input_names(topo_file)}"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-
-    return output, error
+    return run_polyanagro_command(bash_command, input_paths(coord_file, topo_file), backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -51,41 +50,13 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
-
-
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            tar.add(file_path, arcname=os.path.basename(file_path))
-
-    return temp_tar_path
-
-
 # ToDo: How to visualize molecules: VMD or JSMol?
 
 
-def func_page_neighbor_sphere():
+def func_page_neighbor_sphere(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>Neighbor Sphere</h1>", unsafe_allow_html=True)
 
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
-
     with st.expander("INFO"):
 
         # Displaying the welcome text
@@ -181,6 +152,9 @@ def func_page_neighbor_sphere():
 
         # Button to execute the program with the select options
         if st.button("RUN"):
+            if backend is None:
+                st.error("ERROR!!! Please enter all server options correctly")
+                return
             coord_file_path = options.get("input_file_1", "")
             topo_file_path = options.get("input_file_2", "")
 
@@ -196,65 +170,20 @@ def func_page_neighbor_sphere():
                 return
 
             if coord_file_path is not None:
-                with st.spinner("Running Neighbor Sphere. Please wait..."):
-                    warning_container = st.warning("Do not close the interface while Neighbor Sphere is running.")
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        # Use the unique identifier to create a unique directory to the output
-                        output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                        os.makedirs(output_folder)
-
-                        # Save selected files in the temporal directory
-                        coord_file_path = save_uploaded_file(coord_file_path, temp_dir)
-                        topo_file_path = save_uploaded_file(topo_file_path,
-                                                            temp_dir) if topo_file_path else None
-
-                        # Execute the command with path files provided
-                        output, error = run_neighbor_sphere(
-                            coord_file_path,
-                            topo_file_path,
-                            log_filename
-                        )
-
-                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                        m = f"\n\t\tOutput from Neighbor Sphere.({now})"
-                        m += f"\n\t\t{'*' * len(m)}\n"
-                        m += output.decode()
-                        m += error.decode()
-                        print(m) if logger is None else logger.info(m)
-
-                        st.success("Neighbor Sphere subprogram executed successfully!")
-                        warning_container.empty()
-
-                        #   Output list of common files
-                        output_files = [
-                            f"{log_filename}",
-                            "coords_com.pdb", "vmd_com.tcl", "wrapped.pdb"
-                        ]
-
-                        # Move generated files to single folder
-                        for filename in os.listdir(temp_dir):
-                            filepath = os.path.join(temp_dir, filename)
-                            if os.path.isfile(filepath):
-                                shutil.move(filepath, os.path.join(output_folder, filename))
-
-                        if compressed_file_name:
-
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link for output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
-
-
-def run_page_neighbor_sphere():
-
-    func_page_neighbor_sphere()
+                # Uploaded inputs live in a temporary directory until the job has finished with them
+                temp_dir = tempfile.mkdtemp()
+                coord_file_path = save_uploaded_file(coord_file_path, temp_dir)
+                topo_file_path = save_uploaded_file(topo_file_path,
+                                                    temp_dir) if topo_file_path else None
+                get_job_engine().submit("Neighbor Sphere", compressed_file_name, run_neighbor_sphere,
+                                        coord_file_path, topo_file_path, log_filename, backend=backend,
+                                        max_runtime=max_runtime,
+                                        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                st.success(f"Neighbor Sphere job submitted ({backend.name}). You can keep working, "
+                           f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_neighbor_sphere(backend, max_runtime=None):
+
+    func_page_neighbor_sphere(backend, max_runtime)
+    show_jobs_panel("Neighbor Sphere", show_polyanagro_results)
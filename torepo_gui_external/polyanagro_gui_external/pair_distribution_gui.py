@@ -1,14 +1,15 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, run_polyanagro_chunked,
+                                                  run_polyanagro_incremental, input_names, input_paths,
+                                                  shell_words, show_polyanagro_results)
 
 
 # Logger configuration
@@ -16,33 +17,53 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_pair_distribution(traj_files, topo_file,
-                          log_filename, stride, sets, dr):
+def pair_distribution_command(traj_files, topo_file, log_filename, stride, sets, dr):
+    """pair_distribution command line and the input files it needs (see run_pair_distribution)."""
 
-    bash_command = f"pair_distribution -t {traj_files}"
+    bash_command = f"pair_distribution -t {input_names(traj_files)}"
 
     if topo_file.endswith(".tpr"):
-        bash_command += f" --tpr {topo_file}"
+        bash_command += f" --tpr {input_names(topo_file)}"
 
     if topo_file.endswith(".psf"):
-        bash_command += f" --psf {topo_file}"
+        bash_command += f" --psf {input_names(topo_file)}"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
     if stride:
         bash_command += f" --stride {stride}"
 
     if sets:
-        bash_command += f" --sets {sets}"
+        bash_command += f" --sets {shell_words(sets)}"
 
     if dr:
         bash_command += f" --dr {dr}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    return bash_command, input_paths(traj_files, topo_file)
+
+
+def run_pair_distribution(traj_files, topo_file,
+                          log_filename, stride, sets, dr, backend=None, workers=1, incremental=False,
+                          progress_callback=None, output_callback=None):
+
+    if incremental:
+        # Only the frames added since the last run are analysed (see run_polyanagro_incremental)
+        return run_polyanagro_incremental(lambda files: pair_distribution_command(files, topo_file, log_filename,
+                                                                                  stride, sets, dr),
+                                          traj_files, stride, backend,
+                                          progress_callback=progress_callback, output_callback=output_callback)
+
+    if workers > 1:
+        # The g(r) of each part of the trajectory are merged (see run_polyanagro_chunked)
+        return run_polyanagro_chunked(lambda files: pair_distribution_command(files, topo_file, log_filename,
+                                                                              stride, sets, dr),
+                                      traj_files, stride, workers, backend,
+                                      progress_callback=progress_callback, output_callback=output_callback)
 
-    return output, error
+    bash_command, input_files = pair_distribution_command(traj_files, topo_file, log_filename, stride, sets, dr)
+    return run_polyanagro_command(bash_command, input_files, backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -71,31 +92,10 @@ def show_output_files_content(output_file_paths, log_filename):
         st.error(f"Warning: {log_filename} not found in the output files")
 
 
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            if os.path.exists(file_path):  # Check if file exists
-                tar.add(file_path, arcname=os.path.basename(file_path))
-            else:
-                print(f"Warning: File not found - {file_path}")
-
-    if os.path.exists(temp_tar_path):
-        return temp_tar_path
-    else:
-        return None
-
-
 # ToDo: How to visualize molecules: VMD or JSMol?
 
 
-def func_page_pair_distribution():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_pair_distribution(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>Pair Distribution</h1>", unsafe_allow_html=True)
     with st.expander("INFO"):
@@ -201,6 +201,18 @@ def func_page_pair_distribution():
 
         dr = st.number_input("Enter the bin width for the histogram (angstroms)", step=0.1, value=None, format="%.1f")
 
+        #   ============================    Parallel options   ============================    #
+
+        workers = st.number_input("Parallel workers", min_value=1, step=1, value=1,
+                                  help="Runs over the parts of a split XTC trajectory at the same time and "
+                                       "merges their histograms")
+
+        #   ============================    Incremental options   ============================    #
+
+        incremental = st.toggle("Analyse only the frames added since the last run",
+                                help="For a trajectory still growing (XTC): the g(r) of the last run is "
+                                     "updated with the new frames")
+
         #   ============================    Compressed file options   ============================    #
 
         compressed_file_name = st.text_input("Enter the name for the output compressed file*")
@@ -209,6 +221,9 @@ def func_page_pair_distribution():
 
         # Button to execute the subprogram with the select options
         if st.button("RUN"):
+            if backend is None:
+                st.error("ERROR!!! Please enter all server options correctly")
+                return
             traj_files_path = options.get("input_file_1", "")
             topo_file_path = options.get("input_file_2", "")
 
@@ -227,65 +242,20 @@ def func_page_pair_distribution():
                 return
 
             if traj_files_path and topo_file_path is not None:
-                with st.spinner("Running Pair Distribution. Please wait..."):
-                    warning_container = st.warning("Do not close the interface while Pair Distribution is running.")
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        # Use the unique identifier to create a unique directory to the output
-                        output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                        os.makedirs(output_folder)
-
-                        # Save selected files in the temporal directory
-                        traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
-                        topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
-
-                        # Execute the command with path files provided
-                        output, error = run_pair_distribution(
-                            traj_files_path, topo_file_path,
-                            log_filename, stride, sets, dr
-                        )
-
-                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                        m = f"\n\t\tOutput from Pair Distribution.({now})"
-                        m += f"\n\t\t{'*' * len(m)}\n"
-                        m += output.decode()
-                        m += error.decode()
-                        print(m) if logger is None else logger.info(m)
-
-                        st.success("Pair Distribution subprogram executed successfully!")
-                        warning_container.empty()
-
-                        if not log_filename or log_filename.strip() == "":
-                            log_filename = "pol_rdf.log"
-
-                        #   Output list of common files
-                        output_files = [
-                            f"{log_filename}.log"   # Error: Not file found
-                        ]
-
-                        # Move generated files to single folder
-                        for filename in os.listdir(temp_dir):
-                            filepath = os.path.join(temp_dir, filename)
-                            if os.path.isfile(filepath):
-                                shutil.move(filepath, os.path.join(output_folder, filename))
-
-                        if compressed_file_name:
-
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link for output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
-
-
-def run_page_pair_distribution():
-
-    func_page_pair_distribution()
+                # Uploaded inputs live in a temporary directory until the job has finished with them
+                temp_dir = tempfile.mkdtemp()
+                traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+                topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
+                get_job_engine().submit("Pair Distribution", compressed_file_name, run_pair_distribution,
+                                        traj_files_path, topo_file_path, log_filename, stride, sets, dr,
+                                        workers=workers, incremental=incremental, backend=backend,
+                                        max_runtime=max_runtime,
+                                        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                st.success(f"Pair Distribution job submitted ({backend.name}). You can keep working, "
+                           f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_pair_distribution(backend, max_runtime=None):
+
+    func_page_pair_distribution(backend, max_runtime)
+    show_jobs_panel("Pair Distribution", show_polyanagro_results)
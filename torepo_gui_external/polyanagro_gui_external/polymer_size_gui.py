@@ -1,14 +1,14 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, run_polyanagro_incremental, input_names,
+                                                  input_paths, show_polyanagro_results)
 
 
 # Logger configuration
@@ -16,25 +16,25 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_polymer_size(traj_files, topo_file, stride, fraction_trj_average,
-                     end_to_end_distances, end_to_end_acf, c2n_input, log_filename, ree_rg_distributions,
-                     bond_orientation, unwrap_coordinates, rg_massw,
-                     legendre_polynomials):
+def polymer_size_command(traj_files, topo_file, stride, fraction_trj_average,
+                         end_to_end_distances, end_to_end_acf, c2n_input, log_filename, ree_rg_distributions,
+                         bond_orientation, unwrap_coordinates, rg_massw, legendre_polynomials):
+    """polymer_size command line and the input files it needs (see run_polymer_size)."""
 
-    bash_command = f"polymer_size -t {traj_files} --topo {topo_file}"
+    bash_command = f"polymer_size -t {input_names(traj_files)} --topo {input_names(topo_file)}"
 
     if stride:
         bash_command += f" --stride {stride}"
     if fraction_trj_average:
         bash_command += f" --fraction_trj_avg {fraction_trj_average}"
     if end_to_end_distances:
-        bash_command += f" --e2e {end_to_end_distances}"
+        bash_command += f" --e2e {input_names(end_to_end_distances)}"
     if end_to_end_acf:
         bash_command += " --e2acf"
     if c2n_input:
-        bash_command += f" --c2n {c2n_input}"
+        bash_command += f" --c2n {input_names(c2n_input)}"
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
     if ree_rg_distributions:
         bash_command += " -d"
     if bond_orientation:
@@ -49,10 +49,31 @@ def run_polymer_size(traj_files, topo_file, stride, fraction_trj_average,
     if legendre_polynomials:
         bash_command += " --isodf"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    return bash_command, input_paths(traj_files, topo_file, end_to_end_distances, c2n_input)
 
-    return output, error
+
+def run_polymer_size(traj_files, topo_file, stride, fraction_trj_average,
+                     end_to_end_distances, end_to_end_acf, c2n_input, log_filename, ree_rg_distributions,
+                     bond_orientation, unwrap_coordinates, rg_massw,
+                     legendre_polynomials, backend=None, incremental=False,
+                     progress_callback=None, output_callback=None):
+
+    if incremental:
+        # Only the frames added since the last run are analysed (see run_polyanagro_incremental)
+        return run_polyanagro_incremental(
+            lambda files: polymer_size_command(files, topo_file, stride, fraction_trj_average,
+                                               end_to_end_distances, end_to_end_acf, c2n_input, log_filename,
+                                               ree_rg_distributions, bond_orientation, unwrap_coordinates,
+                                               rg_massw, legendre_polynomials),
+            traj_files, stride, backend,
+                                          progress_callback=progress_callback, output_callback=output_callback)
+
+    bash_command, input_files = polymer_size_command(traj_files, topo_file, stride, fraction_trj_average,
+                                                     end_to_end_distances, end_to_end_acf, c2n_input, log_filename,
+                                                     ree_rg_distributions, bond_orientation, unwrap_coordinates,
+                                                     rg_massw, legendre_polynomials)
+    return run_polyanagro_command(bash_command, input_files, backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -68,41 +89,7 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
-
-
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            if os.path.exists(file_path):  # Check if file exists
-                tar.add(file_path, arcname=os.path.basename(file_path))
-            else:
-                print(f"Warning: File not found - {file_path}")
-
-    if os.path.exists(temp_tar_path):
-        return temp_tar_path
-    else:
-        return None
-
-
-def func_page_polymer_size():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_polymer_size(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>Polymer Size</h1>", unsafe_allow_html=True)
 
@@ -255,6 +242,13 @@ def func_page_polymer_size():
                                          "and 2nd Legendre polynomials "
                                          "for the correlation between bonds in a polymer chain")
 
+        #   ============================    Incremental options   ============================    #
+
+        incremental = st.toggle("Analyse only the frames added since the last run",
+                                help="For a trajectory still growing (XTC): the time series and distributions "
+                                     "of the last run are updated with the new frames. The other outputs "
+                                     "(autocorrelations, gnuplot scripts) are kept from the last run")
+
         #   ============================    Compressed file options   ============================    #
 
         compressed_file_name = st.text_input("Enter the name for the output compressed file*")
@@ -263,6 +257,9 @@ def func_page_polymer_size():
 
         # Button to execute the subprogram with the select options
         if st.button("RUN"):
+            if backend is None:
+                st.error("ERROR!!! Please enter all server options correctly")
+                return
             traj_files_path = options.get("input_file_1", "")
             topo_file_path = options.get("input_file_2", "")
             end_to_end_distances_path = options.get("input_file_3", "")
@@ -282,86 +279,32 @@ def func_page_polymer_size():
                 st.error("Please enter the name for the output compressed file")
                 return
 
+            if incremental and (fraction_trj_average or end_to_end_acf):
+                st.error("The fraction of the trajectory and the end to end autocorrelation need the whole "
+                         "trajectory, they cannot be calculated incrementally")
+                return
+
             if traj_files_path and topo_file_path is not None:
-                with st.spinner("Running Polymer Size. Please wait..."):
-                    warning_container = st.warning("Do not close the interface while Polymer Size is running.")
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        # Use the unique identifier to create a unique directory to the output
-                        output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                        os.makedirs(output_folder)
-
-                        # Save selected files in the temporal directory
-                        traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
-                        topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
-                        end_to_end_distances_path = save_uploaded_file(end_to_end_distances_path,
-                                                                       temp_dir) if end_to_end_distances_path else None
-                        c2n_input_path = save_uploaded_file(c2n_input_path,
-                                                            temp_dir) if c2n_input_path else None
-
-                        # Execute the command with path files provided
-                        output, error = run_polymer_size(
-                            traj_files_path, topo_file_path, stride, fraction_trj_average,
-                            end_to_end_distances_path, end_to_end_acf,
-                            c2n_input_path, log_filename, ree_rg_distributions,
-                            bond_orientation, unwrap_coordinates, rg_massw,
-                            legendre_polynomials
-                        )
-
-                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                        m = f"\n\t\tOutput from Polymer Size.({now})"
-                        m += f"\n\t\t{'*' * len(m)}\n"
-                        m += output.decode()
-                        m += error.decode()
-                        print(m) if logger is None else logger.info(m)
-
-                        st.success("Polymer Size subprogram executed successfully!")
-                        warning_container.empty()
-
-                        #   Output common files
-                        output_files = [
-                            f"{log_filename}",
-                            "gnuplot_charratio.gnu", "gnuplot_dimensions.gnu",
-                            "gnuplot_distributions.gnu", "Rg.dat"
-                        ]
-
-                        # If end_to_end_distances file is activated, include these aditional files
-                        if end_to_end_distances_path:
-                            output_files.extend([
-                                "Ree2Rg2.dat",  # not file found:
-                                                # TerminalTypeError: 'NoneType' object is not subscriptable
-                                                # There is an error within polymer_size subprogram
-                                "Ree.dat"   # not file found
-                            ])
-
-                        # If rg_masss is activated, include these aditional files
-                        if rg_massw:
-                            output_files.extend([
-                                "Rg_mass.dat"
-                            ])
-
-                        # Move generated files to single folder
-                        for filename in os.listdir(temp_dir):
-                            filepath = os.path.join(temp_dir, filename)
-                            if os.path.isfile(filepath):
-                                shutil.move(filepath, os.path.join(output_folder, filename))
-
-                        if compressed_file_name:
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link for output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compresseed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
-
-
-def run_page_polymer_size():
-
-    func_page_polymer_size()
+                # Uploaded inputs live in a temporary directory until the job has finished with them
+                temp_dir = tempfile.mkdtemp()
+                traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+                topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
+                end_to_end_distances_path = save_uploaded_file(end_to_end_distances_path,
+                                                               temp_dir) if end_to_end_distances_path else None
+                c2n_input_path = save_uploaded_file(c2n_input_path,
+                                                    temp_dir) if c2n_input_path else None
+                get_job_engine().submit("Polymer Size", compressed_file_name, run_polymer_size,
+                                        traj_files_path, topo_file_path, stride, fraction_trj_average,
+                                        end_to_end_distances_path, end_to_end_acf, c2n_input_path, log_filename,
+                                        ree_rg_distributions, bond_orientation, unwrap_coordinates, rg_massw,
+                                        legendre_polynomials, incremental=incremental, backend=backend,
+                                        max_runtime=max_runtime,
+                                        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                st.success(f"Polymer Size job submitted ({backend.name}). You can keep working, "
+                           f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_polymer_size(backend, max_runtime=None):
+
+    func_page_polymer_size(backend, max_runtime)
+    show_jobs_panel("Polymer Size", show_polyanagro_results)
@@ -0,0 +1,43 @@
+import streamlit as st
+import os
+import time
+import logging
+from functions.polyanagro.result_cache import list_results, load_result, forget_result, RESULT_CACHE_MAX_BYTES
+from torepo_gui_external.polyanagro_gui_external.pair_distribution_gui import show_output_files_content
+
+
+# Logger configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def func_page_previous_results():
+
+    st.markdown("<h1 style='font-size:24px;'>Previous Results</h1>", unsafe_allow_html=True)
+
+    entries = list_results()
+    total_size = sum(entry["size"] for entry in entries)
+    st.write(f"{len(entries)} results kept, {total_size / 1024 ** 2:.1f} MB of "
+             f"{RESULT_CACHE_MAX_BYTES / 1024 ** 2:.0f} MB (the least recently used are removed first)")
+
+    for entry in entries:
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created"]))
+        with st.expander(f"{entry['tool']} - {created} ({len(entry['files'])} files)"):
+            st.code(entry["command"], language="bash")
+            col1, col2 = st.columns(2)
+            with col1:
+                show = st.button("Show", key=f"show_result_{entry['key']}")
+            with col2:
+                if st.button("Remove", key=f"remove_result_{entry['key']}"):
+                    forget_result(entry["key"])
+                    st.rerun()
+
+            # The files are copied back into the current directory, as if the analysis had just run
+            if show and load_result(entry["key"], os.getcwd()):
+                for log_filename in [name for name in entry["files"] if name.endswith(".log")]:
+                    show_output_files_content([log_filename], log_filename)
+
+
+def run_page_previous_results():
+
+    func_page_previous_results()
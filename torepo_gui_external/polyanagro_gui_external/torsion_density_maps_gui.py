@@ -1,14 +1,14 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import (run_polyanagro_command, run_polyanagro_chunked, input_names,
+                                                  input_paths, show_polyanagro_results)
 
 
 # Logger configuration
@@ -16,10 +16,11 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_2d_torsion_density_maps(traj_files, topo_file, phipsi, phipsi_2,
-                                log_filename, stride, unwrap_coordinates):
+def torsion_density_maps_command(traj_files, topo_file, phipsi, phipsi_2, log_filename, stride, unwrap_coordinates):
+    """2D_torsion_density_maps command line and the input files it needs (see run_2d_torsion_density_maps)."""
 
-    bash_command = f"2D_torsion_density_maps -t {traj_files} --topo {topo_file} --phipsi {phipsi} {phipsi_2}"
+    bash_command = (f"2D_torsion_density_maps -t {input_names(traj_files)} --topo {input_names(topo_file)}"
+                    f" --phipsi {input_names(phipsi)} {input_names(phipsi_2)}")
 
     if unwrap_coordinates:
         bash_command += " --unwrap True"
@@ -27,15 +28,30 @@ def run_2d_torsion_density_maps(traj_files, topo_file, phipsi, phipsi_2,
         bash_command += " --unwrap False"
 
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
 
     if stride:
         bash_command += f" --stride {stride}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    return bash_command, input_paths(traj_files, topo_file, phipsi, phipsi_2)
+
+
+def run_2d_torsion_density_maps(traj_files, topo_file, phipsi, phipsi_2,
+                                log_filename, stride, unwrap_coordinates, backend=None, workers=1,
+                                progress_callback=None, output_callback=None):
+
+    if workers > 1:
+        # The phi-psi maps of each part of the trajectory are merged (see run_polyanagro_chunked)
+        return run_polyanagro_chunked(lambda files: torsion_density_maps_command(files, topo_file, phipsi, phipsi_2,
+                                                                                 log_filename, stride,
+                                                                                 unwrap_coordinates),
+                                      traj_files, stride, workers, backend,
+                                      progress_callback=progress_callback, output_callback=output_callback)
 
-    return output, error
+    bash_command, input_files = torsion_density_maps_command(traj_files, topo_file, phipsi, phipsi_2,
+                                                             log_filename, stride, unwrap_coordinates)
+    return run_polyanagro_command(bash_command, input_files, backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -51,38 +67,10 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
-
-
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            tar.add(file_path, arcname=os.path.basename(file_path))
-
-    return temp_tar_path
-
-
 # ToDo: How to visualize molecules: VMD or JSMol?
 
 
-def func_page_2d_torsion():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_2d_torsion(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>2D Torsion Density Maps</h1>", unsafe_allow_html=True)
 
@@ -187,6 +175,12 @@ def func_page_2d_torsion():
 
         stride = st.number_input("Frame numbers for each stride frames", min_value=1, step=1, value=None)
 
+        #   ============================    Parallel options   ============================    #
+
+        workers = st.number_input("Parallel workers", min_value=1, step=1, value=1,
+                                  help="Runs over the parts of a split XTC trajectory at the same time and "
+                                       "merges their histograms")
+
         #   ============================    Compressed file options   ============================    #
 
         compressed_file_name = st.text_input("Enter the name for the output compressed file*")
@@ -195,6 +189,9 @@ def func_page_2d_torsion():
 
         # Button to execute the subprogram with the select options
         if st.button("RUN"):
+            if backend is None:
+                st.error("ERROR!!! Please enter all server options correctly")
+                return
             traj_files_path = options.get("input_file_1", "")
             topo_file_path = options.get("input_file_2", "")
             phipsi_path = options.get("input_file_3", "")
@@ -222,70 +219,22 @@ def func_page_2d_torsion():
                 return
 
             if traj_files_path and topo_file_path and phipsi_path and phipsi_path_2 is not None:
-                with st.spinner("Running 2D Torsion Density Maps. Please wait..."):
-                    warning_container = st.warning("Do not close the interface "
-                                                   "while 2D Torsion Density Maps is running.")
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        # Use the unique identifier to create a unique directory to the output
-                        output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                        os.makedirs(output_folder)
-
-                        # Save selected files in the temporal directory
-                        traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
-                        topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
-                        phipsi_path = save_uploaded_file(phipsi_path, temp_dir)
-                        phipsi_path_2 = save_uploaded_file(phipsi_path_2, temp_dir)
-
-                        # Execute command with path files provided
-                        output, error = run_2d_torsion_density_maps(
-                            traj_files_path,
-                            topo_file_path,
-                            phipsi_path,
-                            phipsi_path_2,
-                            log_filename, stride, unwrap_coordinates
-                        )
-
-                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                        m = f"\n\t\tOutput from 2D Torsion Density Maps.({now})"
-                        m += f"\n\t\t{'*' * len(m)}\n"
-                        m += output.decode()
-                        m += error.decode()
-                        print(m) if logger is None else logger.info(m)
-
-                        st.success("2D Torsion Density Maps subprogram executed successfully!")
-                        warning_container.empty()
-
-                        #   Output list of common files
-                        output_files = [
-                            f"{log_filename}"
-                        ]
-
-                        #   ====    CONTINUE ...   ====
-
-                        # Move generated files to single folder
-                        for filename in os.listdir(temp_dir):
-                            filepath = os.path.join(temp_dir, filename)
-                            if os.path.isfile(filepath):
-                                shutil.move(filepath, os.path.join(output_folder, filename))
-
-                        if compressed_file_name:
-
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link for output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
-
-
-def run_page_2d_torsion():
-
-    func_page_2d_torsion()
+                # Uploaded inputs live in a temporary directory until the job has finished with them
+                temp_dir = tempfile.mkdtemp()
+                traj_files_path = save_uploaded_file(traj_files_path, temp_dir)
+                topo_file_path = save_uploaded_file(topo_file_path, temp_dir)
+                phipsi_path = save_uploaded_file(phipsi_path, temp_dir)
+                phipsi_path_2 = save_uploaded_file(phipsi_path_2, temp_dir)
+                get_job_engine().submit("2D Torsion Density Maps", compressed_file_name, run_2d_torsion_density_maps,
+                                        traj_files_path, topo_file_path, phipsi_path, phipsi_path_2, log_filename,
+                                        stride, unwrap_coordinates, workers=workers, backend=backend,
+                                        max_runtime=max_runtime,
+                                        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                st.success(f"2D Torsion Density Maps job submitted ({backend.name}). You can keep working, "
+                           f"or close the tab: the job is followed again when TOREPO is opened.")
+
+
+def run_page_2d_torsion(backend, max_runtime=None):
+
+    func_page_2d_torsion(backend, max_runtime)
+    show_jobs_panel("2D Torsion Density Maps", show_polyanagro_results)
@@ -1,14 +1,13 @@
 import streamlit as st
 import os
-import subprocess
-import datetime
+import shlex
 import logging
 import shutil
-import tarfile
-import time
 import tempfile
-import base64
 from tkinter import filedialog
+from functions.common.common_functions import show_jobs_panel
+from functions.common.job_engine import get_job_engine
+from functions.polyanagro.polyanagro_func import run_polyanagro_command, show_polyanagro_results
 
 
 # Logger configuration
@@ -17,9 +16,10 @@ logger = logging.getLogger(__name__)
 
 
 def run_votca_analysis(path_steps, begin_step, temp_k,
-                       end_step, dir_tmp, log_filename, press):
+                       end_step, dir_tmp, log_filename, press, backend=None,
+                       progress_callback=None, output_callback=None):
 
-    bash_command = f"votca_analysis ibi -p {path_steps}"
+    bash_command = f"votca_analysis ibi -p {shlex.quote(path_steps)}"
 
     if begin_step:
         bash_command += f" -b {begin_step}"
@@ -30,27 +30,13 @@ def run_votca_analysis(path_steps, begin_step, temp_k,
     if dir_tmp:
         bash_command += " --tmpdir"
     if log_filename:
-        bash_command += f" --log {log_filename}"
+        bash_command += f" --log {shlex.quote(log_filename)}"
     if press:
-        bash_command += f" --press {press}"
+        bash_command += f" --press {shlex.quote(press)}"
 
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-
-    return output, error
-
-
-def show_output_files_content(output_file_paths, log_filename):
-    # Check if the log file is present in the list of output files
-    log_file_path = next((path for path in output_file_paths if log_filename in path), None)
-
-    if log_file_path:
-        st.write(f"### {os.path.basename(log_file_path)}")
-        with open(log_file_path, "r") as output_file:
-            file_content = output_file.read()
-            st.text_area("File content:", value=file_content, height=300)
-    else:
-        st.error(f"Warning: {log_filename} not found in the output files")
+    # path_steps is a directory of the machine the backend runs on, it is not staged
+    return run_polyanagro_command(bash_command, backend=backend,
+                                  progress_callback=progress_callback, output_callback=output_callback)
 
 
 def save_uploaded_file(uploaded_file, directory):
@@ -66,25 +52,10 @@ def save_uploaded_file(uploaded_file, directory):
     return file_path
 
 
-def create_tar_gz(output_folder, output_file_paths):
-    # Create a temporary file to store the .tar.gz
-    temp_tar_path = os.path.join(output_folder, "output_files.tar.gz")
-
-    # Create the .tar.gz file
-    with tarfile.open(temp_tar_path, "w:gz") as tar:
-        for file_path in output_file_paths:
-            tar.add(file_path, arcname=os.path.basename(file_path))
-
-    return temp_tar_path
-
-
 # ToDo: How to visualize molecules: VMD or JSMol?
 
 
-def func_page_votca_analysis():
-
-    # Create a unique identifier for this run
-    unique_id = str(int(time.time()))
+def func_page_votca_analysis(backend, max_runtime):
 
     st.markdown("<h1 style='font-size:24px;'>VOTCA Analysis</h1>", unsafe_allow_html=True)
 
@@ -207,6 +178,9 @@ def func_page_votca_analysis():
 
         # Button to execute the subprogram with the select options
         if st.button("RUN"):
+            if backend is None:
+                st.error("ERROR!!! Please enter all server options correctly")
+                return
 
             press_path = options.get("input_file_1", "")
 
@@ -222,64 +196,18 @@ def func_page_votca_analysis():
                 return
 
             if path_steps is not None:
-                with st.spinner("Running Votca Analysis. Please wait..."):
-                    warning_container = st.warning("Do not close the interface "
-                                                   "while Votca Analysis is running.")
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        # Use the unique identifier to create a unique directory to the output
-                        output_folder = os.path.join(temp_dir, f"output_{unique_id}")
-                        os.makedirs(output_folder)
-
-                        # Save selected files in the temporal directory
-                        press_path = save_uploaded_file(press_path, temp_dir)
-
-                        # Execute command with path files provided
-                        output, error = run_votca_analysis(
-                            path_steps, begin_step, temp_k,
-                            end_step, dir_tmp, log_filename, press_path
-                        )
-
-                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-                        m = f"\n\t\tOutput from Votca Analysis.({now})"
-                        m += f"\n\t\t{'*' * len(m)}\n"
-                        m += output.decode()
-                        m += error.decode()
-                        print(m) if logger is None else logger.info(m)
-
-                        st.success("Votca Analysis subprogram executed successfully!")
-                        warning_container.empty()
-
-                        #   Output list of common files
-                        output_files = [
-                            f"{log_filename}"   # No file found
-                        ]
-
-                        # = UNKNOWN output files = #
-
-                        # Move generated files to single folder
-                        for filename in os.listdir(temp_dir):
-                            filepath = os.path.join(temp_dir, filename)
-                            if os.path.isfile(filepath):
-                                shutil.move(filepath, os.path.join(output_folder, filename))
-
-                        if compressed_file_name:
-
-                            tar_file_path = create_tar_gz(output_folder, output_files)
-
-                            # Generate download link for output files
-                            download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                             f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                             f'" download="{compressed_file_name}.tar.gz">'
-                                             f'Download {compressed_file_name} compressed file</a>')
-                            st.markdown(download_link, unsafe_allow_html=True)
-
-                            # Show output file names
-                            show_output_files_content(output_files, log_filename)
-
-                            if st.button("RESET"):
-                                st.experimental_rerun()
+                # Uploaded inputs live in a temporary directory until the job has finished with them
+                temp_dir = tempfile.mkdtemp()
+                press_path = save_uploaded_file(press_path, temp_dir)
+                get_job_engine().submit("Votca Analysis", compressed_file_name, run_votca_analysis,
+                                        path_steps, begin_step, temp_k, end_step, dir_tmp, log_filename, press_path,
+                                        backend=backend, max_runtime=max_runtime,
+                                        cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                st.success(f"Votca Analysis job submitted ({backend.name}). You can keep working, "
+                           f"or close the tab: the job is followed again when TOREPO is opened.")
 
 
-def run_page_votca_analysis():
+def run_page_votca_analysis(backend, max_runtime=None):
 
-    func_page_votca_analysis()
+    func_page_votca_analysis(backend, max_runtime)
+    show_jobs_panel("Votca Analysis", show_polyanagro_results)
@@ -4,9 +4,15 @@ import tempfile
 import base64
 import shutil
 from torepo_gui_external.server_options import ServerScreen
-from functions.common.common_functions import save_uploaded_file, create_tar_gz, clean_options
+from functions.common.common_functions import (save_uploaded_file, create_tar_gz, clean_options, show_jobs_panel,
+                                               suggest_slurm_resources, show_resource_suggestion)
+from functions.common.job_engine import get_job_engine
 from functions.replicate_polymer.replicate_func import (handle_button_click, run_replicate_cmd_remote,
-                                                        show_info_log_content)
+                                                        show_info_log_content, run_replicate_sweep_remote,
+                                                        parse_sweep_values, build_replicate_sweep,
+                                                        sweep_image_multiplier)
+from functions.common.slurm_resources import count_atoms
+from functions.common.execution_backend import BACKEND_SLURM
 
 
 class ReplicateScreen:
@@ -56,6 +62,10 @@ class ReplicateScreen:
         self._mdengine = None
         self._noh = None
         self._verbose = None
+        self._sweep_mode = None
+        self._sweep_images = None
+        self._sweep_boxlengths = None
+        self._sweep_npairs = None
 
         server_screen = ServerScreen()
         self._server_valid = server_screen.show_screen_sidebar()
@@ -65,6 +75,9 @@ class ReplicateScreen:
         self._ssh_key_options = server_screen._ssh_key_options
         self._path_virtualenv = server_screen._path_virtualenv
         self._working_directory = server_screen._working_directory
+        self._remote_environment = server_screen._remote_environment
+        self._max_runtime = server_screen._max_runtime
+        self._backend = server_screen.execution_backend()
 
     def show_screen(self):
 
@@ -167,6 +180,31 @@ class ReplicateScreen:
                                   st.session_state.get("verbose", False))
         st.session_state.verbose = self._verbose
 
+        #   ============================    Sweep options   ============================    #
+
+        self._sweep_mode = st.toggle("Sweep mode: run a grid of images, box lengths and npairs as one SLURM job array",
+                                     st.session_state.get("sweep_mode", False))
+        st.session_state.sweep_mode = self._sweep_mode
+        if self._sweep_mode:
+            st.info("In sweep mode the images, box lengths and npairs above are replaced by the lists below")
+            self._sweep_images = st.text_area("Images to sweep: x,y,z (one set per line)*",
+                                              st.session_state.get("sweep_images", "1,1,1"))
+            st.session_state.sweep_images = self._sweep_images
+
+            self._sweep_boxlengths = st.text_input("Box lengths to sweep in nanometers: a,b,c (sets separated by ';')",
+                                                   st.session_state.get("sweep_boxlengths", ""))
+            st.session_state.sweep_boxlengths = self._sweep_boxlengths
+
+            self._sweep_npairs = st.text_input("Npairs values to sweep (separated by spaces)",
+                                               st.session_state.get("sweep_npairs", ""))
+            st.session_state.sweep_npairs = self._sweep_npairs
+
+        #   ============================    SLURM resources   ============================    #
+
+        show_resource_suggestion("replicate_polymer", self._suggest_resources,
+                                 "Estimated from the atoms of the structure, the images (the largest of the sweep) "
+                                 "and the accounting of previous runs")
+
         #   ============================    Clean and run buttons   ============================    #
         left, right = st.columns(2)
         #   ========    Clean button   ========    #
@@ -176,86 +214,145 @@ class ReplicateScreen:
         with left:
             button_run = st.button("RUN REPLICATE POLYMER")
         if button_run:
-            if not self._server_valid:
-                st.error("Please check if server options are filled correctly")
-                return
+            self._submit_run()
 
-            structure_file_path = self._input_options.get("input_file_000", "")
-            xml_file_path = self._input_options.get("input_file_001", "")
-            impropers_file_path = self._input_options.get("input_file_002", "")
+        #   ============================    Background jobs   ============================    #
+        show_jobs_panel("Replicate Polymer", show_replicate_results)
 
-            if not structure_file_path:
-                st.error("Please upload a pdb file before running the program")
-                return
+    def _suggest_resources(self):
+        """Fill in the SLURM resources for the largest image multiplier of the sweep, or of the single run."""
+        structure_file_path = self._input_options.get("input_file_000", "")
+        atom_count = count_atoms(structure_file_path) if structure_file_path else None
+        if self._sweep_mode:
+            try:
+                sweep = build_replicate_sweep(parse_sweep_values(self._sweep_images, 3, int))
+            except ValueError:
+                sweep = []
+            image_multiplier = max([sweep_image_multiplier(task) for task in sweep] or [1])
+        else:
+            image_multiplier = (self._image_x or 1) * (self._image_y or 1) * (self._image_z or 1)
+        suggest_slurm_resources("replicate_polymer", atom_count, image_multiplier,
+                                self._name_server, self._name_user, self._ssh_key_options)
+
+    def _submit_run(self):
+        if not self._server_valid:
+            st.error("Please check if server options are filled correctly")
+            return
+
+        structure_file_path = self._input_options.get("input_file_000", "")
+        xml_file_path = self._input_options.get("input_file_001", "")
+        impropers_file_path = self._input_options.get("input_file_002", "")
+
+        if not structure_file_path:
+            st.error("Please upload a pdb file before running the program")
+            return
+
+        if not xml_file_path:
+            st.error("Please upload a FORCEFIELD file before running the program")
+            return
 
-            if not xml_file_path:
-                st.error("Please upload a FORCEFIELD file before running the program")
-                return
+        st.session_state["input_options"] = self._input_options
 
-            st.session_state["input_options"] = self._input_options
+        if not self._image_x:
+            st.error("Please enter the number of images to Replicate in Dimension X")
+            return
 
-            if not self._image_x:
-                st.error("Please enter the number of images to Replicate in Dimension X")
-                return
+        if not self._image_y:
+            st.error("Please enter the number of images to Replicate in Dimension Y")
+            return
 
-            if not self._image_y:
-                st.error("Please enter the number of images to Replicate in Dimension Y")
-                return
+        if not self._image_z:
+            st.error("Please enter the number of images to Replicate in Dimension Z")
+            return
 
-            if not self._image_z:
-                st.error("Please enter the number of images to Replicate in Dimension Z")
-                return
+        if not (isinstance(self._image_x, int) and self._image_x >= 1 and self._image_x % 1 == 0 and
+                isinstance(self._image_y, int) and self._image_y >= 1 and self._image_y % 1 == 0 and
+                isinstance(self._image_z, int) and self._image_z >= 1 and self._image_z % 1 == 0):
+            st.error("Please enter valid integer values greater than or equal "
+                     "to 1 for Number of Images before running the program")
+            return
 
-            if not (isinstance(self._image_x, int) and self._image_x >= 1 and self._image_x % 1 == 0 and
-                    isinstance(self._image_y, int) and self._image_y >= 1 and self._image_y % 1 == 0 and
-                    isinstance(self._image_z, int) and self._image_z >= 1 and self._image_z % 1 == 0):
-                st.error("Please enter valid integer values greater than or equal "
-                         "to 1 for Number of Images before running the program")
+        if self._sweep_mode:
+            try:
+                sweep = build_replicate_sweep(parse_sweep_values(self._sweep_images, 3, int),
+                                              parse_sweep_values(self._sweep_boxlengths, 3, float),
+                                              parse_sweep_values(self._sweep_npairs, 1, int))
+            except ValueError as e:
+                st.error(f"Please check the sweep values: {e}")
+                return
+            if not sweep:
+                st.error("Please enter at least one set of images to sweep")
+                return
+            if self._backend.name != BACKEND_SLURM or \
+                    (self._remote_environment and not self._remote_environment["slurm"]["sbatch"]):
+                st.error("ERROR!!! Sweep mode needs SLURM (sbatch) on the server: please enable the "
+                         "queuing system in the sidebar")
                 return
 
-            stop_button = st.button("STOP")
-            if stop_button:
-                st.warning("Replicate Polymer program has been stopped")
-
-            temp_dir = tempfile.mkdtemp()
-            try:
-                structure_file_path = save_uploaded_file(structure_file_path, temp_dir)
-                xml_file_path = save_uploaded_file(xml_file_path, temp_dir)
-                impropers_file_path = save_uploaded_file(impropers_file_path,
-                                                         temp_dir) if impropers_file_path else None
-
-                with st.spinner("Running Replicate Polymer. Please wait..."):
-                    warning_close_interface = st.warning("Do not close the interface "
-                                                         "while Replicate Polymer is running.")
-                    output, error, output_folder = run_replicate_cmd_remote(self._name_server, self._name_user,
-                                                                            self._ssh_key_options,
-                                                                            self._path_virtualenv,
-                                                                            self._working_directory,
-                                                                            structure_file_path,
-                                                                            xml_file_path,
-                                                                            impropers_file_path,
-                                                                            self._image_x, self._image_y, self._image_z,
-                                                                            self._index,
-                                                                            self._boxlength_a, self._boxlength_b,
-                                                                            self._boxlength_c,
-                                                                            self._boxangle_alpha, self._boxangle_beta,
-                                                                            self._boxangle_gamma,
-                                                                            self._npairs, self._mdengine,
-                                                                            self._noh, self._verbose)
-                    warning_close_interface.empty()
-                    st.success("Job Done!")
-
-                    #   ============================    Getting output files    ============================    #
-
-                    output_file_paths = [os.path.join(output_folder, f) for f in os.listdir(output_folder)]
-
-                    show_info_log_content(output_file_paths)
-                    tar_file_path = create_tar_gz(output_folder, output_file_paths)
-                    download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                     f'" download="replicate_polymer_output_files.tar.gz">'
-                                     f'Download Replicate Polymer output files</a>')
-                    st.markdown(download_link, unsafe_allow_html=True)
-
-            finally:
-                shutil.rmtree(temp_dir)
+        # Uploaded inputs live in a temporary directory until the job has finished with them
+        temp_dir = tempfile.mkdtemp()
+        structure_file_path = save_uploaded_file(structure_file_path, temp_dir)
+        xml_file_path = save_uploaded_file(xml_file_path, temp_dir)
+        impropers_file_path = save_uploaded_file(impropers_file_path,
+                                                 temp_dir) if impropers_file_path else None
+
+        if self._sweep_mode:
+            job_name = f"Sweep of {os.path.basename(structure_file_path)} ({len(sweep)} tasks)"
+            get_job_engine().submit("Replicate Polymer", job_name, run_replicate_sweep_remote,
+                                    self._name_server, self._name_user, self._ssh_key_options,
+                                    self._path_virtualenv, self._working_directory,
+                                    structure_file=structure_file_path, xml_file=xml_file_path, sweep=sweep,
+                                    mdengine=self._mdengine, noh=self._noh, index=self._index,
+                                    boxangle_alpha=self._boxangle_alpha, boxangle_beta=self._boxangle_beta,
+                                    boxangle_gamma=self._boxangle_gamma,
+                                    impropers=impropers_file_path, verbose=self._verbose,
+                                    backend=self._backend, max_runtime=self._max_runtime,
+                                    cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+            st.success(f"Replicate Polymer sweep of {len(sweep)} tasks submitted as one SLURM job array.")
+        else:
+            job_name = (f"{os.path.basename(structure_file_path)} "
+                        f"({self._image_x}x{self._image_y}x{self._image_z})")
+            get_job_engine().submit("Replicate Polymer", job_name, run_replicate_cmd_remote,
+                                    self._name_server, self._name_user, self._ssh_key_options,
+                                    self._path_virtualenv, self._working_directory,
+                                    structure_file=structure_file_path, xml_file=xml_file_path,
+                                    image_x=self._image_x, image_y=self._image_y, image_z=self._image_z,
+                                    mdengine=self._mdengine, noh=self._noh, index=self._index,
+                                    boxlength_a=self._boxlength_a, boxlength_b=self._boxlength_b,
+                                    boxlength_c=self._boxlength_c,
+                                    boxangle_alpha=self._boxangle_alpha, boxangle_beta=self._boxangle_beta,
+                                    boxangle_gamma=self._boxangle_gamma,
+                                    impropers=impropers_file_path, npairs=self._npairs,
+                                    verbose=self._verbose, backend=self._backend,
+                                    max_runtime=self._max_runtime,
+                                    cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+            st.success(f"Replicate Polymer job submitted ({self._backend.name}). "
+                       f"You can keep working while it runs.")
+
+
+def show_replicate_results(job):
+    output, error, output_folder = job.result
+    if not output_folder:
+        # Nothing was fetched: a run reported as cancelled, or one that produced no outputs
+        st.warning(f"No output files to show. {error}".strip())
+        return
+    st.success("Job Done!")
+
+    #   ============================    Getting output files    ============================    #
+
+    output_file_paths = [os.path.join(output_folder, f) for f in os.listdir(output_folder)
+                         if f != "output_files.tar.gz"]
+
+    # Sweeps have one task_<i> directory per parameter set (in its task_arguments.txt)
+    if os.path.isdir(os.path.join(output_folder, "task_0")):
+        st.info(output)
+        if error:
+            st.warning(error)
+    else:
+        show_info_log_content(output_file_paths, key=f"replicate_log_{job.job_id}")
+    tar_file_path = create_tar_gz(output_folder, output_file_paths)
+    download_link = (f'<a href="data:application/tar+gzip;base64,'
+                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
+                     f'" download="replicate_polymer_output_files.tar.gz">'
+                     f'Download Replicate Polymer output files</a>')
+    st.markdown(download_link, unsafe_allow_html=True)
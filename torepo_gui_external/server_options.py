@@ -1,10 +1,13 @@
 import streamlit as st
 import os
+import re
 import json
 from tkinter import filedialog
 from functions.server_options.server_options_functions import (ensure_json_extension, save_options_to_json,
-                                                               check_username_and_name_server, verify_virtualenv_path,
-                                                               verify_working_directory, clean_server_options)
+                                                               get_server_validation, invalidate_server_validation,
+                                                               clean_server_options)
+from functions.common.execution_backend import (SSHDirectBackend, SlurmBackend, get_local_backend,
+                                                LOCAL_POOL_WORKERS)
 
 
 class ServerScreen:
@@ -14,9 +17,12 @@ class ServerScreen:
         self._ssh_key_options = None
         self._path_virtualenv = None
         self._working_directory = None
+        self._remote_environment = None
 
         self._json_filename = None
         self._input_placeholder = None
+        self._run_locally = None
+        self._max_runtime = None
 
         self._use_queuing_system = None
         self._sbatch_squeue = None
@@ -24,6 +30,9 @@ class ServerScreen:
         self._add_cpus = None
         self._script_before_run = None
         self._script_after_run = None
+        self._cpus_per_task = None
+        self._mem = None
+        self._time_limit = None
 
     def show_screen_sidebar(self):
 
@@ -79,6 +88,16 @@ class ServerScreen:
         clean_server_options()  # Only clean if you have loaded it
         #   ========    Clean button   ========    #
 
+        # Programs can also run on this workstation, where no server is needed
+        self._run_locally = st.sidebar.toggle("Run on this workstation", key="run_locally")
+        # Wall-clock limit of each background run, after which the job engine stops it like the STOP button
+        max_runtime_minutes = st.sidebar.number_input("Stop runs after (minutes, 0 for no limit)", min_value=0,
+                                                      step=1, key="max_runtime_minutes")
+        self._max_runtime = max_runtime_minutes * 60 if max_runtime_minutes else None
+        if self._run_locally:
+            st.sidebar.info(f"Programs run here, up to {LOCAL_POOL_WORKERS} at a time")
+            return True
+
         server_options = st.session_state.get("server_options", {
             "Name Server*": "",
             "Username*": "",
@@ -122,26 +141,38 @@ class ServerScreen:
             valid = False
             return
 
-        if not check_username_and_name_server(self._name_server, self._name_user, self._ssh_key_options):
-            st.sidebar.error(
-                f"ERROR!!! Name server '{self._name_server}'"
-                f" or username '{self._name_user}' do not exist. Please, check them")
-            valid = False
-            return
+        # Remote checks are cached per server-options tuple, so reruns do not probe the cluster again
+        server_key = (self._name_server, self._name_user, self._ssh_key_options,
+                      self._path_virtualenv, self._working_directory)
+        previous_server_key = st.session_state.get("validated_server_key")
+        if previous_server_key and previous_server_key != server_key:
+            invalidate_server_validation(previous_server_key)
+        st.session_state.validated_server_key = server_key
 
-        if not verify_virtualenv_path(self._name_server, self._name_user, self._ssh_key_options,
-                                      self._path_virtualenv):
-            st.sidebar.error(
-                f"ERROR!!! Virtual environment path '{self._path_virtualenv}' does not exist on the remote server")
-            valid = False
-            return
+        if st.sidebar.button("Check server options again"):
+            invalidate_server_validation(server_key)
 
-        if not verify_working_directory(self._name_server, self._name_user,
-                                        self._ssh_key_options, self._working_directory):
-            st.sidebar.error(f"ERROR!!! Working directory '{self._working_directory}' does not exist")
+        validation_error, self._remote_environment = get_server_validation(server_key)
+        if validation_error:
+            st.sidebar.error(validation_error)
             valid = False
             return
 
+        with st.sidebar.expander("Remote environment"):
+            remote_environment = self._remote_environment
+            free_disk = remote_environment["free_disk_bytes"]
+            st.write(f"Host: {remote_environment['hostname']}")
+            st.write(f"CPUs: {remote_environment['cpu_count']}")
+            if free_disk is not None:
+                st.write(f"Free disk in working directory: {free_disk / 1024 ** 3:.1f} GB")
+            if remote_environment["quota"]:
+                st.text(remote_environment["quota"])
+            st.write("SLURM: " + ", ".join(f"{cmd} {'OK' if found else 'missing'}"
+                                           for cmd, found in remote_environment["slurm"].items()))
+            for program, found in remote_environment["programs"].items():
+                if not found:
+                    st.warning(f"'{program}' not found in the virtual environment")
+
         #   ============================    Save server options   ============================    #
 
         st.sidebar.markdown("<h1 style='font-size:22px;'>Save server options </h1>", unsafe_allow_html=True)
@@ -164,10 +195,35 @@ class ServerScreen:
         #   TEST
         st.sidebar.markdown("<h1 style='font-size:22px;'>Queuing system options </h1>", unsafe_allow_html=True)
 
-        self._use_queuing_system = st.sidebar.checkbox("Use queuing system")
+        self._use_queuing_system = st.sidebar.checkbox("Use queuing system", key="use_queuing_system")
         if self._use_queuing_system:
+            #   Resources requested per job, left empty they are the partition defaults
+            st.session_state.setdefault("slurm_cpus_per_task", None)
+            self._cpus_per_task = st.sidebar.number_input("CPUs per task (--cpus-per-task)", min_value=1, step=1,
+                                                          key="slurm_cpus_per_task")
+            self._mem = st.sidebar.text_input("Memory per job (--mem, e.g. 4G)", key="slurm_mem").strip()
+            if self._mem and not re.match(r"^\d+[KMGT]?$", self._mem):
+                st.sidebar.error("ERROR!!! Memory must be a number with an optional K, M, G or T unit")
+                self._mem = None
+            self._time_limit = st.sidebar.text_input("Walltime (--time, e.g. 02:00:00 or 1-00:00:00)",
+                                                     key="slurm_time_limit").strip()
+            if self._time_limit and not re.match(r"^(\d+-)?\d+(:\d+){0,2}$", self._time_limit):
+                st.sidebar.error("ERROR!!! Walltime must look like [days-]hours:minutes:seconds")
+                self._time_limit = None
             # self._sbatch_squeue = st.sidebar.radio("Take an option:", ('sbatch', 'squeue'))
             self._script_before_run = st.sidebar.text_area("Script before job execution (without #!/bin/sh)",
                                                            height=400)
             self._script_after_run = st.sidebar.text_area("Script after job execution", height=400)
         return True
+
+    def execution_backend(self):
+        """Backend the programs run on: this workstation, the server over SSH or SLURM on the server."""
+        if self._run_locally:
+            return get_local_backend()
+        if self._use_queuing_system:
+            return SlurmBackend(self._name_server, self._name_user, self._ssh_key_options, self._path_virtualenv,
+                                self._working_directory, script_before_run=self._script_before_run,
+                                script_after_run=self._script_after_run, cpus_per_task=self._cpus_per_task,
+                                mem=self._mem, time_limit=self._time_limit)
+        return SSHDirectBackend(self._name_server, self._name_user, self._ssh_key_options, self._path_virtualenv,
+                                self._working_directory)
@@ -4,8 +4,10 @@ import tempfile
 import base64
 import shutil
 from torepo_gui_external.server_options import ServerScreen
-from functions.common.common_functions import (save_uploaded_file, create_tar_gz,
-                                               clean_options)
+from functions.common.common_functions import (save_uploaded_file, create_tar_gz, clean_options, show_jobs_panel,
+                                               suggest_slurm_resources, show_resource_suggestion)
+from functions.common.slurm_resources import count_atoms
+from functions.common.job_engine import get_job_engine
 from functions.topology.topology_func import (run_topology_cmd_remote,
                                               show_info_topology_content, handle_button_click)
 
@@ -52,6 +54,8 @@ class TopologyScreen:
         self._ssh_key_options = server_screen._ssh_key_options
         self._path_virtualenv = server_screen._path_virtualenv
         self._working_directory = server_screen._working_directory
+        self._max_runtime = server_screen._max_runtime
+        self._backend = server_screen.execution_backend()
 
     def show_screen(self):
 
@@ -130,6 +134,11 @@ class TopologyScreen:
                                              st.session_state.get("guess_improper", False))
             st.session_state.guess_improper = self._guess_improper
 
+            #   ============================    SLURM resources   ============================    #
+
+            show_resource_suggestion("topology", self._suggest_resources,
+                                     "Estimated from the atoms of the input file and the accounting of previous runs")
+
             #   ============================    Clean and run buttons   ============================    #
             left, right = st.columns(2)
             #   ========    Clean button   ========    #
@@ -139,60 +148,75 @@ class TopologyScreen:
             with left:
                 button_run = st.button("RUN TOPOLOGY")
         if button_run:
-            if not self._server_valid:
-                st.error("ERROR!!! Please enter all server options correctly")
-                return
-
-            input_file_path = self._input_options.get("input_file_000", "")
-            renumber_pdb_path = self._input_options.get("input_file_001", "")
-            assign_residues_path = self._input_options.get("input_file_002", "")
-            filemap_path = self._input_options.get("input_file_003", "")
-
-            if not input_file_path:
-                st.error("ERROR!!! Please select an input file (XSD, PDB or MOL2) before running the program")
-                return
-
-            st.session_state["input_options"] = self._input_options
-
-            if not self._pattern:
-                st.error("ERROR!!! Please string pattern to name the new files")
-                return
-
-            temp_dir = tempfile.mkdtemp()
-            try:
-                input_file_path = save_uploaded_file(input_file_path, temp_dir)
-                renumber_pdb_path = save_uploaded_file(renumber_pdb_path,
-                                                       temp_dir) if renumber_pdb_path else None
-                assign_residues_path = save_uploaded_file(assign_residues_path,
-                                                          temp_dir) if assign_residues_path else None
-                filemap_path = save_uploaded_file(filemap_path, temp_dir) if filemap_path else None
-
-                with st.spinner("Running Topology. Please wait..."):
-                    warning_close_interface = st.warning("Do not close the interface while Topology is running.")
-                    output, error, output_folder = run_topology_cmd_remote(self._name_server, self._name_user,
-                                                                           self._ssh_key_options,
-                                                                           self._path_virtualenv,
-                                                                           input_file_path,
-                                                                           renumber_pdb_path,
-                                                                           assign_residues_path,
-                                                                           filemap_path,
-                                                                           self._separate_chains,
-                                                                           self._pattern, self._isunwrap,
-                                                                           self._guess_improper,
-                                                                           self._working_directory)
-                    warning_close_interface.empty()
-                    st.success("JOB DONE!!!")
-
-                    #   ============================    Getting output files    ============================    #
-
-                    output_file_paths = [os.path.join(output_folder, f) for f in os.listdir(output_folder)]
-                    show_info_topology_content(output_file_paths)
-                    tar_file_path = create_tar_gz(output_folder, output_file_paths)
-                    download_link = (f'<a href="data:application/tar+gzip;base64,'
-                                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
-                                     f'" download="topology_output_files.tar.gz">'
-                                     f'Download Topology output files</a>')
-                    st.markdown(download_link, unsafe_allow_html=True)
-
-            finally:
-                shutil.rmtree(temp_dir)
+            self._submit_run()
+
+        #   ============================    Background jobs   ============================    #
+        show_jobs_panel("Topology", show_topology_results)
+
+    def _suggest_resources(self):
+        """Fill in the SLURM resources for the atoms of the input file."""
+        input_file_path = self._input_options.get("input_file_000", "")
+        suggest_slurm_resources("topology", count_atoms(input_file_path) if input_file_path else None, 1,
+                                self._name_server, self._name_user, self._ssh_key_options)
+
+    def _submit_run(self):
+        if not self._server_valid:
+            st.error("ERROR!!! Please enter all server options correctly")
+            return
+
+        input_file_path = self._input_options.get("input_file_000", "")
+        renumber_pdb_path = self._input_options.get("input_file_001", "")
+        assign_residues_path = self._input_options.get("input_file_002", "")
+        filemap_path = self._input_options.get("input_file_003", "")
+
+        if not input_file_path:
+            st.error("ERROR!!! Please select an input file (XSD, PDB or MOL2) before running the program")
+            return
+
+        st.session_state["input_options"] = self._input_options
+
+        if not self._pattern:
+            st.error("ERROR!!! Please string pattern to name the new files")
+            return
+
+        # Uploaded inputs live in a temporary directory until the job has finished with them
+        temp_dir = tempfile.mkdtemp()
+        input_file_path = save_uploaded_file(input_file_path, temp_dir)
+        renumber_pdb_path = save_uploaded_file(renumber_pdb_path,
+                                               temp_dir) if renumber_pdb_path else None
+        assign_residues_path = save_uploaded_file(assign_residues_path,
+                                                  temp_dir) if assign_residues_path else None
+        filemap_path = save_uploaded_file(filemap_path, temp_dir) if filemap_path else None
+
+        get_job_engine().submit("Topology", f"{self._pattern} ({os.path.basename(input_file_path)})",
+                                run_topology_cmd_remote,
+                                self._name_server, self._name_user, self._ssh_key_options,
+                                self._path_virtualenv, input_file_path, renumber_pdb_path,
+                                assign_residues_path, filemap_path, self._separate_chains,
+                                self._pattern, self._isunwrap, self._guess_improper,
+                                self._working_directory, backend=self._backend,
+                                max_runtime=self._max_runtime,
+                                cleanup=lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+        st.success(f"Topology job submitted ({self._backend.name}). You can keep working, or close the tab: "
+                   f"the job is followed again when TOREPO is opened.")
+
+
+def show_topology_results(job):
+    output, error, output_folder = job.result
+    if not output_folder:
+        # Nothing was fetched: a run reported as cancelled, or one that produced no outputs
+        st.warning(f"No output files to show. {error}".strip())
+        return
+    st.success("JOB DONE!!!")
+
+    #   ============================    Getting output files    ============================    #
+
+    output_file_paths = [os.path.join(output_folder, f) for f in os.listdir(output_folder)
+                         if f != "output_files.tar.gz"]
+    show_info_topology_content(output_file_paths, key=f"topology_log_{job.job_id}")
+    tar_file_path = create_tar_gz(output_folder, output_file_paths)
+    download_link = (f'<a href="data:application/tar+gzip;base64,'
+                     f'{base64.b64encode(open(tar_file_path, "rb").read()).decode()}'
+                     f'" download="topology_output_files.tar.gz">'
+                     f'Download Topology output files</a>')
+    st.markdown(download_link, unsafe_allow_html=True)